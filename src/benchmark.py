@@ -0,0 +1,117 @@
+"""
+@file    benchmark.py
+@authors  David Megli
+
+Description:
+This file measures the throughput of the simulator on the scenarios of simulate_tests.py, scaled in number of copies of the network (and so of roads),
+length of the roads, vehicle injection rate and number of cycles.
+For each run it reports the wall time, the vehicle updates per second (one update is a vehicle moved in a cycle, i.e. a saved vehicle state),
+the time of each phase of the cycles (see Simulation.phaseTimes: inject, move, history, export) and the peak resident memory.
+Each run is executed in a new process, so the peak memory and the timings of a run don't depend on the previous runs.
+The results are saved in a JSON file, to compare the versions of the simulator.
+Usage: python benchmark.py [suite.json] [results.json]
+The suite file contains the list of runs, the fields not given in a run take the default of the scenario (see simulate_tests.py):
+{"repeat": 1, "runs": [{"scenario": "bifurcation_sem_high_flow", "copies": 10, "length": 1000, "injectionRate": 2, "cycles": 600, "engine": "scalar"}]}
+"""
+import contextlib
+import json
+import os
+import platform
+import sys
+import time as t
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from simulate import Simulation
+import simulate_tests
+
+SCENARIO_STRING = "scenario"
+COPIES_STRING = "copies"
+LENGTH_STRING = "length"
+INJECTION_RATE_STRING = "injectionRate"
+CYCLES_STRING = "cycles"
+ENGINE_STRING = "engine"
+REPEAT_STRING = "repeat"
+RUNS_STRING = "runs"
+SEED = 0 #all the runs use the same seed, so two versions simulate the same vehicles
+DEFAULT_SUITE = {
+    REPEAT_STRING: 1,
+    RUNS_STRING: [{SCENARIO_STRING: name} for name in simulate_tests.SCENARIOS] + [
+        {SCENARIO_STRING: "bifurcation_sem_high_flow", COPIES_STRING: 10},
+        {SCENARIO_STRING: "single_road_semaphore", COPIES_STRING: 10, LENGTH_STRING: 5000, CYCLES_STRING: 1800},
+    ]
+}
+
+def getPeakMemory(): #peak resident set size of the process in bytes, None if not available (e.g. on Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 #kilobytes on Linux
+
+# Runs one benchmark in the worker process and returns its results. The simulation prints are discarded and its files are written in the output folder
+def runBenchmark(run):
+    build = simulate_tests.SCENARIOS[run[SCENARIO_STRING]]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        simulation = build(run.get(CYCLES_STRING), run.get(INJECTION_RATE_STRING), run.get(LENGTH_STRING), run.get(COPIES_STRING, 1))
+        simulation.simulationName = "benchmark_%s" % run[SCENARIO_STRING]
+        simulation.kinematicsEngine = run.get(ENGINE_STRING, Simulation.ENGINE_SCALAR)
+        simulation.seed = SEED
+        start = t.perf_counter()
+        simulation.simulate()
+        wallTime = t.perf_counter() - start
+    vehicleUpdates = sum(vehicle.getStateCount() for vehicle in simulation.vehicles)
+    return {
+        SCENARIO_STRING: run[SCENARIO_STRING],
+        COPIES_STRING: run.get(COPIES_STRING, 1),
+        "roads": len(simulation.roads),
+        LENGTH_STRING: simulation.roads[0].length,
+        INJECTION_RATE_STRING: simulation.vehicleInjectionRate,
+        CYCLES_STRING: simulation.simulationCycles,
+        ENGINE_STRING: simulation.kinematicsEngine,
+        "vehicles": len(simulation.vehicles),
+        "vehicleUpdates": vehicleUpdates,
+        "wallTime": wallTime,
+        "vehicleUpdatesPerSecond": vehicleUpdates / wallTime if wallTime > 0 else None,
+        "phaseTimes": dict(simulation.phaseTimes),
+        "peakMemory": getPeakMemory()
+    }
+
+# Runs the benchmarks one at a time, each in a new process
+def runSuite(suite):
+    results = []
+    runs = [run for run in suite[RUNS_STRING] for _ in range(suite.get(REPEAT_STRING, 1))]
+    for i, run in enumerate(runs):
+        if run[SCENARIO_STRING] not in simulate_tests.SCENARIOS:
+            raise ValueError("Unknown scenario: %s" % run[SCENARIO_STRING])
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(runBenchmark, run).result()
+        results.append(result)
+        print("%d/%d %s x%d: %.2fs, %.0f vehicle updates/s" % (i + 1, len(runs), result[SCENARIO_STRING], result[COPIES_STRING], result["wallTime"], result["vehicleUpdatesPerSecond"] or 0))
+    return {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": SEED,
+        "results": results
+    }
+
+def main(argv):
+    suite = DEFAULT_SUITE
+    if len(argv) > 0:
+        with open(argv[0], "r") as f:
+            suite = json.load(f)
+    os.makedirs("../output", exist_ok=True)
+    resultsFile = argv[1] if len(argv) > 1 else "../output/benchmark_%s.json" % datetime.now().strftime("%Y%m%d_%H%M%S")
+    try:
+        report = runSuite(suite)
+    except Exception as e:
+        print("Error:", e)
+        return
+    with open(resultsFile, "w+") as f:
+        json.dump(report, f, indent = 4)
+    print("Data saved to %s" % os.path.abspath(resultsFile))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
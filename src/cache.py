@@ -0,0 +1,140 @@
+"""
+@file    cache.py
+@authors  David Megli
+
+Description:
+This file contains the cache of the compiled scenarios, used by Simulation.getSimulationFromJSON.
+The first time a scenario file is loaded, the simulation built from it (roads, lanes, shapes, semaphores with their phase tables, intersections)
+is pickled in the cache folder, in a file named after a hash of the scenario file, of the JSON schema and of the source of every module of the simulator folder.
+The next runs of the same scenario load the pickle instead of parsing, validating and building it again;
+a change of the scenario, of the schema or of the code gives a new hash, so a stale simulation is never loaded.
+The cache keeps the MAX_ENTRIES scenarios used most recently, the older files are deleted when a new one is saved. clear empties it (python simulate.py --clear-cache).
+The roads are pickled without their junctions, which are linked again after loading: the junctions link the roads in long chains,
+that the pickle module would follow recursively. dumpSimulation and loadSimulation are also used by the checkpoints of a running simulation (see checkpoint.py).
+"""
+import copyreg
+import gc
+import hashlib
+import os
+import pickle
+from map import Road
+
+def reduceRoad(road): #pickles the road without its start and end junctions
+    state = road.__dict__.copy()
+    state["startJunction"] = None
+    state["endJunction"] = None
+    return (copyreg.__newobj__, (type(road),), state)
+
+def dumpSimulation(simulation, file, extra = None): #pickles the simulation and the extra objects in the binary file
+    gcEnabled = gc.isenabled()
+    gc.disable() #nothing is freed while pickling, collecting only wastes time
+    try:
+        links = [(road.startJunction, road.endJunction) for road in simulation.roads]
+        pickler = pickle.Pickler(file, pickle.HIGHEST_PROTOCOL)
+        pickler.dispatch_table = copyreg.dispatch_table.copy()
+        pickler.dispatch_table[Road] = reduceRoad
+        pickler.dump((simulation, links, extra))
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+def loadSimulation(file): #returns the simulation and the extra objects pickled by dumpSimulation, with the junctions linked again
+    gcEnabled = gc.isenabled()
+    gc.disable() #the loaded objects are all alive, collecting while they are created only wastes time
+    try:
+        simulation, links, extra = pickle.load(file)
+        for road, (startJunction, endJunction) in zip(simulation.roads, links):
+            road.startJunction = startJunction
+            road.endJunction = endJunction
+    finally:
+        if gcEnabled:
+            gc.enable()
+    return simulation, extra
+
+class ScenarioCache:
+    DEFAULT_FOLDER = "../output/cache"
+    MAX_ENTRIES = 32 #cached scenarios kept, the least recently used are deleted
+    EXTENSION = ".pickle"
+    codeHash = None # hash of the source of the modules, computed once per process
+
+    def __init__(self, folder = DEFAULT_FOLDER, maxEntries = MAX_ENTRIES):
+        self.folder = folder
+        self.maxEntries = maxEntries
+
+    @staticmethod
+    def getCodeHash(): #hash of the names and the source of all the modules in the folder of this file, so no module of the pickled classes can be missed
+        if ScenarioCache.codeHash is None:
+            digest = hashlib.sha256()
+            folder = os.path.dirname(os.path.abspath(__file__))
+            for name in sorted(name for name in os.listdir(folder) if name.endswith(".py")):
+                with open(os.path.join(folder, name), "rb") as f:
+                    source = f.read()
+                for part in (name.encode(), source):
+                    digest.update(len(part).to_bytes(8, "little"))
+                    digest.update(part)
+            ScenarioCache.codeHash = digest.hexdigest()
+        return ScenarioCache.codeHash
+
+    def getKey(self, scenario, schema = b""): #scenario and schema as bytes, as read from the files
+        digest = hashlib.sha256()
+        for part in (scenario, schema, ScenarioCache.getCodeHash().encode()):
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def getFilename(self, key):
+        return os.path.join(self.folder, key + self.EXTENSION)
+
+    def load(self, key): #returns the cached simulation, None if it's not in the cache or it can't be read
+        filename = self.getFilename(key)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with open(filename, "rb") as f:
+                simulation, _ = loadSimulation(f)
+        except Exception as e:
+            print("Ignoring the cached scenario %s: %s" % (filename, e))
+            return None
+        try:
+            os.utime(filename) #the modification time is the last use, see prune
+        except OSError:
+            pass
+        return simulation
+
+    def save(self, key, simulation): #must be called before the simulation runs
+        os.makedirs(self.folder, exist_ok=True)
+        filename = self.getFilename(key)
+        temporary = "%s.%d.tmp" % (filename, os.getpid()) #written aside and renamed, so parallel runs never read a partial file
+        with open(temporary, "wb") as f:
+            dumpSimulation(simulation, f)
+        os.replace(temporary, filename)
+        self.prune()
+
+    def getEntries(self): #paths of the cached scenarios, from the most recently used
+        if not os.path.isdir(self.folder):
+            return []
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith(self.EXTENSION):
+                filename = os.path.join(self.folder, name)
+                try:
+                    entries.append((os.path.getmtime(filename), filename))
+                except OSError: #deleted by a parallel run
+                    pass
+        return [filename for _, filename in sorted(entries, reverse=True)]
+
+    def remove(self, filenames): #returns the number of files removed, the ones already removed by a parallel run are skipped
+        removed = 0
+        for filename in filenames:
+            try:
+                os.remove(filename)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def prune(self): #deletes the least recently used scenarios beyond maxEntries
+        return self.remove(self.getEntries()[self.maxEntries:])
+
+    def clear(self): #deletes all the cached scenarios, returns how many they were
+        return self.remove(self.getEntries())
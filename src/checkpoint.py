@@ -0,0 +1,75 @@
+"""
+@file    checkpoint.py
+@authors  David Megli
+
+Description:
+This file contains the checkpoints of a running simulation, enabled with "checkpointInterval" in the "simulation" section (or Simulation.checkpointInterval).
+Every checkpointInterval cycles Simulation.simulate saves the whole state of the run in <name>_checkpoint_<cycles>.pickle: the roads and the lanes with their vehicles,
+the vehicles with their delays and state histories, the semaphores, the intersections, the map history, the metrics, the counters, the state of the random generator
+and the offsets of the vehicles history file and of the log, that are flushed first. The state is pickled in the same binary form of the scenario cache (see cache.py)
+at the end of a cycle, then the bytes are written by a background thread, so the simulation waits for the disk only if the previous checkpoint is still being written.
+The file is written aside and renamed, so the checkpoint on disk is always a complete one.
+getCheckpointData and loadCheckpointData give the same state as bytes, e.g. to clone a warmed up simulation in other processes (see warmstart.py).
+Simulation.loadCheckpoint loads a checkpoint and Simulation.resume continues the run from the cycle after it: the output files are cut at the saved offsets and continued,
+so a run that was interrupted and resumed writes the same files of a run that never stopped.
+"""
+import io
+import os
+import random
+import threading
+from cache import dumpSimulation, loadSimulation
+
+VERSION = 3 #format of the checkpoint, a checkpoint of another version is not loaded
+
+class CheckpointWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread = None #thread writing the last checkpoint
+        self.error = None #exception of the last write, raised by the next write or wait
+
+    def write(self, simulation): #called at the end of a cycle, when simulation.nextCycle is the cycle the run would continue from
+        data = getCheckpointData(simulation)
+        self.wait()
+        self.thread = threading.Thread(target=self.writeFile, args=(data,))
+        self.thread.start()
+
+    def writeFile(self, data):
+        temporary = "%s.tmp" % self.filename
+        try:
+            with open(temporary, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.filename)
+        except Exception as e:
+            self.error = e
+
+    def wait(self): #waits until the last checkpoint is on disk, raises the error if it couldn't be written
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise RuntimeError("Error writing the checkpoint %s: %s" % (self.filename, error)) from error
+
+def getCheckpointData(simulation): #the state of the simulation and of the random generator, as the bytes of a checkpoint file
+    buffer = io.BytesIO()
+    dumpSimulation(simulation, buffer, {"version": VERSION, "random": random.getstate()})
+    return buffer.getvalue()
+
+def loadCheckpoint(filename): #returns the simulation saved in the checkpoint, resume it with Simulation.resume
+    with open(filename, "rb") as f:
+        data = f.read()
+    return loadCheckpointData(data)
+
+def loadCheckpointData(data): #returns the simulation of the bytes given by getCheckpointData
+    simulation, extra = loadSimulation(io.BytesIO(data))
+    if extra is None or extra.get("version") != VERSION:
+        raise ValueError("Not a checkpoint of this version")
+    roadsById = {road.id: road for road in simulation.roads}
+    for vehicle in simulation.vehicleTypes + simulation.vehicles:
+        if hasattr(vehicle, "stateHistory"): #the retired vehicles have no state history
+            vehicle.stateHistory.relinkRoads(roadsById)
+    simulation.randomState = extra["random"]
+    return simulation
@@ -5,9 +5,15 @@
 Description:
 This file contains the classes to handle the history of the map, saving the state of the roads at different times.
 The classes calculate the number of vehicles and density for each sector of a Road, and can save the history of the road in a json file.
+VehicleHistoryWriter streams the vehicles states to disk during the simulation, one time bucket per cycle, without keeping the whole history in memory.
 """
 from map import Road
+from vehicle import Vehicle, VehicleState
+from trajectory import TrajectoryWriter
+import copy
 import json
+from bisect import bisect_left
+from collections import deque
 
 class RoadState:
     def __init__(self, time, vehiclesPerSector, densityPerSector, densityPerSectorPerLane, numSectors, minimumDensityToConsiderTrafficQueue = 0.8):
@@ -20,45 +26,97 @@ class RoadState:
         self.minDensityToConsiderTrafficQueue = minimumDensityToConsiderTrafficQueue
         self.calculateLongestTrafficQueue()
 
-    def calculateLongestTrafficQueue(self):
+    def calculateLongestTrafficQueue(self): #longest run of consecutive sectors with density over the threshold
+        count = 0
         for i in range(self.numSectors):
             if self.densityPerSector[i] > self.minDensityToConsiderTrafficQueue:
-                count = 1
-                for j in range(i+1, self.numSectors):
-                    if self.densityPerSector[j] > self.minDensityToConsiderTrafficQueue:
-                        count += 1
-                    else:
-                        break
+                count += 1
                 if count > self.longestTrafficQueue:
                     self.longestTrafficQueue = count
+            else:
+                count = 0
 
+    def getStateAtTime(self, time): #same state at another time, the sector lists are shared since they are never changed
+        state = copy.copy(self)
+        state.time = time
+        return state
+
+# RoadHistory aggregates the metrics of the road online (running sums and maxima updated at every saveState), so they don't depend on the stored states.
+# The states with the sectors of the road (the snapshots) are stored only every sampleInterval seconds (0 = every call),
+# and if historyWindow is set only the last historyWindow snapshots are kept, so the memory doesn't grow with the duration of the simulation
 class RoadHistory:
-    def __init__(self, road: Road, sectorLength = 100): #sectorLength in meters
+    def __init__(self, road: Road, sectorLength = 100, sampleInterval = 0, historyWindow = None): #sectorLength in meters, sampleInterval in seconds
         self.road = road
         self.numLanes = road.getNumberOfLanes()
         self.sectorLength = sectorLength
-        self.states = [] #list of SectorsState objects that represent the state of the road in a given time
+        self.sampleInterval = sampleInterval
+        self.states = deque(maxlen=historyWindow) if historyWindow else [] #list of SectorsState objects that represent the state of the road in a given time
+        self.lastSampleTime = None
+        self.lastState = None #last saved state and the version of the road when it was saved (see Road.stateVersion)
+        self.lastStateVersion = None
+        self.sectorStarts, self.sectorEnds = self.calculateSectors(road)
+        # online aggregates
+        self.stateCount = 0
+        self.numSectors = len(self.sectorStarts)
+        self.totalDensity = 0
+        self.totalVehicles = 0
+        self.totalLongestTrafficQueue = 0
+        self.maxDensity = 0
+        self.maxVehiclesPerSector = 0
+        self.maxLongestTrafficQueue = 0
 
-    def saveState(self, road, time): #Given the time, I save the state of the road, saving the number of vehicles in each sector
-        vehiclesPerSector = []
-        densityPerSector = []
-        densityPerSectorPerLane = []
+    def calculateSectors(self, road): #returns the start and end positions of the sectors, a vehicle is in a sector if start < position <= end
+        starts = []
+        ends = []
         for i in range(0, int(road.length), int(self.sectorLength)):
             maxpos = i + self.sectorLength if i + self.sectorLength <= road.length else int(road.length)
             if int(road.length) - i < self.sectorLength*3/2: #in case the last sector is too short
                 maxpos = int(road.length)
-            vehicles = self.road.vehiclesAt(i, maxpos)
-            occupiedSpace = 0
-            for v in vehicles:
-                occupiedSpace += v.length
-                occupiedSpace += self.road.vehicleDistance
-            vehiclesPerSector.append(len(road.vehiclesAt(i, maxpos)))
-            sectorDensity = occupiedSpace / self.sectorLength if self.sectorLength > 0 else 0
-            densityPerSector.append(sectorDensity)
-            densityPerSectorPerLane.append(sectorDensity / self.numLanes)
+            starts.append(i)
+            ends.append(maxpos)
             if int(road.length) - i < self.sectorLength*3/2:
                 break
-        self.states.append(RoadState(time, vehiclesPerSector, densityPerSector, densityPerSectorPerLane, len(vehiclesPerSector)))
+        return starts, ends
+
+    def saveState(self, road, time): #Given the time, I save the state of the road, saving the number of vehicles in each sector
+        if self.lastState is not None and road.stateVersion == self.lastStateVersion: #no vehicle moved, entered or left the road (e.g. an empty road)
+            self.addState(self.lastState.getStateAtTime(time))
+            return
+        # single pass over the vehicles: each vehicle is added to the sectors that contain its position, found with a binary search on the sector ends.
+        # Sectors only overlap when sectorLength is not an integer, in that case a vehicle can be counted in two sectors
+        numSectors = len(self.sectorStarts)
+        vehiclesPerSector = [0] * numSectors
+        occupiedSpacePerSector = [0] * numSectors
+        for lane in road.lanes:
+            for v in lane.getVehicles():
+                sector = bisect_left(self.sectorEnds, v.position)
+                while sector < numSectors and self.sectorStarts[sector] < v.position:
+                    vehiclesPerSector[sector] += 1
+                    occupiedSpacePerSector[sector] += v.length
+                    occupiedSpacePerSector[sector] += road.vehicleDistance
+                    sector += 1
+        densityPerSector = [occupiedSpace / self.sectorLength if self.sectorLength > 0 else 0 for occupiedSpace in occupiedSpacePerSector]
+        densityPerSectorPerLane = [sectorDensity / self.numLanes for sectorDensity in densityPerSector]
+        self.lastState = RoadState(time, vehiclesPerSector, densityPerSector, densityPerSectorPerLane, numSectors)
+        self.lastStateVersion = road.stateVersion
+        self.addState(self.lastState)
+
+    def addState(self, state): #aggregates the state and stores it if it's time to take a snapshot
+        self.aggregateState(state)
+        if self.lastSampleTime is None or state.time - self.lastSampleTime >= self.sampleInterval:
+            self.states.append(state)
+            self.lastSampleTime = state.time
+
+    def aggregateState(self, state): #updates the running sums and maxima used by getMetrics
+        self.stateCount += 1
+        self.numSectors = state.numSectors
+        self.totalDensity += sum(state.densityPerSector)
+        self.totalVehicles += sum(state.vehiclesPerSector)
+        self.totalLongestTrafficQueue += state.longestTrafficQueue
+        if state.numSectors > 0:
+            self.maxDensity = max(self.maxDensity, max(state.densityPerSector))
+            self.maxVehiclesPerSector = max(self.maxVehiclesPerSector, max(state.vehiclesPerSector))
+        self.maxLongestTrafficQueue = max(self.maxLongestTrafficQueue, state.longestTrafficQueue)
 
     def getHistory(self):
         return self.states
@@ -97,20 +155,18 @@ class RoadHistory:
         return history_dict
     
     def getMetrics(self):
-        #calculates average density, average vehicles per sector, average longest traffic queue
-        totalDensity = 0
-        totalVehicles = 0
-        totalLongestTrafficQueue = 0
-        for state in self.states:
-            totalDensity += sum(state.densityPerSector)
-            totalVehicles += sum(state.vehiclesPerSector)
-            totalLongestTrafficQueue += state.longestTrafficQueue
+        #returns average density, average vehicles per sector, average longest traffic queue and their maxima, from the online aggregates
+        stateCount = self.stateCount if self.stateCount > 0 else 1
+        numSectors = self.numSectors if self.numSectors > 0 else 1
         return {
             "road": self.road.id,
             "sectorLength": self.sectorLength,
-            "averageDensity": totalDensity / len(self.states) / state.numSectors,
-            "averageVehiclesPerSector": totalVehicles / len(self.states) / state.numSectors,
-            "averageLongestTrafficQueue": totalLongestTrafficQueue * self.sectorLength / len(self.states)
+            "averageDensity": self.totalDensity / stateCount / numSectors,
+            "averageVehiclesPerSector": self.totalVehicles / stateCount / numSectors,
+            "averageLongestTrafficQueue": self.totalLongestTrafficQueue * self.sectorLength / stateCount,
+            "maxDensity": self.maxDensity,
+            "maxVehiclesPerSector": self.maxVehiclesPerSector,
+            "maxLongestTrafficQueue": self.maxLongestTrafficQueue * self.sectorLength
         }
     
     def saveMetrics(self, filename):
@@ -119,11 +175,11 @@ class RoadHistory:
             json.dump(metrics, f, indent = 4)
 
 class MapHistory:
-    def __init__(self, roads, sectorLength = 100):
+    def __init__(self, roads, sectorLength = 100, sampleInterval = 0, historyWindow = None):
         self.roads = roads
         self.roadHistories = []
         for road in roads:
-            self.roadHistories.append(RoadHistory(road, sectorLength))
+            self.roadHistories.append(RoadHistory(road, sectorLength, sampleInterval, historyWindow))
         
     def saveState(self, time):
         for roadHistory in self.roadHistories:
@@ -154,3 +210,124 @@ class MapHistory:
         metrics = self.getMetrics()
         with open(filename, "w+") as f:
             json.dump(metrics, f, indent = 4)
+
+
+# VehicleHistoryWriter writes the vehicles state history grouped by time while the simulation is running.
+# Vehicles notify the writer every time they save a state (see Vehicle.saveState), the writer keeps only the states of the current cycle
+# and appends them to the file as a single time bucket when saveBucket is called at the end of the cycle.
+# In NDJSON mode each line of the file is a time bucket, in JSON mode the file has the same "vehiclesHistory" layout
+# produced by Vehicle.saveVehiclesStateHistoryGroupedByTime, which is the one read by the visual simulator.
+# In binary mode the buckets are written in the binary trajectory format (see trajectory.py).
+class VehicleHistoryWriter:
+    MODE_NDJSON = "ndjson"
+    MODE_JSON = "json"
+    MODE_BINARY = "bin"
+    INDENT = 4
+    def __init__(self, filename, mode = MODE_NDJSON):
+        if mode != self.MODE_NDJSON and mode != self.MODE_JSON and mode != self.MODE_BINARY:
+            raise ValueError("Unknown vehicle history mode: %s" % mode)
+        self.filename = filename
+        self.mode = mode
+        self.file = None
+        self.trajectoryWriter = None
+        self.bucketCount = 0
+        self.currentStates = [] #list of (vehicle id, row) saved in the current cycle, the rows are (time, position, speed, acceleration, state, road) as given by VehicleStateHistory.getRow
+
+    def open(self):
+        if self.mode == self.MODE_BINARY:
+            self.trajectoryWriter = TrajectoryWriter(self.filename).open()
+            self.bucketCount = 0
+            self.currentStates = []
+            return self
+        self.file = open(self.filename, "w+")
+        self.bucketCount = 0
+        self.currentStates = []
+        if self.mode == self.MODE_JSON:
+            self.file.write("{\n%s\"%s\": [" % (" " * self.INDENT, Vehicle.VEHICLE_HISTORY_STRING))
+        return self
+
+    # When pickled with the simulation (see checkpoint.py) the file is flushed and only its offset is saved, reopen continues the file from that offset
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.file is not None:
+            self.file.flush()
+            state["offset"] = self.file.tell()
+            state["file"] = None
+        return state
+
+    def suspend(self): #closes the file without ending it, reopen continues it (e.g. when a run stops before its last cycle, see Simulation.simulate)
+        if self.trajectoryWriter is not None:
+            self.trajectoryWriter.suspend()
+        if self.file is not None:
+            self.offset = self.file.tell()
+            self.file.close()
+            self.file = None
+
+    def reopen(self): #continues the file of a checkpoint or of a suspended run, dropping what was written after it
+        if self.mode == self.MODE_BINARY:
+            self.trajectoryWriter.reopen()
+            return self
+        self.file = open(self.filename, "r+")
+        self.file.truncate(self.offset)
+        self.file.seek(self.offset)
+        return self
+
+    def recordState(self, vehicle, index): #the state just saved at the given index of the history of the vehicle, read from its columns
+        self.currentStates.append((vehicle.id, vehicle.stateHistory.getRow(index)))
+
+    def recordRow(self, vehicleId, row): #same as recordState, for the rows received from the regions (see partition.py)
+        self.currentStates.append((vehicleId, row))
+
+    # Coordinates of the states of a bucket: the positions on the same road are projected with a single call to Road.getCoordinatesByPositions,
+    # (-1, -1) if the road has no shape
+    def projectBucket(self, states):
+        coordinates = [(-1, -1)] * len(states)
+        rowsByRoad = {} #road -> rows of its states in the bucket
+        for row, (vehicleId, state) in enumerate(states):
+            rowsByRoad.setdefault(state[5], []).append(row)
+        for road, rows in rowsByRoad.items():
+            coords = road.getCoordinatesByPositions([states[row][1][1] for row in rows]) if road is not None else None
+            if coords is None:
+                continue
+            for row, x, y in zip(rows, coords[0], coords[1]):
+                coordinates[row] = (x, y)
+        return coordinates
+
+    def getStateJSON(self, vehicleId, row, coordinates): #same entry of VehicleState.getStateAsTimeBucketJSON, from a row of the bucket
+        _, position, speed, acceleration, state, road = row
+        digits = VehicleState.ROUND_DIGITS
+        return {VehicleState.VEHICLE_ID_STRING: vehicleId, VehicleState.POSITION_STRING: round(position, digits), VehicleState.X_COORDINATE_STRING: round(coordinates[0], digits), VehicleState.Y_COORDINATE_STRING: round(coordinates[1], digits), VehicleState.SPEED_STRING: round(speed, digits), VehicleState.ACCELERATION_STRING: round(acceleration, digits), VehicleState.STATE_STRING: state, VehicleState.ROAD_STRING: road.id}
+
+    def saveBucket(self, time): #writes the states saved at the given time and clears them
+        states = [entry for entry in self.currentStates if entry[1][0] == time]
+        states.sort(key=lambda entry: entry[0]) #vehicles in order of creation, states of the same vehicle in the order they were saved
+        coordinates = self.projectBucket(states)
+        if self.mode == self.MODE_BINARY:
+            self.trajectoryWriter.writeBucket(time, states, coordinates)
+            self.bucketCount += 1
+            self.currentStates = []
+            return
+        bucket = {VehicleState.TIME_STRING: time, Vehicle.VEHICLE_STATES_STRING: [self.getStateJSON(vehicleId, row, coords) for (vehicleId, row), coords in zip(states, coordinates)]}
+        if self.mode == self.MODE_NDJSON:
+            self.file.write(json.dumps(bucket))
+            self.file.write("\n")
+        else:
+            prefix = " " * (self.INDENT * 2)
+            text = json.dumps(bucket, indent = self.INDENT)
+            self.file.write(",\n" if self.bucketCount > 0 else "\n")
+            self.file.write("\n".join(prefix + line for line in text.split("\n")))
+        self.bucketCount += 1
+        self.currentStates = []
+
+    def close(self):
+        if self.trajectoryWriter is not None:
+            self.trajectoryWriter.close()
+            self.trajectoryWriter = None
+        if self.file is None:
+            return
+        if self.mode == self.MODE_JSON:
+            if self.bucketCount > 0:
+                self.file.write("\n%s" % (" " * self.INDENT))
+            self.file.write("]\n}")
+        self.file.close()
+        self.file = None
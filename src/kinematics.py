@@ -0,0 +1,160 @@
+"""
+@file    kinematics.py
+@authors  David Megli
+
+Description:
+This file contains the vectorized kinematics engine, an optional replacement of the per-vehicle loop in Road.moveVehicles.
+The engine copies the vehicles of a lane in arrays (struct of arrays) and advances in a single numpy step all the consecutive vehicles
+that are free-flowing or following a moving vehicle: acceleration clipping, speed capping to maxSpeed and speedLimit, gaussian noise and the gap from the preceding vehicle.
+Every other vehicle (stopped, restarting, giving way, close to a red semaphore or reaching the end of the road) is moved by Road.moveVehicle as before.
+The gaussian noise is drawn from the random module in the same order as the scalar engine, so with the same seed the two engines give the same results;
+positions, speeds and states are checked against the exact comparisons of the scalar engine, and the batch falls back to it when they don't match.
+numpy is only needed when the engine is used.
+"""
+import random
+import numpy as np
+from vehicle import Vehicle
+
+class VectorizedKinematicsEngine:
+    MIN_BATCH_SIZE = 4 #shorter runs of vehicles are moved by the scalar engine, the numpy overhead is not worth it
+    def __init__(self, minBatchSize = MIN_BATCH_SIZE):
+        self.minBatchSize = minBatchSize
+
+    def moveVehicles(self, road, time, timeStep = 1):
+        if road.getNumberOfLanes() != 1: #moveVehicle always looks for the preceding vehicle in the first lane, multi lane roads use the scalar engine
+            for vehicle in road.getAllVehicles():
+                road.moveVehicle(vehicle, time, timeStep)
+            return
+        vehicles = road.getAllVehicles()
+        i = 0
+        while i < len(vehicles):
+            end = i
+            while end < len(vehicles) and self.canBeBatched(road, vehicles[end], time):
+                end += 1
+            moved = 0
+            if end - i >= self.minBatchSize and self.leaderAllowsBatch(road, vehicles[i]):
+                moved = self.moveBatch(road, vehicles[i:end], time, timeStep)
+                if moved is None: #the batch doesn't match the scalar engine, its vehicles are moved one by one
+                    for vehicle in vehicles[i:end]:
+                        road.moveVehicle(vehicle, time, timeStep)
+                    moved = end - i
+            if moved == 0:
+                road.moveVehicle(vehicles[i], time, timeStep)
+                moved = 1
+            i += moved
+
+    # Returns True if the scalar engine would move the vehicle with a single Vehicle.move followed by an optional followVehicle,
+    # without looking at the state of the preceding vehicle, which is checked in leaderAllowsBatch and moveBatch
+    def canBeBatched(self, road, vehicle, time):
+        if vehicle.lastUpdate == time and not vehicle.wasJustCreated():
+            return False
+        if not road.hasVehicle(vehicle):
+            return False
+        if vehicle.state != Vehicle.STATE_MOVING and vehicle.state != Vehicle.STATE_FOLLOWING_VEHICLE:
+            return False
+        if vehicle.speed <= 0 or not vehicle.isDeparted:
+            return False
+        nextSem = road.getNextSemaphore(vehicle.getPosition())
+        return nextSem is None or not nextSem.isRed(time)
+
+    # The first vehicle of a batch can be batched only if the vehicle in front of it is moving, a stopped vehicle in front makes it brake
+    def leaderAllowsBatch(self, road, vehicle):
+        leader = road.precedingVehicle(vehicle)
+        return leader is None or (not leader.isStopped() and leader.speed > 0)
+
+    # Moves the given consecutive vehicles and returns how many of them were moved (the first ones).
+    # Returns 0 if the first vehicle must be moved by the scalar engine, None if the whole batch must
+    def moveBatch(self, road, vehicles, time, timeStep):
+        n = len(vehicles)
+        position = np.array([v.position for v in vehicles], dtype=float)
+        speed = np.array([v.speed for v in vehicles], dtype=float)
+        maxSpeed = np.array([v.maxSpeed for v in vehicles], dtype=float)
+        maxAcceleration = np.array([v.maxAcceleration for v in vehicles], dtype=float)
+        sigma = np.array([v.sigma for v in vehicles], dtype=float)
+        length = np.array([v.length for v in vehicles], dtype=float)
+        # Vehicle.calculateAcceleration, calculateSpeed and calculatePosition
+        reachesMaxSpeed = speed + maxAcceleration * timeStep > maxSpeed
+        acceleration = np.where(reachesMaxSpeed, (maxSpeed - speed) / timeStep, maxAcceleration)
+        reachesMaxSpeed = speed + acceleration * timeStep > maxSpeed
+        freePosition = np.where(reachesMaxSpeed, position + speed * timeStep + 0.5 * (maxSpeed - speed) * timeStep, position + speed * timeStep + 0.5 * acceleration * timeStep**2)
+        meanSpeed = np.minimum(speed + acceleration * timeStep, maxSpeed)
+        # random.gauss(mu, sigma) returns mu + z * sigma, the number of numbers drawn doesn't depend on mu and sigma
+        randomState = random.getstate()
+        z = np.array([random.gauss(0.0, 1.0) for _ in range(n)], dtype=float)
+        freeSpeed = np.minimum(meanSpeed + z * sigma, road.speedLimit)
+        freeSpeed = np.where(freeSpeed > maxSpeed, maxSpeed, freeSpeed)
+        acceleration = np.where(acceleration <= maxAcceleration, acceleration, maxAcceleration)
+        # a vehicle that would stop or reach the end of the road is left to the scalar engine, with the vehicles behind it
+        cut = np.flatnonzero((freeSpeed <= 0) | (freePosition > road.length))
+        count = int(cut[0]) if len(cut) > 0 else n
+        if count < self.minBatchSize:
+            random.setstate(randomState)
+            return 0
+        if count < n: #the numbers drawn for the vehicles left to the scalar engine are drawn again by Vehicle.move
+            random.setstate(randomState)
+            for _ in range(count):
+                random.gauss(0.0, 1.0)
+        result = self.applyGaps(road, vehicles[0], freePosition[:count], freeSpeed[:count], maxSpeed[:count], length[:count])
+        if result is None: #the exact comparisons don't match the vectorized ones
+            random.setstate(randomState)
+            return None
+        newPosition, newSpeed, following = result
+        for i in range(count):
+            vehicle = vehicles[i]
+            vehicle.position = float(newPosition[i])
+            vehicle.speed = float(newSpeed[i])
+            vehicle.acceleration = float(acceleration[i])
+            if following[i]:
+                vehicle.state = Vehicle.STATE_FOLLOWING_VEHICLE
+            else:
+                vehicle.state = Vehicle.STATE_MOVING
+            vehicle.update(time, road)
+        return count
+
+    # Applies the safety distance from the preceding vehicle, like Road.moveAndOvertakeIfPossible does with followVehicle:
+    # a vehicle whose free position exceeds the safety position from the vehicle in front is placed at that position, with the same speed.
+    # Returns the positions, the speeds and which vehicles end in the following state, None if the result differs from the scalar engine
+    def applyGaps(self, road, firstVehicle, freePosition, freeSpeed, maxSpeed, length):
+        n = len(freePosition)
+        leader = road.precedingVehicle(firstVehicle)
+        distance = road.vehicleDistance
+        # the positions are prefix minimums of the free positions, shifted by the cumulative space taken by the vehicles in front
+        leaderPosition = np.concatenate(([leader.position if leader is not None else np.inf], freePosition))
+        leaderLength = np.concatenate(([leader.length if leader is not None else 0.0], length))
+        space = np.concatenate(([0.0], np.cumsum(distance + leaderLength[:-1])))
+        approximatePosition = np.minimum.accumulate(leaderPosition + space) - space
+        follows = freePosition > approximatePosition[1:]
+        # the exact positions are computed segment by segment, in the same order of operations of Vehicle.followVehicle
+        newPosition = freePosition.copy()
+        newSpeed = freeSpeed.copy()
+        following = follows.copy()
+        starts = np.flatnonzero(~follows)
+        segmentStarts = list(starts) if len(starts) > 0 and starts[0] == 0 else [-1] + list(starts)
+        segmentEnds = segmentStarts[1:] + [n]
+        for start, end in zip(segmentStarts, segmentEnds):
+            if end - start <= 1:
+                continue
+            if start < 0:
+                basePosition, baseLength, baseSpeed = leader.position, leader.length, leader.speed
+            else:
+                basePosition, baseLength, baseSpeed = newPosition[start], length[start], newSpeed[start]
+            followers = slice(start + 1, end)
+            operands = np.empty(2 * (end - start - 1) + 1)
+            operands[0] = basePosition
+            operands[1::2] = np.concatenate(([baseLength], length[start + 1:end - 1]))
+            operands[2::2] = distance
+            newPosition[followers] = np.subtract.accumulate(operands)[2::2]
+            speeds = np.minimum(maxSpeed[followers], road.speedLimit)
+            speeds[0] = min(speeds[0], baseSpeed)
+            newSpeed[followers] = np.minimum.accumulate(speeds)
+            # Road.limitSpeed sets the moving state if the speed taken from the vehicle in front exceeds the speed limit
+            precedingSpeed = np.concatenate(([baseSpeed], newSpeed[start + 1:end - 1]))
+            following[followers] = np.minimum(precedingSpeed, maxSpeed[followers]) <= road.speedLimit
+        # check the vectorized choices against the exact comparisons of the scalar engine (newPosition > safetyPositionFrom(leader))
+        if leader is not None:
+            safetyPosition = np.concatenate(([leader.position - distance - leader.length], newPosition[:-1] - distance - length[:-1]))
+            if not np.array_equal(follows, freePosition > safetyPosition):
+                return None
+        elif follows[0] or not np.array_equal(follows[1:], freePosition[1:] > newPosition[:-1] - distance - length[:-1]):
+            return None
+        return newPosition, newSpeed, following
@@ -12,6 +12,7 @@ Intersection = n incoming roads, n outgoing roads
 Junctions have a handleVehicle method that is called when a vehicle reaches the junction.
 """
 import random
+from bisect import bisect_left
 
 class Coordinates:
     def __init__(self, x, y):
@@ -30,44 +31,82 @@ class Coordinates:
     def setY(self, y):
         self.y = y
 
+# Shape precomputes the cumulative length of its segments (the arc length at each coordinate) the first time it's used,
+# so the segment that contains a position is found with a binary search instead of measuring all the segments before it.
+# The index is rebuilt when a coordinate is added, coordinates changed in place require a call to indexSegments
 class Shape:
     def __init__(self, coordinates: list[Coordinates] = None):
         self.coordinates = coordinates if coordinates else []
+        self.arcLengths = None #arc length at each coordinate, the first is 0 and the last is the length of the shape
     
     def addCoordinate(self, coordinate):
         self.coordinates.append(coordinate)
+        self.arcLengths = None
     
     def getCoordinates(self):
         return self.coordinates
     
-    def calculateCoordinatesOnShape(self, position): #returns the coordinates of the shape at the given position
-        if len(self.coordinates) < 2:
-            return None
-        # for each couple of coordinates
-        # if the position exceeds the segment length I calculate the difference and go to next cycle
-        # otherwise I calculate the position of the point in the segment between the two points
+    def indexSegments(self):
+        arcLengths = [0]
         for i in range(1, len(self.coordinates)):
             x1 = self.coordinates[i-1].getX()
             y1 = self.coordinates[i-1].getY()
             x2 = self.coordinates[i].getX()
             y2 = self.coordinates[i].getY()
-            length = ((x2 - x1)**2 + (y2 - y1)**2)**0.5
-            if position <= length:
-                x = x1 + (x2 - x1) * position / length
-                y = y1 + (y2 - y1) * position / length
-                return Coordinates(x, y)
-            position -= length
-        return self.coordinates[-1]
+            arcLengths.append(arcLengths[-1] + ((x2 - x1)**2 + (y2 - y1)**2)**0.5)
+        self.arcLengths = arcLengths
+
+    def calculateCoordinatesOnShape(self, position): #returns the coordinates of the shape at the given position
+        if len(self.coordinates) < 2:
+            return None
+        if self.arcLengths is None:
+            self.indexSegments()
+        # the segment that contains the position is the first one that ends after it, positions before the start are on the first segment
+        i = bisect_left(self.arcLengths, position, 1)
+        if i == len(self.arcLengths):
+            return self.coordinates[-1]
+        start = self.coordinates[i-1]
+        end = self.coordinates[i]
+        length = self.arcLengths[i] - self.arcLengths[i-1]
+        if length == 0: #coincident coordinates
+            return Coordinates(start.getX(), start.getY())
+        position -= self.arcLengths[i-1]
+        x = start.getX() + (end.getX() - start.getX()) * position / length
+        y = start.getY() + (end.getY() - start.getY()) * position / length
+        return Coordinates(x, y)
+
+    def calculateCoordinatesOnShapeBatch(self, positions): #same as calculateCoordinatesOnShape for a list of positions, returns the lists of x and y
+        import numpy as np # numpy is only imported if the batch is used
+        if len(self.coordinates) < 2:
+            return None
+        if self.arcLengths is None:
+            self.indexSegments()
+        positions = np.asarray(positions, dtype=float)
+        arcLengths = np.array(self.arcLengths, dtype=float)
+        xs = np.array([coordinate.getX() for coordinate in self.coordinates], dtype=float)
+        ys = np.array([coordinate.getY() for coordinate in self.coordinates], dtype=float)
+        # same segment search and same operations of calculateCoordinatesOnShape, so the results are identical
+        i = np.maximum(np.searchsorted(arcLengths, positions, side="left"), 1)
+        afterEnd = i == len(arcLengths)
+        i = np.minimum(i, len(arcLengths) - 1)
+        length = arcLengths[i] - arcLengths[i-1]
+        offset = positions - arcLengths[i-1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = xs[i-1] + (xs[i] - xs[i-1]) * offset / length
+            y = ys[i-1] + (ys[i] - ys[i-1]) * offset / length
+        x = x.tolist()
+        y = y.tolist()
+        # the coincident and the after the end positions get the coordinates of the shape as they are, as calculateCoordinatesOnShape returns them (e.g. ints)
+        for k in np.flatnonzero(afterEnd | (length == 0)).tolist():
+            coordinate = self.coordinates[-1] if afterEnd[k] else self.coordinates[i[k]-1]
+            x[k] = coordinate.getX()
+            y[k] = coordinate.getY()
+        return x, y
 
     def calculateLength(self): #returns the length of the shape
-        length = 0
-        for i in range(1, len(self.coordinates)):
-            x1 = self.coordinates[i-1].getX()
-            y1 = self.coordinates[i-1].getY()
-            x2 = self.coordinates[i].getX()
-            y2 = self.coordinates[i].getY()
-            length += ((x2 - x1)**2 + (y2 - y1)**2)**0.5
-        return length
+        if self.arcLengths is None:
+            self.indexSegments()
+        return self.arcLengths[-1]
     
     @staticmethod
     def getShapeByCoordinates(coordinates):
@@ -76,15 +115,38 @@ class Shape:
             shape.addCoordinate(coordinate)
         return shape
 
+# Lane stores its vehicles in queue order: the first vehicle is the one ahead, the last one is the one that entered last.
+# Vehicles enter a lane from the back and don't overtake inside it, so the queue order is also the order by decreasing position.
+# Each vehicle has a slot number that gives its index in the list in O(1), so the preceding and following vehicles are found without scanning the lane.
+# Slots are absolute: removing the first vehicle (the common case, a vehicle leaving the road) only increases firstSlot
 class Lane:
     def __init__(self, vehicles = None):
         self.vehicles = vehicles if vehicles else []
+        self.slots = {} #vehicle -> slot, the index of the vehicle in the list is slot - firstSlot
+        self.firstSlot = 0
+        for i in range(len(self.vehicles)):
+            self.slots[self.vehicles[i]] = i
 
     def append(self, vehicle):
+        self.slots[vehicle] = self.firstSlot + len(self.vehicles)
         self.vehicles.append(vehicle)
                              
     def remove(self, vehicle):
-        self.vehicles.remove(vehicle)
+        index = self.slots.pop(vehicle) - self.firstSlot
+        if index == 0:
+            self.vehicles.pop(0)
+            self.firstSlot += 1
+            return
+        del self.vehicles[index]
+        for i in range(index, len(self.vehicles)): #the vehicles behind move forward of one slot
+            self.slots[self.vehicles[i]] -= 1
+
+    def hasVehicle(self, vehicle):
+        return vehicle in self.slots
+
+    def getIndex(self, vehicle): #returns the index of the vehicle in the lane, None if the vehicle is not in the lane
+        slot = self.slots.get(vehicle)
+        return slot - self.firstSlot if slot is not None else None
 
     def getVehicles(self):
         return self.vehicles
@@ -95,17 +157,40 @@ class Lane:
     def getVehicleCount(self):
         return len(self.vehicles)
 
+    def getFirstVehicle(self): #the vehicle ahead of all the others
+        return self.vehicles[0] if self.vehicles else None
+
+    def getLastVehicle(self): #the vehicle behind all the others
+        return self.vehicles[-1] if self.vehicles else None
+
+    def getPrecedingVehicle(self, vehicle): #the vehicle in front of the given one, None if it's the first one or it's not in the lane
+        index = self.getIndex(vehicle)
+        return self.vehicles[index - 1] if index is not None and index > 0 else None
+
+    def getFollowingVehicle(self, vehicle): #the vehicle behind the given one, None if it's the last one or it's not in the lane
+        index = self.getIndex(vehicle)
+        return self.vehicles[index + 1] if index is not None and index < len(self.vehicles) - 1 else None
+
+    def getNextVehicleAtPosition(self, position): #the closest vehicle ahead of the given position, found with a binary search on the positions
+        index = bisect_left(self.vehicles, -position, key=lambda vehicle: -vehicle.position)
+        return self.vehicles[index - 1] if index > 0 else None
+
 class Road:
     SAFETY_DISTANCE_TO_INTERSECTION = 10 #distance before the intersection where the vehicle is considered to be at the intersection and the next vehicle is not allowed to enter
     SAFETY_DISTANCE_AFTER_INTERSECTION = 5 #distance after the intersection where the vehicle is considered to have passed it and the next vehicle is allowed to enter
+    MIN_BATCH_PROJECTION = 16 #fewer positions are projected one by one by getCoordinatesByPositions, the numpy overhead is not worth it
     BRAKING_DISTANCE  = 20 #distance from stop/semaphore before the vehicle starts braking
     def __init__(self, id, length, vehicleDistance = 1, speedLimit = 50/3.6, semaphores = None, startJunction = None, endJunction = None, priority = 0, shape: Shape = None):
         self.id = id
         self.length = length
         self.lanes: list[Lane] = [Lane()]
+        self.vehicleLanes = {} #index of the vehicles on the road: vehicle -> index of the lane where it's stored, kept updated by appendVehicle and removeVehicle
+        self.kinematicsEngine = None #if set, it moves the vehicles instead of the loop in moveVehicles (see kinematics.VectorizedKinematicsEngine)
+        self.stateVersion = 0 #incremented every time the vehicles on the road may change, RoadHistory reuses the last state of the road if it didn't change
         self.vehicleDistance = vehicleDistance #distance between vehicles in meters
         self.speedLimit = speedLimit #speed limit in m/s
         self.semaphores = semaphores if semaphores else []  # list of semaphores on the road
+        self.semaphoreIndex = None #see indexSemaphores
         self.startJunction: Junction = startJunction
         self.endJunction: Junction = endJunction
         self.priority = priority
@@ -167,9 +252,11 @@ class Road:
 
     def addSemaphore(self, position, greenTime, redTime, yellowTime = 0, startTime = 0): #MUST add semaphores in order of position
         self.semaphores.append(Semaphore(greenTime, redTime, position, yellowTime, startTime))
+        self.semaphoreIndex = None
 
     def addSemaphore(self, semaphore): #MUST add semaphores in order of position
         self.semaphores.append(semaphore)
+        self.semaphoreIndex = None
 
     def setSemaphoreAtEnd(self, semaphore):
         self.removeSemaphoreAtEnd()
@@ -178,9 +265,11 @@ class Road:
     def addSemaphoreAtEnd(self, semaphore):
         self.semaphores.append(semaphore)
         semaphore.position = -1
+        self.semaphoreIndex = None
     
     def addSemaphoreAtEnd(self, greenTime, redTime, yellowTime = 0, startTime = 0):
         self.semaphores.append(Semaphore(greenTime, redTime, -1, yellowTime, startTime))
+        self.semaphoreIndex = None
 
     def addStartJunction(self, junction):
         self.startJunction = junction
@@ -246,8 +335,7 @@ class Road:
             vehicle.restart(self.speedLimit, timeStep)
             ExceedingDistance = vehicle.getPosition() - self.length
             self.endOfRoadHandler(vehicle, ExceedingDistance, currentTime, timeStep) #endOfRoadHandler will decide if the vehicle can go or has to keep waiting
-            vehicles = self.getAllVehicles()
-            if vehicle in vehicles and vehicle.isGivingWay():
+            if self.hasVehicle(vehicle) and vehicle.isGivingWay():
                 vehicle.setPosition(oldPosition) #if the vehicle has to keep waiting, I reset its position to the previous one
         vehicle.update(currentTime, self)
         return True
@@ -290,20 +378,17 @@ class Road:
 
 
     def getNextVehicleAtPosition(self, position, laneIndex):
-        vehicles = self.getVehiclesInLane(laneIndex)
-        if vehicles == None:
+        if laneIndex >= len(self.lanes):
             return None
-        nextVehicle = vehicles[0]
-        minPosition = nextVehicle.getPosition()
-        for vehicle in vehicles:
-            if vehicle.getPosition() > position and vehicle.getPosition() < minPosition:
-                nextVehicle = vehicle
-                minPosition = vehicle.getPosition()
-        return nextVehicle
+        return self.lanes[laneIndex].getNextVehicleAtPosition(position)
     
-    def getLastVehicle(self):
-        vehicles = self.getAllVehicles().sort(key=lambda vehicle: vehicle.position, reverse=False)
-        return vehicles[0] if vehicles else None
+    def getFirstVehicle(self): #returns the vehicle with the highest position on the road
+        firstVehicles = [lane.getFirstVehicle() for lane in self.lanes if lane.getVehicleCount() > 0]
+        return max(firstVehicles, key=lambda vehicle: vehicle.position) if firstVehicles else None
+
+    def getLastVehicle(self): #returns the vehicle with the lowest position on the road
+        lastVehicles = [lane.getLastVehicle() for lane in self.lanes if lane.getVehicleCount() > 0]
+        return min(lastVehicles, key=lambda vehicle: vehicle.position) if lastVehicles else None
 
     def hasOutgoingVehicles(self, timeStep = 1):
         vehicles = self.getAllVehicles()
@@ -317,9 +402,18 @@ class Road:
                     return True
         return False
     
+    def setKinematicsEngine(self, engine):
+        self.kinematicsEngine = engine
+
     def moveVehicles(self, time, timeStep = 1):
-        tmp = self.getAllVehicles()#.copy()
-        for vehicle in tmp:
+        vehicles = self.getAllVehicles()
+        if not vehicles:
+            return
+        self.stateVersion += 1
+        if self.kinematicsEngine is not None:
+            self.kinematicsEngine.moveVehicles(self, time, timeStep)
+            return
+        for vehicle in vehicles:
             self.moveVehicle(vehicle, time, timeStep)
 
     def waitForNextRoad(self, vehicle, posToWaitAt):
@@ -339,31 +433,19 @@ class Road:
         if vehicle.getSpeed() > self.speedLimit:
             vehicle.setSpeed(self.speedLimit)
 
-    def precedingVehicle(self, vehicle, laneIndex = 0): #I get the preceding vehicle of the current vehicle, Vehicles must be ordered by position
-        vehicles = self.getVehiclesInLane(laneIndex)
-        if vehicles is None or len(vehicles) <= 0: #no vehicles
+    def precedingVehicle(self, vehicle, laneIndex = 0): #I get the preceding vehicle of the current vehicle in the given lane
+        if laneIndex >= len(self.lanes):
             return None
-        if len(vehicles) == 1: #one vehicle
-            if vehicles[0] == vehicle:
-                return None
-            return vehicles[0]
-        for i in range(len(vehicles)):
-            if vehicles[i] == vehicle:
-                if i >= 1:
-                    return vehicles[i-1]
-                return None
-        #if there are more than 1 vehicles and the vehicle is not in the list, I return the first vehicle
-        return vehicles[-1]
-        return None
-
-    def followingVehicle(self, vehicle): #I get the following vehicle of the current vehicle, Vehicles must be ordered by position
-        vehicles = self.getAllVehicles()
-        for i in range(len(vehicles)):
-            if vehicles[i] == vehicle:
-                if i < len(vehicles) - 1:
-                    return vehicles[i+1]
-                return None
-        return None
+        lane = self.lanes[laneIndex]
+        if not lane.hasVehicle(vehicle): #if the vehicle is not in the lane (e.g. it's entering the road), I return the last vehicle of the lane
+            return lane.getLastVehicle()
+        return lane.getPrecedingVehicle(vehicle)
+
+    def followingVehicle(self, vehicle): #I get the following vehicle of the current vehicle
+        laneIndex = self.vehicleLanes.get(vehicle)
+        if laneIndex is None:
+            return None
+        return self.lanes[laneIndex].getFollowingVehicle(vehicle)
     
     def safetyPositionFrom(self, vehicle):
         return vehicle.position - self.vehicleDistance - vehicle.length
@@ -372,15 +454,15 @@ class Road:
         return vehicle.position + self.vehicleDistance + vehicle.length
 
     def removeVehicle(self, vehicle):
-        for i in range(len(self.lanes)):
-            if self.hasVehicleInLane(vehicle, i):
-                self.lanes[i].remove(vehicle)
-                return True
-        return False
+        laneIndex = self.vehicleLanes.pop(vehicle, None)
+        if laneIndex is None:
+            return False
+        self.lanes[laneIndex].remove(vehicle)
+        self.stateVersion += 1
+        return True
 
     def vehicleDensity(self):
-        vehicles = self.getAllVehicles()
-        return len(vehicles) / self.length
+        return len(self.vehicleLanes) / self.length
     
     def vehiclesAt(self, start, end):
         vehiclesAt = []
@@ -394,6 +476,14 @@ class Road:
         return self.getNextSemaphore(0)
 
     def getNextSemaphore(self, position):
+        if self.semaphoreIndex is None:
+            self.indexSemaphores()
+        positions, positionedSemaphores, endSemaphores = self.semaphoreIndex
+        if positions is not None and position >= 0: #binary search on the positions of the semaphores
+            i = bisect_left(positions, position)
+            if i < len(positions):
+                return positionedSemaphores[i]
+            return endSemaphores[-1] if endSemaphores else None
         sem = None
         for semaphore in self.semaphores: # If there are multiple semaphores, they must be ordered by position
             if semaphore.position >= position:
@@ -401,16 +491,27 @@ class Road:
             if semaphore.position == -1:
                 sem = semaphore
         return sem
+
+    # Index of the semaphores used by getNextSemaphore and getEndSemaphore: the positions of the semaphores inside the road, in order,
+    # and the semaphores at the end of the road. If the semaphores were not added in order of position the positions are None and the list is scanned.
+    # It's rebuilt after the semaphores of the road are changed
+    def indexSemaphores(self):
+        positionedSemaphores = [semaphore for semaphore in self.semaphores if semaphore.position != -1]
+        endSemaphores = [semaphore for semaphore in self.semaphores if semaphore.position == -1]
+        positions = [semaphore.position for semaphore in positionedSemaphores]
+        if any(positions[i] > positions[i + 1] for i in range(len(positions) - 1)):
+            positions = None
+        self.semaphoreIndex = (positions, positionedSemaphores, endSemaphores)
     
     def getSemaphorePosition(self, semaphore):
         if semaphore in self.semaphores:
             return semaphore.position if semaphore.position != -1 else self.length #if the semaphore is at the end of the road, I return the length of the road
     
     def getEndSemaphore(self):
-        for semaphore in self.semaphores:
-            if semaphore.position == -1:
-                return semaphore
-        return None
+        if self.semaphoreIndex is None:
+            self.indexSemaphores()
+        endSemaphores = self.semaphoreIndex[2]
+        return endSemaphores[0] if endSemaphores else None
         
     def isGreen(self, currentTime):
         endSemaphore = self.getEndSemaphore()
@@ -420,12 +521,14 @@ class Road:
         
     def removeSemaphore(self, semaphore):
         self.semaphores.remove(semaphore)
+        self.semaphoreIndex = None
     
     def removeSemaphoreAtEnd(self):
         semaphores = self.semaphores
         for semaphore in semaphores:
             if semaphore.position == -1:
                 self.semaphores.remove(semaphore)
+                self.semaphoreIndex = None
                 return semaphore
         
     def getPriority(self):
@@ -438,23 +541,22 @@ class Road:
         vehicle.setPosition(0)
 
     def hasVehicleInLane(self, vehicle, laneIndex):
-        if (vehicles := self.getVehiclesInLane(laneIndex)) is None:
-            return False
-        return vehicle.getLane() == laneIndex and vehicle in vehicles
+        return self.vehicleLanes.get(vehicle) == laneIndex
     
     def hasVehicle(self, vehicle):
-        vehicles = self.getAllVehicles()
-        for v in vehicles:
-            if v == vehicle:
-                return True
-        return False
+        return vehicle in self.vehicleLanes
+
+    def getVehicleCount(self):
+        return len(self.vehicleLanes)
     
     def getVehiclesInLane(self, laneIndex):
         if laneIndex >= len(self.lanes):
             return None
         return self.lanes[laneIndex].getVehicles()
     
-    def getAllVehicles(self):
+    def getAllVehicles(self): #returns a new list, so the caller can add or remove vehicles from the road while iterating it
+        if len(self.lanes) == 1:
+            return list(self.lanes[0].getVehicles())
         allVehicles = []
         for index in range(len(self.lanes)):
             allVehicles += self.lanes[index].getVehicles()
@@ -462,12 +564,26 @@ class Road:
     
     def appendVehicle(self, vehicle, laneIndex = 0):
         self.lanes[laneIndex].append(vehicle)
+        self.vehicleLanes[vehicle] = laneIndex
+        self.stateVersion += 1
 
     def getLaneWhereVehicleIs(self, vehicle):
         return vehicle.getLane()
     
     def getCoordinatesByPosition(self, position):
         return self.Shape.calculateCoordinatesOnShape(position)
+
+    def getCoordinatesByPositions(self, positions): #lists of x and y of the given positions, None if the road has no shape
+        if len(positions) >= self.MIN_BATCH_PROJECTION:
+            try:
+                coords = self.Shape.calculateCoordinatesOnShapeBatch(positions)
+                return coords
+            except ImportError: #numpy is optional, the positions are projected one by one
+                pass
+        coords = [self.Shape.calculateCoordinatesOnShape(position) for position in positions]
+        if coords and coords[0] is None:
+            return None
+        return [coord.getX() for coord in coords], [coord.getY() for coord in coords]
     
 class Semaphore:
     STATE_GREEN = "green"
@@ -479,7 +595,19 @@ class Semaphore:
         self.position = position #position of the semaphore on the road, -1 = end of the road, 0 = start of the road
         self.yellowTime = yellowTime
         self.startTime = startTime
+        self.compilePhases()
+
+    # Precomputes the phases of the cycle: the ends of the green, yellow and red phases and, if the times are integers, the state of every second
+    # of the cycle, so getState is a single lookup. The state of the last queried time is cached, since it's asked several times per vehicle per cycle.
+    # Must be called again if the times of the semaphore are changed
+    def compilePhases(self):
         self.totalCycleTime = self.greenTime + self.redTime + self.yellowTime
+        self.phaseEnds = (self.greenTime, self.greenTime + self.yellowTime, self.totalCycleTime)
+        self.phaseTable = None
+        if all(type(time) is int and time >= 0 for time in (self.greenTime, self.yellowTime, self.redTime)):
+            self.phaseTable = [self.STATE_GREEN] * self.greenTime + [self.STATE_YELLOW] * self.yellowTime + [self.STATE_RED] * self.redTime
+        self.lastQueryTime = None
+        self.lastQueryState = None
 
     @staticmethod
     def createOppositeSemaphore(sem): #this function is used to create a semaphore for an X intersection
@@ -493,16 +621,32 @@ class Semaphore:
         return Semaphore(newGreen, newRed, sem.position, newYellow, sem.startTime)
 
     def getState(self, currentTime):
+        if currentTime == self.lastQueryTime:
+            return self.lastQueryState
         if currentTime >= self.startTime:
             timeInCycle = (currentTime - self.startTime) % self.totalCycleTime
-            if timeInCycle < self.greenTime:
-                return self.STATE_GREEN
-            elif timeInCycle < self.greenTime + self.yellowTime:
-                return self.STATE_YELLOW
+            if self.phaseTable is not None and type(timeInCycle) is int:
+                state = self.phaseTable[timeInCycle]
+            elif timeInCycle < self.phaseEnds[0]:
+                state = self.STATE_GREEN
+            elif timeInCycle < self.phaseEnds[1]:
+                state = self.STATE_YELLOW
             else:
-                return self.STATE_RED
-        return self.STATE_RED
-    
+                state = self.STATE_RED
+        else:
+            state = self.STATE_RED
+        self.lastQueryTime = currentTime
+        self.lastQueryState = state
+        return state
+    
+    def getNextChangeTime(self, currentTime): #first time after currentTime at which the state of the semaphore can change
+        if currentTime < self.startTime:
+            return self.startTime
+        timeInCycle = (currentTime - self.startTime) % self.totalCycleTime
+        for phaseEnd in self.phaseEnds:
+            if phaseEnd > timeInCycle:
+                return currentTime - timeInCycle + phaseEnd
+
     def isGreen(self, currentTime):
         return self.getState(currentTime) == self.STATE_GREEN
     
@@ -520,6 +664,12 @@ class Junction:
     def handleVehicle(self, vehicle, position, currentTime, timeStep = 1):
         pass
 
+    def getIncomingRoads(self): #roads that end in the junction
+        return []
+
+    def getOutgoingRoads(self): #roads that start from the junction
+        return []
+
 class Bifurcation(Junction):
     # Deprecated: use Intersection instead
     def __init__(self, id, incomingRoad, outgoingRoad1, outgoingRoad2, flux1):
@@ -535,8 +685,14 @@ class Bifurcation(Junction):
         if outgoingRoad2 != None:
             outgoingRoad2.addStartJunction(self)
 
+    def getIncomingRoads(self):
+        return [road for road in [self.incomingRoad] if road is not None]
+
+    def getOutgoingRoads(self):
+        return [road for road in [self.outgoingRoad1, self.outgoingRoad2] if road is not None]
+
     def handleVehicle(self, vehicle, position, currentTime, timeStep = 1):
-        if vehicle in self.incomingRoad.vehicles:
+        if self.incomingRoad.hasVehicle(vehicle):
             nextRoad = self.outgoingRoad1 if random.uniform(0,1) < self.flux1 else self.outgoingRoad2
             pos = nextRoad.tryAddVehicle(vehicle, currentTime, position)
             if pos < 0: #if the vehicle cannot be added to the next road
@@ -567,6 +723,12 @@ class NFurcation(Junction): #1 incoming road, n outgoing roads
         self.incomingRoad = road
         road.addEndJunction(self)
 
+    def getIncomingRoads(self):
+        return [self.incomingRoad] if self.incomingRoad is not None else []
+
+    def getOutgoingRoads(self):
+        return list(self.outgoingRoads) if self.outgoingRoads is not None else []
+
     def getNextRoad(self):
         randomValue = random.uniform(0,1)
         chosenRoad = 0
@@ -613,9 +775,15 @@ class Merge(Junction): #2 incoming roads, 1 outgoing road
             return self.incomingRoad1
         return self.incomingRoad2
 
+    def getIncomingRoads(self):
+        return [road for road in [self.incomingRoad1, self.incomingRoad2] if road is not None]
+
+    def getOutgoingRoads(self):
+        return [self.outgoingRoad] if self.outgoingRoad is not None else []
+
     def handleVehicle(self, vehicle, position, currentTime, timeStep = 1):
-        if self.incomingRoad1.hasVehicle(vehicle) or self.incomingRoad2.hasVehicle(vehicle):
-            fromRoad = self.incomingRoad1 if self.incomingRoad1.hasVehicle(vehicle) else self.incomingRoad2 #I get the road from which the vehicle comes
+        fromRoad = self.incomingRoad1 if self.incomingRoad1.hasVehicle(vehicle) else self.incomingRoad2 if self.incomingRoad2.hasVehicle(vehicle) else None #I get the road from which the vehicle comes
+        if fromRoad is not None:
 
             if fromRoad == self.priorityRoad or not self.priorityRoad.hasOutgoingVehicles(timeStep): #if the vehicle comes from the priority road or the priority road is free
                 pos = self.outgoingRoad.tryAddVehicle(vehicle, currentTime, position)
@@ -649,7 +817,13 @@ class Intersection(Junction): #n incoming roads, n outgoing roads
         self.outgoingRoadsFluxes.append(flux)
         road.addStartJunction(self)
 
-    def incomingRoad(self, vehicle):
+    def getIncomingRoads(self):
+        return list(self.incomingRoads) if self.incomingRoads is not None else []
+
+    def getOutgoingRoads(self):
+        return list(self.outgoingRoads) if self.outgoingRoads is not None else []
+
+    def incomingRoad(self, vehicle): #hasVehicle is O(1), so this only costs one lookup per incoming road
         for road in self.incomingRoads:
             if road.hasVehicle(vehicle):
                 return road
@@ -689,11 +863,8 @@ class Intersection(Junction): #n incoming roads, n outgoing roads
         for r in self.incomingRoads:
             if r.getPriority() < road.getPriority() and r.isGreen(currentTime) and r.hasOutgoingVehicles():
                 return False
-        #ritorno False anche se nella road dove deve immettersi il veicolo ci sono veicoli all'inizio della strada
-        lastVehInNextRoad = road.getLastVehicle()
-        safePos = road.safetyPositionFrom(lastVehInNextRoad) - Road.SAFETY_DISTANCE_AFTER_INTERSECTION if lastVehInNextRoad is not None else 1000000
-        if position > safePos:
-            return False
+        #the check of the vehicles at the start of the next road is not done here: it read road.getLastVehicle(), that always returned None,
+        #so it never stopped a vehicle, and tryAddVehicle already refuses a vehicle that doesn't fit in the next road
         return True
     
     def outgoingRoadsOrderedByPriority(self):
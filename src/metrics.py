@@ -0,0 +1,155 @@
+"""
+@file    metrics.py
+@authors  David Megli
+
+Description:
+This file contains the online aggregation of the vehicles metrics (see Vehicle.getVehiclesMetrics), used by Simulation.getMetrics.
+The metrics of each vehicle are added once, when the vehicle retires (see Simulation.retireVehicles), to running statistics:
+the minimum, the maximum and the mean are exact, the median is exact while the values take few distinct values (it counts the occurrences of each value)
+and is estimated with the P² algorithm (Jain and Chlamtac, 1985), that keeps five markers instead of all the values, otherwise. So the report at the end of the run doesn't depend on the number of vehicles,
+and a snapshot taken while the simulation runs only adds the vehicles still on the network to copies of the statistics.
+"""
+import copy
+from bisect import bisect_right, insort
+from statistics import median
+
+# P2Quantile estimates a quantile of a stream of values in constant memory.
+# The five markers are the minimum, the maximum, the quantile and two quantiles half way; when a value arrives the positions of the markers are updated
+# and the heights of the inner markers are moved with a piecewise parabolic interpolation. With five values or less the quantile is exact
+class P2Quantile:
+    def __init__(self, quantile = 0.5):
+        self.quantile = quantile
+        self.heights = [] #heights of the markers, the first five values sorted until the markers are initialized
+        self.positions = [1, 2, 3, 4, 5]
+        self.desiredPositions = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        heights = self.heights
+        if self.count <= 5:
+            insort(heights, value)
+            return
+        positions = self.positions
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect_right(heights, value, 1, 4) - 1 #heights[cell] <= value < heights[cell + 1]
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desiredPositions[i] += self.increments[i]
+        for i in range(1, 4):
+            delta = self.desiredPositions[i] - positions[i]
+            if (delta >= 1 and positions[i + 1] - positions[i] > 1) or (delta <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if delta > 0 else -1
+                height = self.parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def parabolic(self, i, step):
+        q = self.heights
+        n = self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def getValue(self): #None if no value was added
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            if self.quantile == 0.5:
+                return median(self.heights)
+            rank = self.quantile * (self.count - 1) #linear interpolation between the closest ranks
+            low = int(rank)
+            high = min(low + 1, self.count - 1)
+            return self.heights[low] + (rank - low) * (self.heights[high] - self.heights[low])
+        return self.heights[2]
+
+# RunningStatistic keeps count, sum, minimum, maximum and the median of a stream of values.
+# The median is exact while the values take few distinct values (e.g. times in whole cycles, number of stops), counting the occurrences of each value,
+# then it's the estimate of P2Quantile, which is updated from the first value
+class RunningStatistic:
+    MAX_DISTINCT_VALUES = 1024 #over this number of distinct values the occurrences are no longer counted
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.medianEstimator = P2Quantile(0.5)
+        self.valueCounts = {} #value -> occurrences, None if there are too many distinct values
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        self.medianEstimator.add(value)
+        if self.valueCounts is not None:
+            self.valueCounts[value] = self.valueCounts.get(value, 0) + 1
+            if len(self.valueCounts) > RunningStatistic.MAX_DISTINCT_VALUES:
+                self.valueCounts = None
+
+    def getMedian(self): #same result of statistics.median while the values are counted
+        if self.valueCounts is None:
+            return self.medianEstimator.getValue()
+        lowIndex = (self.count - 1) // 2 #the two middle values, the same one if count is odd
+        highIndex = self.count // 2
+        low = None
+        seen = 0
+        for value in sorted(self.valueCounts):
+            seen += self.valueCounts[value]
+            if low is None and seen > lowIndex:
+                low = value
+            if seen > highIndex:
+                return low if lowIndex == highIndex else (low + value) / 2
+
+    def getSummary(self): #(min, max, median, average), all 0 if no value was added, as in Vehicle.getVehiclesMetrics
+        if self.count == 0:
+            return (0, 0, 0, 0)
+        return (self.minimum, self.maximum, self.getMedian(), self.total / self.count)
+
+# VehicleMetricsAccumulator aggregates the metrics of the retired vehicles, getMetrics returns the same tuple of Vehicle.getVehiclesMetrics.
+# As in Vehicle.getVehiclesMetrics, travel time, time waited and departure delay are of the arrived vehicles only,
+# the stops and the average speed and acceleration are of all the vehicles, so the vehicles still on the network are added to a copy of the statistics
+class VehicleMetricsAccumulator:
+    def __init__(self):
+        self.travelTime = RunningStatistic()
+        self.stops = RunningStatistic()
+        self.timeWaited = RunningStatistic()
+        self.departDelay = RunningStatistic()
+        self.speedSum = 0.0 #sum of the average speeds of the vehicles
+        self.accelerationSum = 0.0
+        self.vehicleCount = 0
+        self.arrivedCount = 0
+
+    def addVehicle(self, vehicle): #the vehicle must not change anymore, e.g. it arrived or the simulation ended
+        if vehicle.isArrived():
+            self.travelTime.add(vehicle.getTravelTime())
+            self.timeWaited.add(vehicle.timeWaited)
+            self.departDelay.add(vehicle.departDelay)
+            self.arrivedCount += 1
+        self.stops.add(vehicle.getNumberOfStops())
+        historyMetrics = vehicle.getVehicleStateHistoryMetrics()
+        self.speedSum += historyMetrics[0]
+        self.accelerationSum += historyMetrics[1]
+        self.vehicleCount += 1
+
+    def addVehicles(self, vehicles):
+        for vehicle in vehicles:
+            self.addVehicle(vehicle)
+
+    def getMetrics(self, activeVehicles = None): #the aggregated vehicles plus the given vehicles still on the network
+        if activeVehicles:
+            snapshot = copy.deepcopy(self)
+            snapshot.addVehicles(activeVehicles)
+            return snapshot.getMetrics()
+        vehicleCount = self.vehicleCount if self.vehicleCount > 0 else 1
+        return self.travelTime.getSummary() + self.stops.getSummary() + self.timeWaited.getSummary() + self.departDelay.getSummary() + (self.speedSum / vehicleCount, self.accelerationSum / vehicleCount, self.arrivedCount)
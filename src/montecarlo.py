@@ -0,0 +1,126 @@
+"""
+@file    montecarlo.py
+@authors  David Megli
+
+Description:
+This file runs many replications of the same simulation with different seeds, in parallel, and merges their metrics.
+The model is stochastic (the speed noise of the vehicles, the choice of the outgoing road in the intersections and the departures from the starting roads),
+so a single run is one sample of the metrics: each replication seeds the random generator with its own seed, so any replication can be repeated alone.
+The replications run in a process pool, the metrics of each replication are streamed back as soon as it ends and saved one per line (NDJSON),
+then the metrics of Vehicle.getVehiclesMetricsAsJSON and MapHistory.getMetrics are merged in mean, standard deviation and confidence interval.
+Usage: python montecarlo.py simulation.json replications [workers] [firstSeed] [confidence]
+"""
+import contextlib
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from statistics import NormalDist, mean, stdev
+from simulate import Simulation
+
+SEED_STRING = "seed"
+METRICS_STRING = "metrics"
+FIELD_SEPARATOR = "."
+
+# Runs a single replication in the worker process and returns its seed and metrics. The simulation prints are discarded
+def runReplication(filename, seed):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        simulation = Simulation.getSimulationFromJSON(filename)
+        if simulation is None:
+            raise ValueError("Invalid simulation file: %s" % filename)
+        simulation.seed = seed
+        simulation.saveOutput = False
+        simulation.log = False #the parallel runs would write the same log file
+        simulation.simulate()
+    return {SEED_STRING: seed, METRICS_STRING: simulation.getMetrics()}
+
+# Flattens the metrics of a replication in a dictionary field name -> value, e.g. "vehicles.Duration.average" or "roads.2.averageDensity"
+def flattenMetrics(metrics, prefix = ""):
+    fields = {}
+    if isinstance(metrics, dict):
+        items = metrics.items()
+    else: #list of road metrics, each identified by its road id
+        items = [(roadMetrics["road"], roadMetrics) for roadMetrics in metrics]
+    for key, value in items:
+        name = "%s%s" % (prefix, key)
+        if isinstance(value, (dict, list)):
+            fields.update(flattenMetrics(value, name + FIELD_SEPARATOR))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and key != "road":
+            fields[name] = value
+    return fields
+
+# Runs the replications in a process pool and yields the result of each replication as soon as it ends (not in the order of the seeds)
+def runReplications(filename, seeds, workers = None):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(runReplication, filename, seed) for seed in seeds]
+        for future in as_completed(futures):
+            yield future.result()
+
+# MonteCarloSummary merges the metrics of the replications: for each field it keeps the values and returns mean, standard deviation
+# and the confidence interval of the mean (normal approximation, good for the tens or hundreds of replications of a calibration)
+class MonteCarloSummary:
+    def __init__(self, confidence = 0.95):
+        self.confidence = confidence
+        self.values = {} #field name -> values of the replications
+        self.seeds = []
+
+    def addReplication(self, result):
+        self.seeds.append(result[SEED_STRING])
+        for name, value in flattenMetrics(result[METRICS_STRING]).items():
+            self.values.setdefault(name, []).append(value)
+
+    def getConfidenceInterval(self, values):
+        average = mean(values)
+        deviation = stdev(values) if len(values) > 1 else 0.0
+        halfWidth = NormalDist().inv_cdf((1 + self.confidence) / 2) * deviation / math.sqrt(len(values))
+        return {"mean": average, "std": deviation, "low": average - halfWidth, "high": average + halfWidth, "samples": len(values)}
+
+    def getSummary(self):
+        return {
+            "replications": len(self.seeds),
+            "confidence": self.confidence,
+            "seeds": sorted(self.seeds),
+            METRICS_STRING: {name: self.getConfidenceInterval(values) for name, values in self.values.items()}
+        }
+
+    def saveSummary(self, filename):
+        with open(filename, "w+") as f:
+            json.dump(self.getSummary(), f, indent = 4)
+
+# Runs the replications of the given simulation file, saving the metrics of each replication while they arrive and the summary at the end
+def runMonteCarlo(filename, replications, workers = None, firstSeed = 0, confidence = 0.95):
+    simulation = Simulation.getSimulationFromJSON(filename) #validates the file once before starting the workers
+    if simulation is None:
+        return None
+    os.makedirs("../output", exist_ok=True)
+    replicationsFile = "../output/%s_montecarlo_replications_%i.ndjson" % (simulation.simulationName, replications)
+    summaryFile = "../output/%s_montecarlo_summary_%i.json" % (simulation.simulationName, replications)
+    summary = MonteCarloSummary(confidence)
+    with open(replicationsFile, "w+") as f:
+        for result in runReplications(filename, range(firstSeed, firstSeed + replications), workers):
+            summary.addReplication(result)
+            f.write(json.dumps(result))
+            f.write("\n")
+            f.flush()
+            print("Replication %d/%d (seed %d)" % (len(summary.seeds), replications, result[SEED_STRING]), end="\r")
+    summary.saveSummary(summaryFile)
+    print()
+    print("Data saved to %s" % os.path.abspath(summaryFile))
+    return summary
+
+def main(argv):
+    if len(argv) < 2:
+        print("Usage: python montecarlo.py simulation.json replications [workers] [firstSeed] [confidence]")
+        return
+    workers = int(argv[2]) if len(argv) > 2 else None
+    firstSeed = int(argv[3]) if len(argv) > 3 else 0
+    confidence = float(argv[4]) if len(argv) > 4 else 0.95
+    try:
+        runMonteCarlo(argv[0], int(argv[1]), workers, firstSeed, confidence)
+    except Exception as e:
+        print("Error:", e)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
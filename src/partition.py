@@ -0,0 +1,368 @@
+"""
+@file    partition.py
+@authors  David Megli
+
+Description:
+This file contains the partitioned execution mode, that splits the roads of the simulation in regions and moves each region in its own process.
+Roads interact only through the junctions at their ends, so the regions are cut at the junctions: the incoming roads of a junction are always in the same region,
+that owns the junction, while its outgoing roads can be in other regions.
+Every region process builds the whole network, but it only moves its own roads. The outgoing roads of its junctions that belong to other regions are "ghost" roads:
+at the start of every tick they are filled with stubs, copies of the last vehicles of each lane sent by the owner region at the end of the previous tick,
+so the junctions decide if a vehicle can enter with the same code used in the serial mode. The vehicles that enter a ghost road are removed at the end of the tick
+and sent to the owner region through the per-tick message buffer kept by the coordinator, which adds them to the road, in the order they entered, at the start of the next tick.
+The states saved by the vehicles of a region in a tick are sent back with the tick reply and the coordinator writes the time bucket of the tick, as the serial mode does,
+and the arrived vehicles are retired by their region, so neither the regions nor the coordinator keep the states of the whole run.
+The result only depends on the seed and on the number of regions: each region has its own random generator seeded with the seed and its index,
+and the vehicles ids are given as in the serial mode, so the processes scheduling doesn't change the outcome.
+The results differ from the serial mode at the junctions between regions. The serial mode moves the roads downstream first, so a vehicle at a junction
+sees the next road already moved in the tick, while the ghost road shows it as it was at the end of the previous tick: the vehicles are admitted later
+and the queues before the boundary junctions grow. The admission can't be made exact without waiting, in every tick, for the regions downstream,
+that would run the regions one after the other. Without queues at the boundaries (e.g. simulate_tests.bifurcation_sem) the metrics are the same
+or nearly the same of the serial mode; with queues the deviation is large. In bifurcation_sem_high_flow (1 to 3 copies, 2 and 3 regions, seeds 7 and 11)
+the partitioned runs gave, from the serial run: duration +8% to +13%, time waited +30% to +52%, stops +19% to +33%, average speed -12% to -23%,
+arrived vehicles -5% to -13%. checkDeviation runs a scenario in both modes and checks that the deviation stays within DEVIATION_TOLERANCES.
+Usage: python partition.py scenario regions [seed] [copies]
+The scenario is a JSON file or the name of a scenario of simulate_tests.py (built with the given number of copies of the network).
+"""
+import contextlib
+import copy
+import json
+import multiprocessing
+import os
+import random
+import sys
+from collections import deque
+from data import MapHistory, VehicleHistoryWriter
+from montecarlo import flattenMetrics
+from simulate import Simulation
+from vehicle import VehicleStateHistory
+import simulate_tests
+
+TICK = "tick"
+FINISH = "finish"
+DEVIATION_SEED = 7
+# Largest relative deviation of the vehicle metrics of a partitioned run from the serial run accepted by checkDeviation,
+# the largest deviations measured in bifurcation_sem_high_flow (see above) with some margin
+DEVIATION_TOLERANCES = {
+    "vehicles.ArrivedVehicles": 0.2,
+    "vehicles.Duration.average": 0.2,
+    "vehicles.TimeWaited.average": 0.75,
+    "vehicles.Stops.average": 0.5,
+    "vehicles.AverageSpeed": 0.3
+}
+
+# Groups the roads in units that can't be split: the roads that end in the same junction, since the junction reads all of them to decide who can go
+def getRoadUnits(roads):
+    units = []
+    unitOf = {} #road id -> index of its unit
+    for road in roads:
+        if road.id in unitOf:
+            continue
+        members = road.endJunction.getIncomingRoads() if road.endJunction is not None else []
+        unit = [road] + [r for r in members if r is not road and r.id not in unitOf]
+        for r in unit:
+            unitOf[r.id] = len(units)
+        units.append(unit)
+    return units, unitOf
+
+# Splits the roads in at most regionCount regions of similar size (length * lanes) and returns the ids of the roads of each region.
+# The units are visited from the starting roads downstream (breadth first) and cut in consecutive groups, so the roads of a region are close to each other
+def partitionRoads(roads, startingRoads, regionCount):
+    units, unitOf = getRoadUnits(roads)
+    order = []
+    visited = set()
+    queue = deque([unitOf[road.id] for road in startingRoads] + list(range(len(units))))
+    while queue:
+        unit = queue.popleft()
+        if unit in visited:
+            continue
+        visited.add(unit)
+        order.append(unit)
+        for road in units[unit]:
+            if road.endJunction is not None:
+                queue.extend(unitOf[nextRoad.id] for nextRoad in road.endJunction.getOutgoingRoads())
+    weights = [sum(road.length * road.getNumberOfLanes() for road in units[unit]) for unit in order]
+    regionCount = max(1, min(regionCount, len(units)))
+    target = sum(weights) / regionCount
+    regions = [[]]
+    weight = 0
+    for i, unit in enumerate(order):
+        remainingUnits = len(order) - i
+        emptyRegions = regionCount - len(regions)
+        if regions[-1] and emptyRegions > 0 and (weight >= target * len(regions) or remainingUnits <= emptyRegions):
+            regions.append([])
+        regions[-1] += [road.id for road in units[unit]]
+        weight += weights[i]
+    return regions
+
+# RegionStates collects the states saved by the vehicles of a region in a tick, that are sent to the coordinator with the tick reply.
+# It takes the place of the history writer of the vehicles, the roads are sent as ids
+class RegionStates:
+    def __init__(self):
+        self.states = []
+
+    def recordState(self, vehicle, index):
+        time, position, speed, acceleration, state, road = vehicle.stateHistory.getRow(index)
+        self.states.append((vehicle.id, time, position, speed, acceleration, state, road.id if road is not None else None))
+
+    def takeStates(self): #returns the states of the tick and clears them
+        states = self.states
+        self.states = []
+        return states
+
+# Region moves the roads of a region in the worker process
+class Region:
+    def __init__(self, simulation, index, roadIds, ghostRoadIds, boundaryRoadIds):
+        self.simulation = simulation
+        self.index = index
+        self.roadsById = {road.id: road for road in simulation.roads}
+        self.roads = sorted([self.roadsById[roadId] for roadId in roadIds], key=lambda road: road.id, reverse=True) #same order of Simulation.moveVehicles
+        self.ghostRoads = [self.roadsById[roadId] for roadId in ghostRoadIds] #outgoing roads of the junctions of the region that belong to other regions
+        self.boundaryRoads = [self.roadsById[roadId] for roadId in boundaryRoadIds] #roads of the region that are ghost roads of other regions
+        ownedRoads = set(roadIds)
+        self.startingRoads = [(roadIndex, road) for roadIndex, road in enumerate(simulation.startingRoads) if road.id in ownedRoads]
+        self.vehicles = {} #vehicle id -> vehicle, the vehicles in the roads of the region
+        self.retired = [] #vehicles that left the network from the roads of the region, retired as in the serial mode
+        self.stubs = set() #stubs currently in the ghost roads
+        self.pendingStubs = {road.id: [] for road in self.ghostRoads} #stubs of the vehicles sent to the other regions in the last tick, not yet in their snapshots
+        self.history = MapHistory(self.roads[::-1], simulation.sectorLength, simulation.historySampleInterval, simulation.historyWindow if simulation.saveOutput else 1)
+        self.states = RegionStates() if simulation.saveOutput else None
+        simulation.historyWriter = self.states #the new vehicles record their states in it (see Simulation.createVehicle)
+        simulation.setupKinematicsEngine()
+        if simulation.seed is not None:
+            random.seed("%d-%d" % (simulation.seed, index))
+        else:
+            random.seed()
+
+    def createStub(self, vehicle): #copy of the vehicle without its history, used to fill the ghost roads
+        stub = copy.copy(vehicle)
+        stub.stateHistory = VehicleStateHistory()
+        stub.historyWriter = None
+        return stub
+
+    def getSnapshots(self): #the last vehicle of each lane of the boundary roads, read by the junctions of the other regions
+        snapshots = {}
+        for road in self.boundaryRoads:
+            snapshots[road.id] = [(laneIndex, self.createStub(lane.getLastVehicle())) for laneIndex, lane in enumerate(road.lanes) if lane.getVehicleCount() > 0]
+        return snapshots
+
+    def refreshGhostRoads(self, snapshots):
+        for road in self.ghostRoads:
+            for vehicle in road.getAllVehicles():
+                road.removeVehicle(vehicle)
+        self.stubs = set()
+        for road in self.ghostRoads:
+            for laneIndex, stub in snapshots.get(road.id, []) + self.pendingStubs[road.id]:
+                road.appendVehicle(stub, laneIndex)
+                self.stubs.add(stub)
+
+    def addArrivals(self, arrivals): #vehicles that entered the roads of the region from other regions in the last tick
+        for roadId, laneIndex, vehicle in arrivals:
+            vehicle.stateHistory.relinkRoads(self.roadsById)
+            vehicle.setHistoryWriter(self.states)
+            self.roadsById[roadId].appendVehicle(vehicle, laneIndex)
+            self.vehicles[vehicle.id] = vehicle
+
+    def injectVehicles(self, time, cycle): #same vehicles and ids of Simulation.injectVehicles, only in the starting roads of the region
+        simulation = self.simulation
+        if cycle % simulation.vehicleInjectionRate != 0:
+            return
+        startingRoadCount = len(simulation.startingRoads)
+        firstId = (cycle // simulation.vehicleInjectionRate) * len(simulation.vehicleTypes) * startingRoadCount
+        for typeIndex, vehicleType in enumerate(simulation.vehicleTypes):
+            for roadIndex, road in self.startingRoads:
+                vehicle = simulation.createVehicle(vehicleType, firstId + typeIndex * startingRoadCount + roadIndex, time)
+                road.addVehicle(vehicle, time)
+                self.vehicles[vehicle.id] = vehicle
+
+    def collectMigrants(self): #removes from the ghost roads the vehicles that entered them in this tick
+        migrants = []
+        for road in self.ghostRoads:
+            self.pendingStubs[road.id] = []
+            for laneIndex, lane in enumerate(road.lanes):
+                for vehicle in list(lane.getVehicles()):
+                    if vehicle in self.stubs:
+                        continue
+                    road.removeVehicle(vehicle)
+                    del self.vehicles[vehicle.id]
+                    vehicle.setHistoryWriter(None) #the owner region gives it its own
+                    self.pendingStubs[road.id].append((laneIndex, self.createStub(vehicle)))
+                    migrants.append((road.id, laneIndex, vehicle))
+        return migrants
+
+    def retireVehicles(self): #same as Simulation.retireVehicles, the arrived vehicles keep only their metrics
+        arrived = [vehicle for vehicle in self.vehicles.values() if vehicle.isArrived()]
+        for vehicle in arrived:
+            del self.vehicles[vehicle.id]
+            self.retired.append(vehicle.retire() if self.simulation.retireArrived else vehicle)
+
+    def tick(self, time, cycle, arrivals, snapshots):
+        self.refreshGhostRoads(snapshots)
+        self.addArrivals(arrivals)
+        self.injectVehicles(time, cycle)
+        for road in self.roads:
+            road.moveVehicles(time, self.simulation.timeStep)
+        self.history.saveState(time)
+        self.retireVehicles()
+        states = self.states.takeStates() if self.states is not None else []
+        return self.collectMigrants(), self.getSnapshots(), states
+
+    def getResults(self):
+        historyDicts = [roadHistory.getHistoryDict() for roadHistory in self.history.roadHistories] if self.simulation.saveOutput else []
+        return list(self.vehicles.values()) + self.retired, self.history.getMetrics()["metrics"], historyDicts
+
+# Main function of the region processes: runs a tick for every message of the coordinator and sends back the migrants, the snapshots and the states of the tick
+def runRegion(simulation, index, roadIds, ghostRoadIds, boundaryRoadIds, connection):
+    region = Region(simulation, index, roadIds, ghostRoadIds, boundaryRoadIds)
+    while True:
+        message = connection.recv()
+        if message[0] == FINISH:
+            connection.send(region.getResults())
+            break
+        _, time, cycle, arrivals, snapshots = message
+        connection.send(region.tick(time, cycle, arrivals, snapshots))
+    connection.close()
+
+# RegionsHistory merges the road histories of the regions, it has the methods of MapHistory used after the simulation
+class RegionsHistory:
+    def __init__(self, metrics, historyDicts):
+        self.metrics = metrics
+        self.historyDicts = historyDicts
+
+    def getMetrics(self):
+        return {"metrics": self.metrics}
+
+    def getHistoryDict(self):
+        return {"roads": self.historyDicts}
+
+    def saveHistory(self, filename):
+        with open(filename, "w+") as f:
+            json.dump(self.getHistoryDict(), f, indent = 4)
+
+    def saveMetrics(self, filename):
+        with open(filename, "w+") as f:
+            json.dump(self.getMetrics(), f, indent = 4)
+
+# PartitionedSimulation runs the regions in parallel processes, tick by tick, routing the vehicles that cross the regions boundaries and the snapshots of the boundary roads
+class PartitionedSimulation:
+    def __init__(self, simulation, regionCount):
+        self.simulation = simulation
+        self.regions = partitionRoads(simulation.roads, simulation.startingRoads, regionCount)
+        self.owner = {roadId: index for index, roadIds in enumerate(self.regions) for roadId in roadIds} #road id -> region
+        self.ghostedBy = {} #road id -> region that owns the junction at the start of the road, if it's another region
+        for road in simulation.roads:
+            if road.endJunction is not None:
+                for nextRoad in road.endJunction.getOutgoingRoads():
+                    if self.owner[nextRoad.id] != self.owner[road.id]:
+                        self.ghostedBy[nextRoad.id] = self.owner[road.id]
+
+    def getGhostRoadIds(self, index):
+        return [roadId for roadId, region in self.ghostedBy.items() if region == index]
+
+    def getBoundaryRoadIds(self, index):
+        return [roadId for roadId in self.ghostedBy if self.owner[roadId] == index]
+
+    def simulate(self, vehHistoryFile, roadsMetricsFile, mapHistoryFile):
+        simulation = self.simulation
+        connections = []
+        processes = []
+        for index, roadIds in enumerate(self.regions):
+            connection, regionConnection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=runRegion, args=(simulation, index, roadIds, self.getGhostRoadIds(index), self.getBoundaryRoadIds(index), regionConnection))
+            process.start()
+            connections.append(connection)
+            processes.append(process)
+        ghostRoadIds = [self.getGhostRoadIds(index) for index in range(len(self.regions))]
+        roadsById = {road.id: road for road in simulation.roads}
+        writer = VehicleHistoryWriter(vehHistoryFile, simulation.vehicleHistoryFormat).open() if simulation.saveOutput else None
+        inboxes = [[] for _ in self.regions]
+        snapshots = {}
+        for i in range(simulation.simulationCycles):
+            time = i * simulation.timeStep
+            for index, connection in enumerate(connections):
+                connection.send((TICK, time, i, inboxes[index], {roadId: snapshots.get(roadId, []) for roadId in ghostRoadIds[index]}))
+            inboxes = [[] for _ in self.regions]
+            for connection in connections:
+                migrants, regionSnapshots, states = connection.recv()
+                for migrant in migrants:
+                    inboxes[self.owner[migrant[0]]].append(migrant)
+                snapshots.update(regionSnapshots)
+                if writer is not None:
+                    for vehicleId, stateTime, position, speed, acceleration, state, roadId in states:
+                        writer.recordRow(vehicleId, (stateTime, position, speed, acceleration, state, roadsById[roadId] if roadId is not None else None))
+            if writer is not None:
+                writer.saveBucket(time) #the bucket of the tick is written as in the serial mode
+            print("Cycle %d/%d" % (i, simulation.simulationCycles), end="\r")
+        print("Simulation finished")
+        vehicles = [vehicle for inbox in inboxes for _, _, vehicle in inbox] #vehicles that crossed a boundary in the last tick
+        metrics = {}
+        historyDicts = {}
+        for connection in connections:
+            connection.send((FINISH,))
+            regionVehicles, regionMetrics, regionHistoryDicts = connection.recv()
+            vehicles += regionVehicles
+            metrics.update((roadMetrics["road"], roadMetrics) for roadMetrics in regionMetrics)
+            historyDicts.update((historyDict["road"], historyDict) for historyDict in regionHistoryDicts)
+        for process in processes:
+            process.join()
+        for vehicle in vehicles:
+            if hasattr(vehicle, "stateHistory"): #the retired vehicles have no state history
+                vehicle.stateHistory.relinkRoads(roadsById)
+        simulation.vehicles = sorted(vehicles, key=lambda vehicle: vehicle.id)
+        simulation.vehicleCount = len(simulation.vehicles)
+        simulation.activeVehicles = {}
+        simulation.vehicleMetrics.addVehicles(simulation.vehicles) #the run is over, no vehicle changes anymore
+        simulation.history = RegionsHistory([metrics[road.id] for road in simulation.roads], [historyDicts[road.id] for road in simulation.roads if road.id in historyDicts])
+        if simulation.saveOutput:
+            print("Saving data...")
+            simulation.history.saveHistory(mapHistoryFile)
+            simulation.history.saveMetrics(roadsMetricsFile)
+            writer.close()
+
+# Runs the simulation built by buildSimulation (a new one for each run) in the serial mode and with regionCount regions, with the same seed,
+# and returns the relative deviation of the metrics in tolerances of the partitioned run from the serial run.
+# Raises ValueError if a deviation is larger than its tolerance
+def checkDeviation(buildSimulation, regionCount, seed = DEVIATION_SEED, tolerances = DEVIATION_TOLERANCES):
+    results = []
+    for regions in [1, regionCount]:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            simulation = buildSimulation()
+            if simulation is None:
+                raise ValueError("the scenario can't be built, see Simulation.getSimulationFromJSON")
+            simulation.seed = seed
+            simulation.regions = regions
+            simulation.saveOutput = False
+            simulation.simulate()
+        results.append(flattenMetrics(simulation.getMetrics()))
+    serial, partitioned = results
+    deviations = {name: abs(partitioned[name] - serial[name]) / max(abs(serial[name]), 1) for name in tolerances} #at least 1 as denominator, the metric can be 0 in the serial run
+    exceeded = ["%s %g (serial %g, deviation %.0f%% > %.0f%%)" % (name, partitioned[name], serial[name], deviations[name] * 100, tolerances[name] * 100) for name in tolerances if deviations[name] > tolerances[name]]
+    if exceeded:
+        raise ValueError("the partitioned run with %d regions deviates from the serial run: %s" % (regionCount, ", ".join(exceeded)))
+    return deviations
+
+def main(argv):
+    if len(argv) < 2:
+        print("Usage: python partition.py scenario regions [seed] [copies]")
+        return
+    scenario = argv[0]
+    regionCount = int(argv[1])
+    seed = int(argv[2]) if len(argv) > 2 else DEVIATION_SEED
+    copies = int(argv[3]) if len(argv) > 3 else 1
+    if scenario in simulate_tests.SCENARIOS:
+        buildSimulation = lambda: simulate_tests.SCENARIOS[scenario](copies = copies)
+    elif not os.path.isfile(scenario):
+        print("Error: %s is neither a JSON file nor a scenario of simulate_tests.py" % scenario)
+        return
+    else:
+        buildSimulation = lambda: Simulation.getSimulationFromJSON(scenario, False)
+    try:
+        deviations = checkDeviation(buildSimulation, regionCount, seed)
+        for name, deviation in deviations.items():
+            print("%s: %.1f%% (tolerance %.0f%%)" % (name, deviation * 100, DEVIATION_TOLERANCES[name] * 100))
+    except Exception as e:
+        print("Error:", e)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
@@ -3,67 +3,184 @@
 @authors  David Megli
 
 Description:
-This file contains the code to plot the vehicles in the simulation.json file.
+This file contains the code to plot the vehicles of a vehicles history file written by the simulation (json, ndjson or bin).
+The frames are read lazily from the time index of the file: the binary trajectory file (see trajectory.py) is memory mapped and has the
+bounding box of the coordinates in its header, the NDJSON file is indexed by the offset of each line, the JSON file is loaded at once.
+The animation reuses a single scatter artist, moving its points with set_offsets.
+The animation can also be rendered without a window to a video (.mp4, .gif) or to a folder of PNG images, in a background process.
+Usage: python plot.py history_file [--start time] [--end time] [--save output] [--fps fps] [--show]
+With --save the animation is rendered in a background process, --show also plays it in a window in the meantime.
+matplotlib is imported only when an animation is created, so the frame sources can be used without it.
 '''
 
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.animation import FuncAnimation
 import json
+import multiprocessing
+import os
 from vehicle import Vehicle, VehicleState
+from trajectory import TrajectoryReader
 import sys
 
-def parse_coords(filename):
-    # I parse the file simulation.json to get the points to plot
-    # In the json, for each time there is a number of vehicles, each with its coordinates
-    # I have a dictionary indexed by time, and each value is a list of tuples (x, y) with the coordinates of the vehicles
-    with open(filename, 'r') as f:
-        data = json.load(f)
-    coords = {}
-    for v in data[Vehicle.VEHICLE_HISTORY_STRING]:
-        time = v[VehicleState.TIME_STRING]
-        if time not in coords:
-            coords[time] = []
-        for veh in v[Vehicle.VEHICLE_STATES_STRING]:
-            coords[time].append((veh[VehicleState.X_COORDINATE_STRING], veh[VehicleState.Y_COORDINATE_STRING]))
-    return coords
-
-def get_min_max_coords(coords):
-    minX = 100
-    minY = 100
-    maxX = -100
-    maxY = -100
-    for time in coords:
-        for coord in coords[time]:
-            if coord[0] < minX:
-                minX = coord[0]
-            if coord[1] < minY:
-                minY = coord[1]
-            if coord[0] > maxX:
-                maxX = coord[0]
-            if coord[1] > maxY:
-                maxY = coord[1]
-    return minX, minY, maxX, maxY
+NO_COORDS = np.empty((0, 2))
+VIDEO_EXTENSIONS = (".mp4", ".gif")
 
-def main(args):
-    coords = parse_coords(args[0])
+def in_window(time, start_time, end_time):
+    return (start_time is None or time >= start_time) and (end_time is None or time < end_time)
+
+# The frame sources give the times of the frames, the coordinates of the vehicles at a time as an array of shape (vehicles, 2) and the bounding box
+class TrajectoryFrames:
+    def __init__(self, filename, start_time = None, end_time = None):
+        self.reader = TrajectoryReader(filename)
+        self.times = [int(time) if time.is_integer() else time for time in self.reader.getTimes().tolist() if in_window(time, start_time, end_time)]
+
+    def get_coords(self, time): #only the pages of the records of this time are read from the file
+        records = self.reader.getRecordsAt(time)
+        return np.column_stack((records["x"], records["y"])) if len(records) > 0 else NO_COORDS
+
+    def get_bounds(self):
+        return self.reader.getBounds()
+
+class NDJSONFrames:
+    def __init__(self, filename, start_time = None, end_time = None):
+        self.file = open(filename, "rb")
+        self.offsets = {} #time -> offset of the line of its bucket
+        self.times = []
+        self.bounds = None
+        offset = 0
+        for line in self.file: #a single pass to index the lines, the coordinates are not kept
+            bucket = json.loads(line)
+            time = bucket[VehicleState.TIME_STRING]
+            if in_window(time, start_time, end_time):
+                self.offsets[time] = offset
+                self.times.append(time)
+                self.update_bounds(self.get_bucket_coords(bucket))
+            offset += len(line)
+
+    def get_bucket_coords(self, bucket):
+        states = bucket[Vehicle.VEHICLE_STATES_STRING]
+        if not states:
+            return NO_COORDS
+        return np.array([(state[VehicleState.X_COORDINATE_STRING], state[VehicleState.Y_COORDINATE_STRING]) for state in states], dtype=float)
+
+    def update_bounds(self, coords):
+        if len(coords) == 0:
+            return
+        low = coords.min(axis=0)
+        high = coords.max(axis=0)
+        if self.bounds is None:
+            self.bounds = (float(low[0]), float(low[1]), float(high[0]), float(high[1]))
+        else:
+            self.bounds = (min(self.bounds[0], float(low[0])), min(self.bounds[1], float(low[1])), max(self.bounds[2], float(high[0])), max(self.bounds[3], float(high[1])))
+
+    def get_coords(self, time):
+        self.file.seek(self.offsets[time])
+        return self.get_bucket_coords(json.loads(self.file.readline()))
+
+    def get_bounds(self):
+        return self.bounds if self.bounds is not None else (0, 0, 0, 0)
+
+class JSONFrames: #the JSON layout can't be read one bucket at a time, the file is loaded at once
+    def __init__(self, filename, start_time = None, end_time = None):
+        # for each time there is a number of vehicles, each with its coordinates: I keep a dictionary indexed by time of the (x, y) of the vehicles
+        with open(filename, 'r') as f:
+            data = json.load(f)
+        coords = {}
+        for v in data[Vehicle.VEHICLE_HISTORY_STRING]:
+            points = coords.setdefault(v[VehicleState.TIME_STRING], [])
+            for veh in v[Vehicle.VEHICLE_STATES_STRING]:
+                points.append((veh[VehicleState.X_COORDINATE_STRING], veh[VehicleState.Y_COORDINATE_STRING]))
+        self.coords = {time: np.array(points, dtype=float) if points else NO_COORDS for time, points in coords.items() if in_window(time, start_time, end_time)}
+        self.times = sorted(self.coords)
+        points = np.concatenate([self.coords[time] for time in self.times]) if self.times else NO_COORDS
+        self.bounds = tuple(points.min(axis=0).tolist() + points.max(axis=0).tolist()) if len(points) > 0 else (0, 0, 0, 0)
+
+    def get_coords(self, time):
+        return self.coords[time]
+
+    def get_bounds(self):
+        return self.bounds
+
+def open_frames(filename, start_time = None, end_time = None):
+    if filename.endswith(".bin"):
+        return TrajectoryFrames(filename, start_time, end_time)
+    if filename.endswith(".ndjson"):
+        return NDJSONFrames(filename, start_time, end_time)
+    return JSONFrames(filename, start_time, end_time)
+
+def create_animation(frames, fps = 10):
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
     fig, ax = plt.subplots()
     #I change the size of the figure
     fig.set_size_inches(10, 10)
-    x = []
-    y = []
-    minX, minY, maxX, maxY = get_min_max_coords(coords)
+    minX, minY, maxX, maxY = frames.get_bounds()
+    margin = max(maxX - minX, maxY - minY) * 0.02 + 1 #so the vehicles on the border are visible
+    ax.set_xlim(minX - margin, maxX + margin)
+    ax.set_ylim(minY - margin, maxY + margin)
+    scatter = ax.scatter([], [])
+    title = ax.set_title("")
     def update(frame):
-        ax.clear()
-        ax.set_xlim(minX, maxX)
-        ax.set_ylim(minY, maxY)
-        for coord in coords[frame]:
-            x.append(coord[0])
-            y.append(coord[1])
-        ax.scatter(x, y)
-    ani = FuncAnimation(fig, update, frames=range(0, 600), repeat=True)
+        time = frames.times[frame]
+        scatter.set_offsets(frames.get_coords(time))
+        title.set_text("Time: %s" % time)
+        return scatter, title
+    ani = FuncAnimation(fig, update, frames=len(frames.times), interval=1000 / fps, repeat=True)
+    return fig, ani, update
+
+def render(filename, output, start_time = None, end_time = None, fps = 10): #renders the animation without a window, to a video or to a folder of PNG images
+    import matplotlib.pyplot as plt
+    plt.switch_backend("Agg")
+    frames = open_frames(filename, start_time, end_time)
+    fig, ani, update = create_animation(frames, fps)
+    if output.endswith(VIDEO_EXTENSIONS):
+        ani.save(output, fps=fps)
+    else:
+        os.makedirs(output, exist_ok=True)
+        for frame in range(len(frames.times)):
+            update(frame)
+            fig.savefig(os.path.join(output, "frame_%06d.png" % frame))
+    plt.close(fig)
+    print("Animation saved to %s" % os.path.abspath(output))
+
+def render_in_background(filename, output, start_time = None, end_time = None, fps = 10): #returns the process, call join to wait for the end
+    process = multiprocessing.Process(target=render, args=(filename, output, start_time, end_time, fps))
+    process.start()
+    return process
+
+def show(filename, start_time = None, end_time = None, fps = 10):
+    import matplotlib.pyplot as plt
+    frames = open_frames(filename, start_time, end_time)
+    fig, ani, update = create_animation(frames, fps)
     plt.show()
 
+def main(args):
+    if len(args) < 1:
+        print("Usage: python plot.py history_file [--start time] [--end time] [--save output] [--fps fps] [--show]")
+        return
+    options = {"--start": None, "--end": None, "--save": None, "--fps": "10"}
+    showWindow = False
+    i = 1
+    while i < len(args):
+        if args[i] == "--show":
+            showWindow = True
+        elif args[i] in options and i + 1 < len(args):
+            options[args[i]] = args[i + 1]
+            i += 1
+        else:
+            print("Unknown option: %s" % args[i])
+            return
+        i += 1
+    start_time = float(options["--start"]) if options["--start"] is not None else None
+    end_time = float(options["--end"]) if options["--end"] is not None else None
+    fps = int(options["--fps"])
+    if options["--save"] is None:
+        show(args[0], start_time, end_time, fps)
+        return
+    process = render_in_background(args[0], options["--save"], start_time, end_time, fps)
+    if showWindow:
+        show(args[0], start_time, end_time, fps)
+    process.join()
+
 if __name__ == '__main__':
     args = sys.argv[1:]
-    main(args)
\ No newline at end of file
+    main(args)
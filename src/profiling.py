@@ -0,0 +1,101 @@
+"""
+@file    profiling.py
+@authors  David Megli
+
+Description:
+This file contains the profiler of the simulation, enabled with "profile": true in the "simulation" section or with Simulation.enableProfiling.
+The profiler receives from Simulation.simulate the wall time of each phase of every cycle (inject, move, history, export, log)
+and counts the calls to the helpers that are called many times per cycle (e.g. Road.hasVehicle, Road.precedingVehicle, Intersection.canGo,
+Shape.calculateCoordinatesOnShape). The helpers are counted by replacing them with a counting wrapper while the simulation runs,
+so they cost nothing when the profiler is off.
+At the end of the run the report contains, for each phase, the total, mean and maximum time per cycle and, for each helper, the number of calls;
+with timeSeries the report also contains the phase times and the calls of every cycle, to see where the time goes as the network fills up.
+"""
+import json
+from map import Road, Shape, Intersection, Semaphore
+
+class SimulationProfiler:
+    COUNTED_METHODS = [
+        (Road, "hasVehicle"),
+        (Road, "precedingVehicle"),
+        (Road, "followingVehicle"),
+        (Road, "getNextSemaphore"),
+        (Intersection, "canGo"),
+        (Semaphore, "getState"),
+        (Shape, "calculateCoordinatesOnShape"),
+        (Shape, "calculateCoordinatesOnShapeBatch")
+    ]
+    def __init__(self, timeSeries = False, countedMethods = None):
+        self.timeSeries = timeSeries
+        self.countedMethods = countedMethods if countedMethods is not None else self.COUNTED_METHODS
+        self.originals = {} #(class, method name) -> original method, while the counters are installed
+        self.reset()
+
+    def reset(self):
+        self.cycles = 0
+        self.phaseTotals = {}
+        self.phaseMaxima = {}
+        self.counters = {self.getCounterName(cls, name): 0 for cls, name in self.countedMethods}
+        self.lastCounters = dict(self.counters)
+        self.series = [] #one entry per cycle if timeSeries is set
+
+    @staticmethod
+    def getCounterName(cls, name):
+        return "%s.%s" % (cls.__name__, name)
+
+    def start(self): #installs the counting wrappers, called by Simulation.simulate before the first cycle
+        self.reset()
+        self.install()
+
+    def install(self): #installs the counting wrappers without resetting the counters, e.g. when a run is resumed from a checkpoint
+        for cls, name in self.countedMethods:
+            if (cls, name) in self.originals:
+                continue
+            original = cls.__dict__[name]
+            self.originals[(cls, name)] = original
+            setattr(cls, name, self.getCountingWrapper(original, self.getCounterName(cls, name)))
+
+    def stop(self): #restores the original methods
+        for (cls, name), original in self.originals.items():
+            setattr(cls, name, original)
+        self.originals = {}
+
+    def __getstate__(self): #the original methods belong to this process, the counters are installed again by install
+        state = self.__dict__.copy()
+        state["originals"] = {}
+        return state
+
+    def getCountingWrapper(self, method, counterName):
+        counters = self.counters
+        def wrapper(*args, **kwargs):
+            counters[counterName] += 1
+            return method(*args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def recordCycle(self, time, phaseTimes): #phaseTimes: phase -> seconds spent in this cycle
+        self.cycles += 1
+        for phase, seconds in phaseTimes.items():
+            self.phaseTotals[phase] = self.phaseTotals.get(phase, 0.0) + seconds
+            if seconds > self.phaseMaxima.get(phase, 0.0):
+                self.phaseMaxima[phase] = seconds
+        if self.timeSeries:
+            calls = {name: count - self.lastCounters[name] for name, count in self.counters.items()}
+            self.lastCounters = dict(self.counters)
+            self.series.append({"time": time, "phases": dict(phaseTimes), "calls": calls})
+
+    def getReport(self):
+        cycles = self.cycles if self.cycles > 0 else 1
+        report = {
+            "cycles": self.cycles,
+            "phases": {phase: {"total": total, "mean": total / cycles, "max": self.phaseMaxima.get(phase, 0.0)} for phase, total in self.phaseTotals.items()},
+            "calls": {name: {"total": count, "perCycle": count / cycles} for name, count in self.counters.items()}
+        }
+        if self.timeSeries:
+            report["series"] = self.series
+        return report
+
+    def saveReport(self, filename):
+        with open(filename, "w+") as f:
+            json.dump(self.getReport(), f, indent = 4)
@@ -0,0 +1,57 @@
+"""
+@file    signals.py
+@authors  David Megli
+
+Description:
+This file contains the signal plan of the map, that answers the queries about all the semaphores at once, e.g. the state of every light at a given time for the visualizer.
+The phases of the semaphores (start time, end of the green and yellow phases and cycle time) are copied in arrays, so the state of all the semaphores
+at a time, or the table with the state of every semaphore at every cycle of the simulation, is computed with a few numpy operations.
+The states are returned as codes, the index of the state in SignalPlan.STATES. A single semaphore is queried with Semaphore.getState, which uses the phases compiled by Semaphore.compilePhases.
+numpy is only needed when the signal plan is used.
+"""
+import numpy as np
+from map import Semaphore
+
+class SignalPlan:
+    STATES = [Semaphore.STATE_GREEN, Semaphore.STATE_YELLOW, Semaphore.STATE_RED] #state code -> state
+    GREEN = 0
+    YELLOW = 1
+    RED = 2
+    def __init__(self, roads):
+        self.semaphores = [] #list of (road, semaphore), in order of road and of position in the road
+        for road in roads:
+            for semaphore in road.semaphores:
+                self.semaphores.append((road, semaphore))
+        self.compile()
+
+    def compile(self): #must be called again if the times of the semaphores are changed
+        semaphores = [semaphore for _, semaphore in self.semaphores]
+        self.startTimes = np.array([semaphore.startTime for semaphore in semaphores], dtype=float)
+        self.greenEnds = np.array([semaphore.phaseEnds[0] for semaphore in semaphores], dtype=float)
+        self.yellowEnds = np.array([semaphore.phaseEnds[1] for semaphore in semaphores], dtype=float)
+        self.cycleTimes = np.array([semaphore.phaseEnds[2] for semaphore in semaphores], dtype=float)
+
+    def getStateCodesAt(self, times): #state codes with shape (len(times), number of semaphores), same comparisons of Semaphore.getState
+        times = np.asarray(times, dtype=float)[:, np.newaxis]
+        timeInCycle = np.mod(times - self.startTimes, self.cycleTimes)
+        codes = np.full(timeInCycle.shape, self.RED, dtype=np.int8)
+        codes[timeInCycle < self.yellowEnds] = self.YELLOW
+        codes[timeInCycle < self.greenEnds] = self.GREEN
+        codes[times < self.startTimes] = self.RED
+        return codes
+
+    def getStateCodes(self, time): #state code of every semaphore at the given time
+        return self.getStateCodesAt([time])[0]
+
+    def getStates(self, time):
+        return [self.STATES[code] for code in self.getStateCodes(time)]
+
+    def getPhaseTable(self, startTime, endTime, timeStep = 1): #state codes of every semaphore at every cycle from startTime to endTime (excluded)
+        return self.getStateCodesAt(np.arange(startTime, endTime, timeStep))
+
+    def getNextChangeTime(self, time): #first time after the given time at which a semaphore can change state
+        return min([semaphore.getNextChangeTime(time) for _, semaphore in self.semaphores], default=None)
+
+    def getStatesAsJSON(self, time): #state of every semaphore with its road and position, e.g. to draw the lights
+        states = self.getStates(time)
+        return [{"road": road.id, "position": road.getSemaphorePosition(semaphore), "state": states[i]} for i, (road, semaphore) in enumerate(self.semaphores)]
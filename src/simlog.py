@@ -0,0 +1,131 @@
+"""
+@file    simlog.py
+@authors  David Megli
+
+Description:
+This file contains the logger of the simulation, used by Simulation.simulate when log is set.
+For every logged cycle it writes the state of the semaphores, the vehicles on each road and the vehicles arrived so far.
+The vehicles are read from the lanes of each road, so a cycle costs as much as the vehicles on the map and not roads x all the vehicles ever created;
+the arrived vehicles are kept in a list extended at each cycle with the vehicles retired by the simulation, so the list is never rebuilt or sorted again.
+The text of a cycle is built in memory and written to the file by a background thread, so the simulation doesn't wait for the disk.
+The level selects what is written (summary: time and number of arrived vehicles, semaphores: also the state of the semaphores,
+vehicles: everything, the default) and the interval writes only one cycle every interval cycles.
+"""
+import queue
+import threading
+
+class SimulationLogger:
+    LEVEL_SUMMARY = "summary"
+    LEVEL_SEMAPHORES = "semaphores"
+    LEVEL_VEHICLES = "vehicles"
+    LEVELS = [LEVEL_SUMMARY, LEVEL_SEMAPHORES, LEVEL_VEHICLES] #each level writes also what the previous ones write
+    QUEUE_SIZE = 64 #cycles waiting to be written, the simulation waits if the writer falls behind
+    def __init__(self, filename, level = LEVEL_VEHICLES, interval = 1):
+        if level not in SimulationLogger.LEVELS:
+            raise ValueError("Unknown log level: %s" % level)
+        self.filename = filename
+        self.level = SimulationLogger.LEVELS.index(level)
+        self.interval = interval if interval is not None and interval > 0 else 1
+        self.arrivals = [] #(arrival time, id) of the arrived vehicles, in order of arrival time and id
+        self.arrivalsText = [] #"id:arrivalTime, " of each arrived vehicle
+        self.arrivalsLine = None #arrivalsText joined, built again only when it's written after new arrivals
+        self.queue = None
+        self.writer = None
+        self.error = None #exception of the writer thread, raised by the next logCycle or close
+
+    def open(self):
+        self.file = open(self.filename, "w+")
+        self.startWriter()
+        return self
+
+    def reopen(self): #continues the file of a checkpoint or of a closed log, dropping what was written after it
+        self.file = open(self.filename, "r+")
+        self.file.truncate(self.offset)
+        self.file.seek(self.offset)
+        self.startWriter()
+        return self
+
+    def startWriter(self):
+        self.error = None
+        self.queue = queue.Queue(SimulationLogger.QUEUE_SIZE)
+        self.writer = threading.Thread(target=self.writeLoop, daemon=True)
+        self.writer.start()
+
+    # After an error (e.g. disk full) the next cycles are taken from the queue and discarded, so the simulation never waits on a full queue,
+    # and the error is raised in the simulation thread by checkError
+    def writeLoop(self):
+        while True:
+            text = self.queue.get()
+            if text is None:
+                break
+            if self.error is None:
+                try:
+                    self.file.write(text)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+        try:
+            if self.error is None:
+                self.offset = self.file.tell() #a closed log can be continued by reopen, e.g. when a stopped run is resumed
+            self.file.close()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+    def checkError(self):
+        if self.error is not None:
+            raise RuntimeError("Error writing the log %s: %s" % (self.filename, self.error)) from self.error
+
+    # When pickled with the simulation (see checkpoint.py) the cycles in the queue are written first and only the offset of the file is saved,
+    # the writer is started again by reopen
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.writer is not None:
+            self.queue.join()
+            self.checkError()
+            self.file.flush()
+            state["offset"] = self.file.tell()
+        state["queue"] = None
+        state["writer"] = None
+        state["file"] = None
+        return state
+
+    def close(self): #waits until all the cycles are written
+        if self.writer is None:
+            return
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+        self.checkError()
+
+    def addArrivals(self, arrived): #vehicles arrived in the last cycle, in order of creation (see Simulation.retireVehicles), called at every cycle
+        if not arrived:
+            return
+        arrived = sorted(((vehicle.arrivalTime, vehicle.id) for vehicle in arrived), key=lambda arrival: arrival[0]) #stable, so the ties stay in order of id
+        if self.arrivals and arrived[0][0] < self.arrivals[-1][0]: #only if the arrival times are set out of order
+            self.arrivals = sorted(self.arrivals + arrived)
+            self.arrivalsText = ["%d:%d, " % (vehicleId, arrivalTime) for arrivalTime, vehicleId in self.arrivals]
+        else:
+            self.arrivals += arrived
+            self.arrivalsText += ["%d:%d, " % (vehicleId, arrivalTime) for arrivalTime, vehicleId in arrived]
+        self.arrivalsLine = None
+
+    def logCycle(self, cycle, time, roads): #roads in the order they are written
+        if cycle % self.interval != 0:
+            return
+        lines = ["Time: %ds\n" % time]
+        if self.level >= SimulationLogger.LEVELS.index(SimulationLogger.LEVEL_SEMAPHORES):
+            for road in roads:
+                for s in road.semaphores:
+                    lines.append("Semaphore in road %d at %dm: %s\n" % (road.id, s.position, s.getState(time)))
+        if self.level >= SimulationLogger.LEVELS.index(SimulationLogger.LEVEL_VEHICLES):
+            for road in roads:
+                for vehicle in sorted(road.getAllVehicles(), key=lambda vehicle: vehicle.id):
+                    lines.append("Vehicle %d: pos: %d/%dm, speed: %dm/s (%dkm/h), acc: %dm/s^2, in road %d, State: %s, Arrived: %s, currentDelay: %s, cumulativeDelay: %s\n" % (vehicle.id, vehicle.position, road.length, vehicle.speed, vehicle.speed*3.6, vehicle.acceleration, road.id, vehicle.state, vehicle.isArrived(), vehicle.currentDelay, vehicle.cumulativeDelay))
+        lines.append("Arrived Vehicles: %d\n" % len(self.arrivals))
+        if self.level >= SimulationLogger.LEVELS.index(SimulationLogger.LEVEL_VEHICLES) and self.arrivals:
+            if self.arrivalsLine is None:
+                self.arrivalsLine = "".join(self.arrivalsText) + "\n"
+            lines.append(self.arrivalsLine)
+        self.checkError()
+        self.queue.put("".join(lines))
@@ -5,15 +5,15 @@
 Description:
 This file simulates the movement of vehicles in a road, receiving a JSON file with the configuration of the simulation.
 """
+import gc
 import json
-import jsonschema
 import sys
-from vehicle import Vehicle
+from vehicle import Vehicle, RetiredVehicle
 from map import Coordinates, Road, Semaphore, Junction, Intersection, Shape
-from data import RoadHistory, MapHistory
+from data import RoadHistory, MapHistory, VehicleHistoryWriter
+from metrics import VehicleMetricsAccumulator
 import random
 import time as t
-from pathlib import Path
 import os
 
 class Simulation:
@@ -25,6 +25,17 @@ class Simulation:
     VEHICLE_INJECTION_RATE_STRING = "vehicleInjectionRate"
     SECTOR_LENGTH_STRING = "sectorLength"
     LOG_STRING = "log"
+    LOG_LEVEL_STRING = "logLevel"
+    LOG_INTERVAL_STRING = "logInterval"
+    VEHICLE_HISTORY_FORMAT_STRING = "vehicleHistoryFormat"
+    KINEMATICS_ENGINE_STRING = "kinematicsEngine"
+    HISTORY_SAMPLE_INTERVAL_STRING = "historySampleInterval"
+    HISTORY_WINDOW_STRING = "historyWindow"
+    SEED_STRING = "seed"
+    REGIONS_STRING = "regions"
+    PROFILE_STRING = "profile"
+    PROFILE_TIME_SERIES_STRING = "profileTimeSeries"
+    CHECKPOINT_INTERVAL_STRING = "checkpointInterval"
     VEHICLES_STRING = "vehicles"
     VEHICLE_LENGTH_STRING = "length"
     VEHICLE_INITIAL_POS_STRING = "initialPosition"
@@ -38,6 +49,7 @@ class Simulation:
     VEHICLE_REACTION_TIME_AT_SEMAPHORE_STRING = "reactionTimeAtSemaphore"
     VEHICLE_DAMPING_FACTOR_STRING = "dampingFactor"
     ROADS_STRING = "roads"
+    ROAD_ID_STRING = "id"
     ROAD_LENGTH_STRING = "length"
     ROAD_VEHICLE_DISTANCE_STRING = "vehicleDistance"
     ROAD_SPEED_LIMIT_STRING = "speedLimit"
@@ -54,14 +66,31 @@ class Simulation:
     INTERSECTION_INCOMING_ROADS_STRING = "inRoads"
     INTERSECTION_OUTGOING_ROADS_STRING = "outRoads"
     INTERSECTION_OUT_FLUXES_STRING = "outFluxes"
+    # Kinematics engines:
+    ENGINE_SCALAR = "scalar" # vehicles moved one by one by Road.moveVehicle
+    ENGINE_NUMPY = "numpy" # vehicles moved in batches by kinematics.VectorizedKinematicsEngine, requires numpy
+    # Phases of a cycle timed in phaseTimes:
+    PHASE_INJECT = "inject" # injectVehicles
+    PHASE_MOVE = "move" # moveVehicles
+    PHASE_HISTORY = "history" # MapHistory.saveState
+    PHASE_EXPORT = "export" # vehicles history buckets, retirement of the arrived vehicles and output files
+    PHASE_LOG = "log" # log of the cycle, if log is set
+    PHASES = [PHASE_INJECT, PHASE_MOVE, PHASE_HISTORY, PHASE_EXPORT, PHASE_LOG]
+    SCHEMA_FILENAME = "simulation_schema.json"
+    schema = None # JSON schema, loaded by validateJSON the first time it's needed
+    schemaSource = None # content of the schema file, part of the key of the scenario cache
     
-    def __init__(self, simulationCycles: int = 600, timeStep: int = 1, vehicleInjectionRate: int = 1, sectorLength: int = 100, simulationName: str = "simulation", log: bool = False):
+    def __init__(self, simulationCycles: int = 600, timeStep: int = 1, vehicleInjectionRate: int = 1, sectorLength: int = 100, simulationName: str = "simulation", log: bool = False, vehicleHistoryFormat: str = VehicleHistoryWriter.MODE_JSON, kinematicsEngine: str = ENGINE_SCALAR, historySampleInterval: int = 0, historyWindow: int = None, seed: int = None, saveOutput: bool = True, regions: int = 1):
         self.roadCount = 0
         self.intersectionCount = 0
         self.vehicleTypeCount = 0
         self.vehicleTypes: list[Vehicle] = []
         self.vehicleCount = 0
-        self.vehicles: list[Vehicle] = []
+        self.vehicles: list[Vehicle | RetiredVehicle] = [] #all the vehicles in order of creation, the arrived ones are replaced by their RetiredVehicle
+        self.activeVehicles: dict[Vehicle, int] = {} #vehicles not arrived yet -> index in self.vehicles, in order of creation
+        self.retireArrived = True #if False the arrived vehicles are not retired and keep their state history until the end of the run
+        self.vehicleMetrics = VehicleMetricsAccumulator() #metrics of the retired vehicles, see getVehiclesMetrics
+        self.onCycle = None #if set, called with the simulation and the time at the end of every cycle, e.g. to poll getMetrics during a long run
         self.roads: list[Road] = []
         self.startingRoads: list[Road] = []
         self.intersections: list[Intersection] = []
@@ -72,6 +101,28 @@ class Simulation:
         self.simulationName = simulationName
         self.vehicleInjectionRate = vehicleInjectionRate
         self.log = log
+        self.logLevel = "vehicles" # what the log writes: "summary", "semaphores" or "vehicles" (see simlog.SimulationLogger)
+        self.logInterval = 1 # the log writes one cycle every logInterval cycles
+        self.vehicleHistoryFormat = vehicleHistoryFormat # "json" (same layout read by the visual simulator), "ndjson" (one time bucket per line) or "bin" (binary trajectory, see trajectory.py)
+        self.historyWriter: VehicleHistoryWriter = None
+        self.kinematicsEngine = kinematicsEngine
+        self.historySampleInterval = historySampleInterval # seconds between the sector snapshots saved in the map history, 0 = every cycle
+        self.historyWindow = historyWindow # if set, only the last historyWindow snapshots of each road are kept
+        self.seed = seed # if set, the random generator is seeded with it at the start of simulate, so the replication can be repeated
+        self.saveOutput = saveOutput # if False no output file is written, the metrics are read with getMetrics (see montecarlo.py)
+        self.movingOrder = None #roads in the order they are moved, from the highest id
+        self.regions = regions # if > 1 the roads are split in regions that run in parallel processes (see partition.py)
+        self.phaseTimes = {phase: 0.0 for phase in Simulation.PHASES} # wall time in seconds spent in each phase by the last run of simulate (serial mode only)
+        self.profiler = None # if set, it receives the phase times of every cycle and counts the calls to the hot helpers (see enableProfiling)
+        self.logger = None # log of the current run, if log is set (see simlog.SimulationLogger)
+        self.checkpointInterval = 0 # if > 0 the state of the run is saved every checkpointInterval cycles, to resume it (see checkpoint.py, serial mode only)
+        self.nextCycle = 0 # cycle the run continues from, see resume
+        self.randomState = None # state of the random generator saved in the checkpoint the simulation was loaded from, restored by resume
+
+    def __getstate__(self): #the callback is not pickled with the simulation (see cache.py and checkpoint.py)
+        state = self.__dict__.copy()
+        state["onCycle"] = None
+        return state
    
     def addVehicleType(self,length: int = 5, initialPos: int = 0, initialSpeed: int = 7, initialAcceleration: int = 0, maxSpeed: int = 7, maxAcceleration: float = 4, creationTime: int = 0, sigma: float = 0.0, reactionTime: float = 1.0, reactionTimeAtSemaphore: float = 1.0, dampingFactor: float = 0.18):
         self.vehicleTypes.append(Vehicle(self.vehicleTypeCount, length, initialPos, initialSpeed, initialAcceleration, maxSpeed, maxAcceleration, creationTime, sigma, reactionTime,reactionTimeAtSemaphore, dampingFactor))
@@ -93,7 +144,7 @@ class Simulation:
         return self.roads[-roadCount:]
     
     def addSemaphore(self, road, greenLight: int = 60, redLight: int = 30, position: int = 500, yellowLight: int = 0, delay: int = 0):
-        road.addSemaphore(Semaphore(greenLight, redLight, position, 0, 0))
+        road.addSemaphore(Semaphore(greenLight, redLight, position, yellowLight, delay))
 
     def addIntersection(self, incomingRoads: list[Road], outgoingRoads: list[Road], outProbabilities: list[int]):
         self.intersections.append(Intersection(self.intersectionCount, incomingRoads, outgoingRoads, outProbabilities))
@@ -101,62 +152,164 @@ class Simulation:
         self.intersectionCount += 1
         return self.intersections[-1]
     
+    def createVehicle(self, vehicleType, vehicleId, time): #returns a new vehicle with the characteristics of the given vehicle type
+        veh = Vehicle(vehicleId, vehicleType.length, 0, vehicleType.initialSpeed, vehicleType.initialAcceleration, vehicleType.maxSpeed, vehicleType.maxAcceleration, time, vehicleType.sigma, vehicleType.reactionTime, vehicleType.reactionTimeAtSemaphore, vehicleType.dampingFactor)
+        veh.setHistoryWriter(self.historyWriter) #None if the output is not saved
+        return veh
+
     def injectVehicles(self, time, cycle):
         for vehicle in self.vehicleTypes:
             if cycle % self.vehicleInjectionRate == 0:        
                 for road in self.startingRoads:
-                    veh = Vehicle(self.vehicleCount, vehicle.length, 0, vehicle.initialSpeed, vehicle.initialAcceleration, vehicle.maxSpeed, vehicle.maxAcceleration, time, vehicle.sigma, vehicle.reactionTime, vehicle.reactionTimeAtSemaphore, vehicle.dampingFactor)
+                    veh = self.createVehicle(vehicle, self.vehicleCount, time)
                     road.addVehicle(veh,time)
+                    self.activeVehicles[veh] = len(self.vehicles)
                     self.vehicles.append(veh)
                     self.vehicleCount += 1
 
+    def retireVehicles(self): #removes the arrived vehicles from the active ones and returns them, in order of creation
+        arrived = [vehicle for vehicle in self.activeVehicles if vehicle.isArrived()]
+        retired = []
+        for vehicle in arrived:
+            index = self.activeVehicles.pop(vehicle)
+            if self.retireArrived:
+                self.vehicles[index] = vehicle.retire() #the states were already written by the history writer, only the metrics are kept
+            retired.append(self.vehicles[index])
+        self.vehicleMetrics.addVehicles(retired)
+        return retired
+
+    def getActiveVehicles(self):
+        return list(self.activeVehicles)
+
+    def setupKinematicsEngine(self):
+        engine = None
+        if self.kinematicsEngine == Simulation.ENGINE_NUMPY:
+            from kinematics import VectorizedKinematicsEngine # numpy is only imported if the engine is used
+            engine = VectorizedKinematicsEngine()
+        elif self.kinematicsEngine != Simulation.ENGINE_SCALAR:
+            raise ValueError("Unknown kinematics engine: %s" % self.kinematicsEngine)
+        for road in self.roads:
+            road.setKinematicsEngine(engine)
+
     def moveVehicles(self, time):
-        roads = sorted(self.roads, key=lambda road: road.id, reverse=True)
-        for road in roads:
+        if self.movingOrder is None or len(self.movingOrder) != len(self.roads): #the roads are sorted once, not at every cycle
+            self.movingOrder = sorted(self.roads, key=lambda road: road.id, reverse=True)
+        for road in self.movingOrder:
             road.moveVehicles(time, self.timeStep)
 
-    def simulate(self):
+    def enableProfiling(self, timeSeries = False): #the profile of the next run is returned by getProfile and saved with the output files
+        from profiling import SimulationProfiler # the profiler is only imported if it's used
+        self.profiler = SimulationProfiler(timeSeries)
+        return self.profiler
+
+    def getProfile(self):
+        return self.profiler.getReport() if self.profiler is not None else None
+
+    # Runs the cycles from firstCycle to lastCycle (excluded, by default the last cycle of the simulation). firstCycle > 0 continues a run
+    # loaded from a checkpoint or stopped before the end by lastCycle (see resume); the output files are saved only after the last cycle
+    def simulate(self, firstCycle = 0, lastCycle = None):
+        resuming = firstCycle > 0
+        lastCycle = self.simulationCycles if lastCycle is None else min(lastCycle, self.simulationCycles)
         os.makedirs("../output", exist_ok=True)
         output = "../output/%s_simulation_output_%i.txt" % (self.simulationName, self.simulationCycles)
-        vehHistoryMetricsFile = "../output/%s_vehicles_metrics_%i.json" % (self.simulationName, self.simulationCycles)
+        vehHistoryMetricsFile = "../output/%s_vehicles_metrics_%i.%s" % (self.simulationName, self.simulationCycles, self.vehicleHistoryFormat)
         vehMetricsFile = "../output/%s_vehicles_metrics_%i.txt" % (self.simulationName, self.simulationCycles)
         roadsMetricsJsonFile = "../output/%s_road_metrics_%i.json" % (self.simulationName, self.simulationCycles)
         mapHistoryFile = "../output/%s_map_history_%i.json" % (self.simulationName, self.simulationCycles)
+        profileFile = "../output/%s_profile_%i.json" % (self.simulationName, self.simulationCycles)
+        checkpointFile = "../output/%s_checkpoint_%i.pickle" % (self.simulationName, self.simulationCycles)
+        if resuming:
+            if self.randomState is not None:
+                random.setstate(self.randomState)
+                self.randomState = None
+        elif self.seed is not None:
+            random.seed(self.seed)
+        if self.regions > 1:
+            ignored = [name for name, isSet in ((Simulation.LOG_STRING, self.log), (Simulation.PROFILE_STRING, self.profiler is not None), (Simulation.CHECKPOINT_INTERVAL_STRING, self.checkpointInterval > 0)) if isSet]
+            if ignored:
+                print("Warning: %s not supported with %d regions, ignored" % (", ".join(ignored), self.regions))
+            from partition import PartitionedSimulation # multiprocessing is only used in the partitioned mode
+            PartitionedSimulation(self, self.regions).simulate(vehHistoryMetricsFile, roadsMetricsJsonFile, mapHistoryFile)
+            return
+        logger = None
         if self.log:
-            f = open(vehMetricsFile, "w+")
-            f2 = open(output, "w+")
-            #f3 = open(vehHistoryMetricsFile, "w+")
-        self.history = MapHistory(self.roads, self.sectorLength)
-        for i in range(self.simulationCycles):
-            time = i * self.timeStep
-            if self.log:
-                print("Time: %ds" % time, file=f2)
-            self.injectVehicles(time, i)
-            self.moveVehicles(time)
-            self.history.saveState(time)
-            print("Cycle %d/%d" % (i,self.simulationCycles), end="\r")
-            if self.log:
-                roads = None
-                if self.roads is not None:
-                    roads = sorted(self.roads, key=lambda road: road.id, reverse=True)
-                for road in roads:
-                    for s in road.semaphores:
-                        print("Semaphore in road %d at %dm: %s" % (road.id, s.position, s.getState(time)), file=f2)
-                for road in roads:
-                    for vehicle in self.vehicles:
-                        if road.hasVehicle(vehicle):
-                            print("Vehicle %d: pos: %d/%dm, speed: %dm/s (%dkm/h), acc: %dm/s^2, in road %d, State: %s, Arrived: %s, currentDelay: %s, cumulativeDelay: %s" % (vehicle.id, vehicle.position, road.length, vehicle.speed, vehicle.speed*3.6, vehicle.acceleration, road.id, vehicle.state, vehicle.isArrived(), vehicle.currentDelay, vehicle.cumulativeDelay), file=f2)
-                print("Arrived Vehicles: %d" % len([vehicle for vehicle in self.vehicles if vehicle.isArrived()]), file=f2)
-                arrivedVehs = [vehicle for vehicle in self.vehicles if vehicle.isArrived()]
-                if arrivedVehs:
-                    arrivedVehs.sort(key=lambda vehicle: vehicle.arrivalTime)
-                for vehicle in arrivedVehs:
-                    print("%d:%d, " % (vehicle.id, vehicle.arrivalTime), end="", file=f2)
-                if arrivedVehs:
-                    print("", file=f2)
+            if resuming:
+                self.logger.reopen()
+            else:
+                from simlog import SimulationLogger # the logger is only imported if it's used
+                self.logger = SimulationLogger(output, self.logLevel, self.logInterval).open()
+            logger = self.logger
+            logOrder = sorted(self.roads, key=lambda road: road.id, reverse=True)
+        if resuming:
+            if self.historyWriter is not None:
+                self.historyWriter.reopen()
+        elif self.saveOutput:
+            self.history = MapHistory(self.roads, self.sectorLength, self.historySampleInterval, self.historyWindow)
+            self.historyWriter = VehicleHistoryWriter(vehHistoryMetricsFile, self.vehicleHistoryFormat).open()
+        else: #the road metrics are aggregated online, only the last snapshot is kept
+            self.history = MapHistory(self.roads, self.sectorLength, self.historySampleInterval, 1)
+            self.historyWriter = None
+        self.setupKinematicsEngine()
+        if not resuming:
+            self.phaseTimes = {phase: 0.0 for phase in Simulation.PHASES}
+        phaseTimes = self.phaseTimes
+        if self.profiler is not None:
+            if resuming:
+                self.profiler.install()
+            else:
+                self.profiler.start()
+        checkpoints = None
+        if self.checkpointInterval > 0:
+            from checkpoint import CheckpointWriter # the checkpoints are only imported if they're used
+            checkpoints = CheckpointWriter(checkpointFile)
+        try:
+            for i in range(firstCycle, lastCycle):
+                time = i * self.timeStep
+                start = t.perf_counter()
+                self.injectVehicles(time, i)
+                injected = t.perf_counter()
+                self.moveVehicles(time)
+                moved = t.perf_counter()
+                self.history.saveState(time)
+                saved = t.perf_counter()
+                if self.historyWriter is not None:
+                    self.historyWriter.saveBucket(time)
+                retired = self.retireVehicles()
+                exported = t.perf_counter()
+                print("Cycle %d/%d" % (i,self.simulationCycles), end="\r")
+                if logger is not None:
+                    logger.addArrivals(retired)
+                    logger.logCycle(i, time, logOrder)
+                logged = t.perf_counter()
+                cycleTimes = {Simulation.PHASE_INJECT: injected - start, Simulation.PHASE_MOVE: moved - injected, Simulation.PHASE_HISTORY: saved - moved, Simulation.PHASE_EXPORT: exported - saved, Simulation.PHASE_LOG: logged - exported}
+                for phase, seconds in cycleTimes.items():
+                    phaseTimes[phase] += seconds
+                if self.profiler is not None:
+                    self.profiler.recordCycle(time, cycleTimes)
+                if self.onCycle is not None:
+                    self.onCycle(self, time)
+                self.nextCycle = i + 1
+                if checkpoints is not None and self.nextCycle % self.checkpointInterval == 0 and self.nextCycle < self.simulationCycles:
+                    start = t.perf_counter()
+                    checkpoints.write(self)
+                    phaseTimes[Simulation.PHASE_EXPORT] += t.perf_counter() - start
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop() #the counted helpers are restored even if the run fails
+            if logger is not None:
+                logger.close() #the cycles still in the queue are written
+            if checkpoints is not None:
+                checkpoints.wait() #the last checkpoint is completed even if the run fails, an error writing it is raised
+        if self.nextCycle < self.simulationCycles: #stopped before the end, the files are continued by resume
+            if self.historyWriter is not None:
+                self.historyWriter.suspend()
+            print("Simulation stopped at cycle %d/%d" % (self.nextCycle, self.simulationCycles))
+            return
         print("Simulation finished")
         print("Saving data...")
         if self.log:
+            f = open(vehMetricsFile, "w+")
+            #f3 = open(vehHistoryMetricsFile, "w+")
             print("VEHICLES METRICS:", file=f)
             for vehicle in self.vehicles:
                 if vehicle.isArrived():
@@ -165,96 +318,218 @@ class Simulation:
                     #print(Vehicle.getVehicleStateHistoryMetricsAsJSON(vehicle), file=f3, end=",\n")
             print()
             print("Simulation duration: %ds" % (self.simulationCycles * self.timeStep), file=f)
-            print(Vehicle.getVehiclesMetricsAsString(self.vehicles), file=f)
-        self.history.saveHistory(mapHistoryFile)
-        self.history.saveMetrics(roadsMetricsJsonFile)
-        Vehicle.saveVehiclesStateHistoryGroupedByTime(self.vehicles, vehHistoryMetricsFile)
-        abspath = os.path.abspath(vehHistoryMetricsFile)
-        print("Data saved to %s" % abspath)
+            print(Vehicle.getMetricsTupleAsString(self.getVehiclesMetrics()), file=f)
+        if self.saveOutput:
+            start = t.perf_counter()
+            self.history.saveHistory(mapHistoryFile)
+            self.history.saveMetrics(roadsMetricsJsonFile)
+            self.historyWriter.close()
+            phaseTimes[Simulation.PHASE_EXPORT] += t.perf_counter() - start
+            if self.profiler is not None:
+                self.profiler.saveReport(profileFile)
+            abspath = os.path.abspath(vehHistoryMetricsFile)
+            print("Data saved to %s" % abspath)
         if self.log:
             f.close()
-            f2.close()
             #f3.close()
 
-    def getSimulationFromJSON(filename):
-        if not Path(filename).is_file():
+    def resume(self, lastCycle = None): #continues the run of a simulation loaded with loadCheckpoint, or stopped by simulate, from the cycle after the checkpoint
+        self.simulate(self.nextCycle, lastCycle)
+
+    def loadCheckpoint(filename): #returns the simulation saved in a checkpoint file (see checkpoint.py)
+        from checkpoint import loadCheckpoint
+        return loadCheckpoint(filename)
+
+    def getVehiclesMetrics(self): #same tuple of Vehicle.getVehiclesMetrics, from the retired vehicles and the ones still on the network; the medians are estimated (see metrics.py)
+        return self.vehicleMetrics.getMetrics(list(self.activeVehicles))
+
+    def getMetrics(self): #metrics of the last run, or of the current one so far: the vehicles metrics (see getVehiclesMetrics) and the metrics of each road (see RoadHistory.getMetrics)
+        return {
+            Simulation.VEHICLES_STRING: Vehicle.getMetricsTupleAsJSON(self.getVehiclesMetrics()),
+            Simulation.ROADS_STRING: self.history.getMetrics()["metrics"]
+        }
+
+    def getSignalPlan(self): #state of all the semaphores of the map at any time, e.g. for the visualizer (see signals.SignalPlan)
+        from signals import SignalPlan # numpy is only imported if the signal plan is used
+        return SignalPlan(self.roads)
+
+    def getSimulationFromJSON(filename, useCache = True): #with useCache the built simulation is loaded from the scenario cache, or saved in it (see cache.py)
+        if not os.path.isfile(filename):
             print("File %s does not exist" % filename)
             return
-        # check JSON schema here
+        with open(filename, "rb") as f:
+            scenario = f.read()
+        cache = None
+        if useCache:
+            from cache import ScenarioCache # the cache is only imported if it's used
+            cache = ScenarioCache()
+            key = cache.getKey(scenario, Simulation.getSchemaSource())
+            simulation = cache.load(key)
+            if simulation is not None:
+                return simulation
+        import jsonschema # only imported when a scenario is validated, the runs of a cached scenario don't need it
+        gcEnabled = gc.isenabled()
+        gc.disable() #the map is made of many objects that live until the end of the run, collecting while they are created only wastes time
         try:
-            jsonschema.validate(instance=json.load(open(filename, "r")), schema=json.load(open("simulation_schema.json", "r")))
+            # check JSON schema here
+            data = json.loads(scenario)
+            Simulation.validateJSON(data)
+            simulation = Simulation.getSimulationFromDict(data)
         except jsonschema.exceptions.ValidationError as e:
             print("well-formed but invalid JSON:", e)
             return
         except json.decoder.JSONDecodeError as e:
             print("poorly-formed text, not JSON:", e)
             return
-        with open(filename, "r") as f:
-            data = json.load(f)
-            simInfo = data[Simulation.SIMULATION_INFO_STRING]
-            simName = simInfo[Simulation.SIMULATION_NAME_STRING]
-            simCycles = simInfo[Simulation.SIMULATION_CYCLES_STRING]
-            timeStep = simInfo[Simulation.TIME_STEP_STRING] if Simulation.TIME_STEP_STRING in simInfo else 1
-            vehicleInjectionRate = simInfo[Simulation.VEHICLE_INJECTION_RATE_STRING] if Simulation.VEHICLE_INJECTION_RATE_STRING in simInfo else 1
-            sectorLength = simInfo[Simulation.SECTOR_LENGTH_STRING]
-            simulation = Simulation(simCycles, timeStep, vehicleInjectionRate, sectorLength, simName)
+        finally:
+            if gcEnabled:
+                gc.enable()
+        if cache is not None:
+            try:
+                cache.save(key, simulation)
+            except OSError as e: #the simulation can run anyway
+                print("Could not save the scenario in the cache:", e)
+        return simulation
+
+    def getSchemaSource(): #content of the schema file, read only once
+        if Simulation.schemaSource is None:
+            with open(Simulation.SCHEMA_FILENAME, "rb") as f:
+                Simulation.schemaSource = f.read()
+        return Simulation.schemaSource
+
+    def validateJSON(data): #raises jsonschema.exceptions.ValidationError if the data doesn't follow the schema, which is loaded only once
+        import jsonschema
+        if Simulation.schema is None:
+            Simulation.schema = json.loads(Simulation.getSchemaSource())
+        jsonschema.validate(instance=data, schema=Simulation.schema)
 
-            for vehicle in data[Simulation.VEHICLES_STRING]:
-                len = vehicle[Simulation.VEHICLE_LENGTH_STRING]
-                initialPos = vehicle[Simulation.VEHICLE_INITIAL_POS_STRING] if Simulation.VEHICLE_INITIAL_POS_STRING in vehicle else 0
-                initialSpeed = vehicle[Simulation.VEHICLE_INITIAL_SPEED_STRING]
-                initialAcceleration = vehicle[Simulation.VEHICLE_INITIAL_ACCELERATION_STRING]
-                maxSpeed = vehicle[Simulation.VEHICLE_MAX_SPEED_STRING]
-                maxAcceleration = vehicle[Simulation.VEHICLE_MAX_ACCELERATION_STRING]
-                creationTime = vehicle[Simulation.VEHICLE_CREATION_TIME_STRING] if Simulation.VEHICLE_CREATION_TIME_STRING in vehicle else 0
-                sigma = vehicle[Simulation.VEHICLE_SIGMA_STRING] if Simulation.VEHICLE_SIGMA_STRING in vehicle else 0.0
-                reactionTime = vehicle[Simulation.VEHICLE_REACTION_TIME_STRING] if Simulation.VEHICLE_REACTION_TIME_STRING in vehicle else 1.0
-                reactionTimeAtSemaphore = vehicle[Simulation.VEHICLE_REACTION_TIME_AT_SEMAPHORE_STRING] if Simulation.VEHICLE_REACTION_TIME_AT_SEMAPHORE_STRING in vehicle else 1.0
-                dampingFactor = vehicle[Simulation.VEHICLE_DAMPING_FACTOR_STRING] if Simulation.VEHICLE_DAMPING_FACTOR_STRING in vehicle else 0.18
-                simulation.addVehicleType(len, initialPos, initialSpeed, initialAcceleration, maxSpeed, maxAcceleration, creationTime, sigma, reactionTime, reactionTimeAtSemaphore, dampingFactor)
+    def getSimulationFromDict(data): #builds the simulation from the already parsed and validated JSON configuration
+        simInfo = data[Simulation.SIMULATION_INFO_STRING]
+        simName = simInfo[Simulation.SIMULATION_NAME_STRING]
+        simCycles = simInfo[Simulation.SIMULATION_CYCLES_STRING]
+        timeStep = simInfo[Simulation.TIME_STEP_STRING] if Simulation.TIME_STEP_STRING in simInfo else 1
+        vehicleInjectionRate = simInfo[Simulation.VEHICLE_INJECTION_RATE_STRING] if Simulation.VEHICLE_INJECTION_RATE_STRING in simInfo else 1
+        sectorLength = simInfo[Simulation.SECTOR_LENGTH_STRING]
+        vehicleHistoryFormat = simInfo[Simulation.VEHICLE_HISTORY_FORMAT_STRING] if Simulation.VEHICLE_HISTORY_FORMAT_STRING in simInfo else VehicleHistoryWriter.MODE_JSON
+        kinematicsEngine = simInfo[Simulation.KINEMATICS_ENGINE_STRING] if Simulation.KINEMATICS_ENGINE_STRING in simInfo else Simulation.ENGINE_SCALAR
+        historySampleInterval = simInfo[Simulation.HISTORY_SAMPLE_INTERVAL_STRING] if Simulation.HISTORY_SAMPLE_INTERVAL_STRING in simInfo else 0
+        historyWindow = simInfo[Simulation.HISTORY_WINDOW_STRING] if Simulation.HISTORY_WINDOW_STRING in simInfo else None
+        seed = simInfo[Simulation.SEED_STRING] if Simulation.SEED_STRING in simInfo else None
+        regions = simInfo[Simulation.REGIONS_STRING] if Simulation.REGIONS_STRING in simInfo else 1
+        log = simInfo[Simulation.LOG_STRING] if Simulation.LOG_STRING in simInfo else False
+        simulation = Simulation(simCycles, timeStep, vehicleInjectionRate, sectorLength, simName, log, vehicleHistoryFormat, kinematicsEngine, historySampleInterval, historyWindow, seed, True, regions)
+        simulation.logLevel = simInfo.get(Simulation.LOG_LEVEL_STRING, simulation.logLevel)
+        simulation.logInterval = simInfo.get(Simulation.LOG_INTERVAL_STRING, simulation.logInterval)
+        simulation.checkpointInterval = simInfo.get(Simulation.CHECKPOINT_INTERVAL_STRING, simulation.checkpointInterval)
+        if simInfo.get(Simulation.PROFILE_STRING, False):
+            simulation.enableProfiling(simInfo.get(Simulation.PROFILE_TIME_SERIES_STRING, False))
 
-            for road in data[Simulation.ROADS_STRING]:
-                length = road[Simulation.ROAD_LENGTH_STRING]
-                vehicleDistance = road[Simulation.ROAD_VEHICLE_DISTANCE_STRING]
-                speedLimit = road[Simulation.ROAD_SPEED_LIMIT_STRING]
-                isStartingRoad = road[Simulation.ROAD_IS_STARTING_ROAD_STRING] if Simulation.ROAD_IS_STARTING_ROAD_STRING in road else False
-                simulation.addRoad(length, vehicleDistance, speedLimit, isStartingRoad)
-            
-            for semaphore in data[Simulation.SEMAPHORES_STRING]:
-                position = semaphore[Simulation.SEMAPHORE_POSITION_STRING]
-                greenLight = semaphore[Simulation.SEMAPHORE_GREEN_LIGHT_STRING]
-                redLight = semaphore[Simulation.SEMAPHORE_RED_LIGHT_STRING]
-                yellowLight = semaphore[Simulation.SEMAPHORE_YELLOW_LIGHT_STRING] if Simulation.SEMAPHORE_YELLOW_LIGHT_STRING in semaphore else 0
-                startTime = semaphore[Simulation.SEMAPHORE_START_TIME_STRING]
-                roadId = semaphore[Simulation.SEMAPHORE_ROAD_ID_STRING]
-                road = next((road for road in simulation.roads if road.id == roadId), None)
-                simulation.addSemaphore(road, greenLight, redLight, position, yellowLight, startTime)
+        for vehicle in data[Simulation.VEHICLES_STRING]:
+            len = vehicle[Simulation.VEHICLE_LENGTH_STRING]
+            initialPos = vehicle[Simulation.VEHICLE_INITIAL_POS_STRING] if Simulation.VEHICLE_INITIAL_POS_STRING in vehicle else 0
+            initialSpeed = vehicle[Simulation.VEHICLE_INITIAL_SPEED_STRING]
+            initialAcceleration = vehicle[Simulation.VEHICLE_INITIAL_ACCELERATION_STRING]
+            maxSpeed = vehicle[Simulation.VEHICLE_MAX_SPEED_STRING]
+            maxAcceleration = vehicle[Simulation.VEHICLE_MAX_ACCELERATION_STRING]
+            creationTime = vehicle[Simulation.VEHICLE_CREATION_TIME_STRING] if Simulation.VEHICLE_CREATION_TIME_STRING in vehicle else 0
+            sigma = vehicle[Simulation.VEHICLE_SIGMA_STRING] if Simulation.VEHICLE_SIGMA_STRING in vehicle else 0.0
+            reactionTime = vehicle[Simulation.VEHICLE_REACTION_TIME_STRING] if Simulation.VEHICLE_REACTION_TIME_STRING in vehicle else 1.0
+            reactionTimeAtSemaphore = vehicle[Simulation.VEHICLE_REACTION_TIME_AT_SEMAPHORE_STRING] if Simulation.VEHICLE_REACTION_TIME_AT_SEMAPHORE_STRING in vehicle else 1.0
+            dampingFactor = vehicle[Simulation.VEHICLE_DAMPING_FACTOR_STRING] if Simulation.VEHICLE_DAMPING_FACTOR_STRING in vehicle else 0.18
+            simulation.addVehicleType(len, initialPos, initialSpeed, initialAcceleration, maxSpeed, maxAcceleration, creationTime, sigma, reactionTime, reactionTimeAtSemaphore, dampingFactor)
 
-            for intersection in data[Simulation.INTERSECTIONS_STRING]:
-                inRoads = intersection[Simulation.INTERSECTION_INCOMING_ROADS_STRING]
-                outRoads = intersection[Simulation.INTERSECTION_OUTGOING_ROADS_STRING]
-                outFluxes = intersection[Simulation.INTERSECTION_OUT_FLUXES_STRING]
-                inRoads = []
-                for r in inRoads:
-                    inRoads.append(next((road for road in simulation.roads if road.id == r), None))
-                outRoads = []
-                for r in outRoads:
-                    outRoads.append(next((road for road in simulation.roads if road.id == r), None))
-                simulation.addIntersection(inRoads, outRoads, outFluxes)
+        roadsById = {} #the ids in the JSON file can differ from the ids given by addRoad
+        for road in data[Simulation.ROADS_STRING]:
+            length = road[Simulation.ROAD_LENGTH_STRING]
+            vehicleDistance = road[Simulation.ROAD_VEHICLE_DISTANCE_STRING]
+            speedLimit = road[Simulation.ROAD_SPEED_LIMIT_STRING]
+            isStartingRoad = road[Simulation.ROAD_IS_STARTING_ROAD_STRING] if Simulation.ROAD_IS_STARTING_ROAD_STRING in road else False
+            newRoad = simulation.addRoad(length, vehicleDistance, speedLimit, isStartingRoad)
+            roadsById[road[Simulation.ROAD_ID_STRING] if Simulation.ROAD_ID_STRING in road else newRoad.id] = newRoad
+        
+        for semaphore in data[Simulation.SEMAPHORES_STRING]:
+            position = semaphore[Simulation.SEMAPHORE_POSITION_STRING]
+            greenLight = semaphore[Simulation.SEMAPHORE_GREEN_LIGHT_STRING]
+            redLight = semaphore[Simulation.SEMAPHORE_RED_LIGHT_STRING]
+            yellowLight = semaphore[Simulation.SEMAPHORE_YELLOW_LIGHT_STRING] if Simulation.SEMAPHORE_YELLOW_LIGHT_STRING in semaphore else 0
+            startTime = semaphore[Simulation.SEMAPHORE_START_TIME_STRING]
+            roadId = semaphore[Simulation.SEMAPHORE_ROAD_ID_STRING]
+            road = Simulation.getRoadFromId(roadsById, roadId, "semaphore")
+            simulation.addSemaphore(road, greenLight, redLight, position, yellowLight, startTime)
 
-            return simulation
+        for intersection in data[Simulation.INTERSECTIONS_STRING]:
+            inRoadIds = intersection[Simulation.INTERSECTION_INCOMING_ROADS_STRING]
+            outRoadIds = intersection[Simulation.INTERSECTION_OUTGOING_ROADS_STRING]
+            outFluxes = intersection[Simulation.INTERSECTION_OUT_FLUXES_STRING]
+            inRoads = [Simulation.getRoadFromId(roadsById, r, "intersection") for r in inRoadIds]
+            outRoads = [Simulation.getRoadFromId(roadsById, r, "intersection") for r in outRoadIds]
+            simulation.addIntersection(inRoads, outRoads, outFluxes)
+
+        return simulation
+
+    def getRoadFromId(roadsById, roadId, element): #raises ValueError if no road in the configuration has the given id
+        if roadId not in roadsById:
+            raise ValueError("%s refers to road %s, but there is no road with this id (road ids: %s)" % (element, roadId, sorted(roadsById)))
+        return roadsById[roadId]
 
 #This is the main function that reads the JSON configuration file and runs the simulation
+# Worker mode: runs the scenario files whose paths are read from the input, one per line, in this process, until the end of the input,
+# so the interpreter starts and the modules are imported only once for many short runs. The prints of the simulations are discarded
+# and a JSON line is written to the output for each scenario: {"scenario": path, "ok": true, "wallTime": seconds} or {"scenario": path, "ok": false, "error": message}
+def runWorker(useCache = True, input = sys.stdin, output = sys.stdout):
+    import contextlib # only needed by the worker mode
+    import io
+    for line in input:
+        filename = line.strip()
+        if not filename:
+            continue
+        result = {"scenario": filename}
+        start = t.perf_counter()
+        try:
+            messages = io.StringIO()
+            with contextlib.redirect_stdout(messages):
+                simulation = Simulation.getSimulationFromJSON(filename, useCache)
+            if simulation is None: #the reason was printed by getSimulationFromJSON
+                raise ValueError(messages.getvalue().strip().splitlines()[0] if messages.getvalue().strip() else "invalid scenario")
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                simulation.simulate()
+            result["ok"] = True
+            result["wallTime"] = t.perf_counter() - start
+        except Exception as e:
+            result["ok"] = False
+            result["error"] = str(e)
+        print(json.dumps(result), file=output, flush=True)
+
+#Usage: python simulate.py simulation.json [--no-cache] [--clear-cache]
+#       python simulate.py --resume checkpoint.pickle
+#       python simulate.py --worker [--no-cache] < scenario paths
+#       python simulate.py --clear-cache
 def main(argv):
+    if "--clear-cache" in argv:
+        from cache import ScenarioCache
+        print("Removed %d cached scenarios" % ScenarioCache().clear())
+        argv = [arg for arg in argv if arg != "--clear-cache"]
+        if not argv:
+            return
     if len(argv) < 1:
         print("Please provide the filename of a JSON file with the simulation configuration")
         return
+    useCache = "--no-cache" not in argv
+    if argv[0] == "--worker":
+        runWorker(useCache)
+        return
     try:
-        simulation = Simulation.getSimulationFromJSON(argv[0])
+        if argv[0] == "--resume":
+            if len(argv) < 2:
+                print("Please provide the filename of a checkpoint")
+                return
+            Simulation.loadCheckpoint(argv[1]).resume()
+            return
+        simulation = Simulation.getSimulationFromJSON(argv[0], useCache)
         simulation.simulate()
     except Exception as e:
         print("Error:", e)
 
 if __name__ == "__main__":
     args = sys.argv[1:]
-    main(args)
\ No newline at end of file
+    main(args)
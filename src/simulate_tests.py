@@ -31,92 +31,123 @@ dampingFactor = 0.18 # fattore di smorzamento per il calcolo dei tempi di reazio
 sigma = 0.00
 vehicleDistance = 1.0
 
-#The following functions are used to simulate the scenarios described in the report without using the JSON configuration file
-def single_road():
-    simulationName = "1_single_road_sim"
-    simulation = Simulation(simulationCycles, timeStep, injectingRateForRoad, roadLength / sectorsPerRoad, simulationName)
-    road = simulation.addRoad(singleRoadLen, vehicleDistance, speedLimit, True)
-    road.setShape(Shape([Coordinates(0,0), Coordinates(singleRoadLen,0)]))
-    simulation.addVehicleType(vehicleLength, startingPosition, minVehicleSpeed, 0, maxVehicleSpeed, maxAcceleration, 0, sigma, reactionTime, reactionTimeAtSemaphore, dampingFactor)
-    simulation.simulate()
+#The following functions build the scenarios described in the report without using the JSON configuration file.
+#The builders can be scaled for the benchmarks (see benchmark.py): cycles, injectionRate and length (of the roads) default to the values of the report,
+#and the network of the scenario is repeated copies times, side by side, so the number of roads is copies times the roads of the scenario
+def new_simulation(simulationName, cycles, injectionRate):
+    return Simulation(cycles, timeStep, injectionRate, roadLength / sectorsPerRoad, simulationName)
 
-def single_road_semaphore():
-    simulationName = "2_single_road_semaphore_sim"
-    simulation = Simulation(simulationCycles, timeStep, injectingRateForRoad, roadLength / sectorsPerRoad, simulationName)
-    semaphore = Semaphore(greenLight, redLight, 800, 0, 0)
-    road = simulation.addRoad(singleRoadLen, vehicleDistance, speedLimit, True)
-    road.setShape(Shape([Coordinates(0,0), Coordinates(singleRoadLen,0)]))
-    road.addSemaphore(semaphore)
+def add_vehicle_type(simulation):
     simulation.addVehicleType(vehicleLength, startingPosition, minVehicleSpeed, 0, maxVehicleSpeed, maxAcceleration, 0, sigma, reactionTime, reactionTimeAtSemaphore, dampingFactor)
-    simulation.simulate()
 
-def merge_sem():
+def build_single_road(cycles = None, injectionRate = None, length = None, copies = 1):
+    length = length if length is not None else singleRoadLen
+    simulation = new_simulation("1_single_road_sim", cycles or simulationCycles, injectionRate or injectingRateForRoad)
+    for copy in range(copies):
+        y = copy * length / 2 #distance between the copies of the network
+        road = simulation.addRoad(length, vehicleDistance, speedLimit, True)
+        road.setShape(Shape([Coordinates(0,y), Coordinates(length,y)]))
+    add_vehicle_type(simulation)
+    return simulation
+
+def build_single_road_semaphore(cycles = None, injectionRate = None, length = None, copies = 1):
+    length = length if length is not None else singleRoadLen
+    simulation = new_simulation("2_single_road_semaphore_sim", cycles or simulationCycles, injectionRate or injectingRateForRoad)
+    for copy in range(copies):
+        y = copy * length / 2
+        semaphore = Semaphore(greenLight, redLight, length * 4 // 5, 0, 0)
+        road = simulation.addRoad(length, vehicleDistance, speedLimit, True)
+        road.setShape(Shape([Coordinates(0,y), Coordinates(length,y)]))
+        road.addSemaphore(semaphore)
+    add_vehicle_type(simulation)
+    return simulation
+
+def build_merge_sem(cycles = None, injectionRate = None, length = None, copies = 1):
     green = 30
     red = 30
     delay1 = red
-    simulationName = "4_merge_sem_sim"
     n_roads = 2
-    injectionRate = 5
-    simulationCycles = 10
-    simulation = Simulation(simulationCycles, timeStep, injectionRate, roadLength / sectorsPerRoad, simulationName)
-    semaphore1 = Semaphore(green, red, roadLength, 0, delay1)
-    semaphore2 = Semaphore(green, red, roadLength, 0, 0)
-    inRoads = simulation.addRoads(roadLength, vehicleDistance, speedLimit, n_roads, True)
-    inRoads[0].setShape(Shape([Coordinates(0,roadLength/(2**0.5)), Coordinates(roadLength/(2**0.5),0)]))
-    inRoads[1].setShape(Shape([Coordinates(0,-roadLength/(2**0.5)), Coordinates(roadLength/(2**0.5),0)]))
-    inRoads[0].addSemaphore(semaphore1)
-    inRoads[1].addSemaphore(semaphore2)
-    outRoads = simulation.addRoads(roadLength, vehicleDistance, speedLimit, 1)
-    outRoads[0].setShape(Shape([Coordinates(roadLength/(2**0.5),0), Coordinates(2*roadLength,0)]))
-    print("Road 1) from x: %d, y: %d to x: %d, y: %d" % (0, roadLength/(2**0.5), roadLength, 0))
-    print("Road 2) from x: %d, y: %d to x: %d, y: %d" % (0, -roadLength/(2**0.5), roadLength, 0))
-    print("Road 3) from x: %d, y: %d to x: %d, y: %d" % (roadLength, 0, 2*roadLength, 0))
-    merge = simulation.addIntersection(inRoads, outRoads, [1])
-    simulation.addVehicleType(vehicleLength, startingPosition, minVehicleSpeed, 0, maxVehicleSpeed, maxAcceleration, 0, sigma, reactionTime, reactionTimeAtSemaphore, dampingFactor)
-    simulation.simulate()
+    length = length if length is not None else roadLength
+    simulation = new_simulation("4_merge_sem_sim", cycles or 10, injectionRate or 5)
+    for copy in range(copies):
+        y = copy * 3 * length
+        semaphore1 = Semaphore(green, red, length, 0, delay1)
+        semaphore2 = Semaphore(green, red, length, 0, 0)
+        inRoads = simulation.addRoads(length, vehicleDistance, speedLimit, n_roads, True)
+        inRoads[0].setShape(Shape([Coordinates(0,y+length/(2**0.5)), Coordinates(length/(2**0.5),y)]))
+        inRoads[1].setShape(Shape([Coordinates(0,y-length/(2**0.5)), Coordinates(length/(2**0.5),y)]))
+        inRoads[0].addSemaphore(semaphore1)
+        inRoads[1].addSemaphore(semaphore2)
+        outRoads = simulation.addRoads(length, vehicleDistance, speedLimit, 1)
+        outRoads[0].setShape(Shape([Coordinates(length/(2**0.5),y), Coordinates(2*length,y)]))
+        if copy == 0:
+            print("Road 1) from x: %d, y: %d to x: %d, y: %d" % (0, length/(2**0.5), length, 0))
+            print("Road 2) from x: %d, y: %d to x: %d, y: %d" % (0, -length/(2**0.5), length, 0))
+            print("Road 3) from x: %d, y: %d to x: %d, y: %d" % (length, 0, 2*length, 0))
+        merge = simulation.addIntersection(inRoads, outRoads, [1])
+    add_vehicle_type(simulation)
+    return simulation
+
+def add_bifurcation(simulation, length, y, fluxes, semaphore = None): #one copy of the bifurcation network
+    inroads = simulation.addRoads(length, vehicleDistance, speedLimit, 1, True)
+    inroads[0].setShape(Shape([Coordinates(0,y), Coordinates(length,y)]))
+    if semaphore is not None:
+        inroads[0].addSemaphore(semaphore)
+    outroads = simulation.addRoads(length, vehicleDistance, speedLimit, 2)
+    outroads[0].setShape(Shape([Coordinates(length,y), Coordinates(length+length/(2**0.5),y+length/(2**0.5))]))
+    outroads[1].setShape(Shape([Coordinates(length,y), Coordinates(length+length/(2**0.5),y-length/(2**0.5))]))
+    return simulation.addIntersection(inroads, outroads, fluxes)
+
+def build_bifurcation(cycles = None, injectionRate = None, length = None, copies = 1):
+    length = length if length is not None else roadLength
+    simulation = new_simulation("3_bifurcation_sim", cycles or simulationCycles, injectionRate or 3)
+    for copy in range(copies):
+        add_bifurcation(simulation, length, copy * 3 * length, [0.8, 0.2])
+    add_vehicle_type(simulation)
+    return simulation
+
+def build_bifurcation_sem(cycles = None, injectionRate = None, length = None, copies = 1):
+    length = length if length is not None else roadLength
+    simulation = new_simulation("5_bifurcation_sem_sim", cycles or simulationCycles, injectionRate or 5)
+    for copy in range(copies):
+        add_bifurcation(simulation, length, copy * 3 * length, [0.5, 0.5], Semaphore(greenLight, redLight, length, 0, 0))
+    add_vehicle_type(simulation)
+    return simulation
+
+def build_bifurcation_sem_high_flow(cycles = None, injectionRate = None, length = None, copies = 1):
+    length = length if length is not None else roadLength
+    simulation = new_simulation("6_bifurcation_sem_high_flow_sim", cycles or simulationCycles, injectionRate or 2)
+    for copy in range(copies):
+        add_bifurcation(simulation, length, copy * 3 * length, [0.5, 0.5], Semaphore(greenLight, redLight, length, 0, 0))
+    add_vehicle_type(simulation)
+    return simulation
+
+SCENARIOS = {
+    "single_road": build_single_road,
+    "single_road_semaphore": build_single_road_semaphore,
+    "bifurcation": build_bifurcation,
+    "merge_sem": build_merge_sem,
+    "bifurcation_sem": build_bifurcation_sem,
+    "bifurcation_sem_high_flow": build_bifurcation_sem_high_flow
+}
+
+def single_road():
+    build_single_road().simulate()
+
+def single_road_semaphore():
+    build_single_road_semaphore().simulate()
+
+def merge_sem():
+    build_merge_sem().simulate()
 
 def bifurcation():
-    simulationName = "3_bifurcation_sim"
-    injectingRate = 3
-    simulation = Simulation(simulationCycles, timeStep, injectingRate, roadLength / sectorsPerRoad, simulationName)
-    inroads = simulation.addRoads(roadLength, vehicleDistance, speedLimit, 1, True)
-    inroads[0].setShape(Shape([Coordinates(0,0), Coordinates(roadLength,0)]))
-    outroads = simulation.addRoads(roadLength, vehicleDistance, speedLimit, 2)
-    outroads[0].setShape(Shape([Coordinates(roadLength,0), Coordinates(roadLength+roadLength/(2**0.5),roadLength/(2**0.5))]))
-    outroads[1].setShape(Shape([Coordinates(roadLength,0), Coordinates(roadLength+roadLength/(2**0.5),-roadLength/(2**0.5))]))
-    bifurcation = simulation.addIntersection(inroads, outroads, [0.8, 0.2])
-    simulation.addVehicleType(vehicleLength, startingPosition, minVehicleSpeed, 0, maxVehicleSpeed, maxAcceleration, 0, sigma, reactionTime, reactionTimeAtSemaphore, dampingFactor)
-    simulation.simulate()
+    build_bifurcation().simulate()
 
 def bifurcation_sem():
-    simulationName = "5_bifurcation_sem_sim"
-    injectionRate = 5
-    simulation = Simulation(simulationCycles, timeStep, injectionRate, roadLength / sectorsPerRoad, simulationName)
-    semaphore = Semaphore(greenLight, redLight, 500, 0, 0)
-    inroads = simulation.addRoads(roadLength, vehicleDistance, speedLimit, 1, True)
-    inroads[0].setShape(Shape([Coordinates(0,0), Coordinates(roadLength,0)]))
-    inroads[0].addSemaphore(semaphore)
-    outroads = simulation.addRoads(roadLength, vehicleDistance, speedLimit, 2)
-    outroads[0].setShape(Shape([Coordinates(roadLength,0), Coordinates(roadLength+roadLength/(2**0.5),roadLength/(2**0.5))]))
-    outroads[1].setShape(Shape([Coordinates(roadLength,0), Coordinates(roadLength+roadLength/(2**0.5),-roadLength/(2**0.5))]))
-    bifurcation = simulation.addIntersection(inroads, outroads, [0.5, 0.5])
-    simulation.addVehicleType(vehicleLength, startingPosition, minVehicleSpeed, 0, maxVehicleSpeed, maxAcceleration, 0, sigma, reactionTime, reactionTimeAtSemaphore, dampingFactor)
-    simulation.simulate()
+    build_bifurcation_sem().simulate()
 
 def bifurcation_sem_high_flow():
-    simulationName = "6_bifurcation_sem_high_flow_sim"
-    injectionRate = 2
-    simulation = Simulation(simulationCycles, timeStep, injectionRate, roadLength / sectorsPerRoad, simulationName)
-    semaphore = Semaphore(greenLight, redLight, 500, 0, 0)
-    inroads = simulation.addRoads(roadLength, vehicleDistance, speedLimit, 1, True)
-    inroads[0].setShape(Shape([Coordinates(0,0), Coordinates(roadLength,0)]))
-    inroads[0].addSemaphore(semaphore)
-    outroads = simulation.addRoads(roadLength, vehicleDistance, speedLimit, 2)
-    outroads[0].setShape(Shape([Coordinates(roadLength,0), Coordinates(roadLength+roadLength/(2**0.5),roadLength/(2**0.5))]))
-    outroads[1].setShape(Shape([Coordinates(roadLength,0), Coordinates(roadLength+roadLength/(2**0.5),-roadLength/(2**0.5))]))
-    bifurcation = simulation.addIntersection(inroads, outroads, [0.5, 0.5])
-    simulation.addVehicleType(vehicleLength, startingPosition, minVehicleSpeed, 0, maxVehicleSpeed, maxAcceleration, 0, sigma, reactionTime, reactionTimeAtSemaphore, dampingFactor)
-    simulation.simulate()
+    build_bifurcation_sem_high_flow().simulate()
 
 '''def road_different_speeds():
     simulationName = "7_road_different_speeds_sim"
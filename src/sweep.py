@@ -0,0 +1,156 @@
+"""
+@file    sweep.py
+@authors  David Megli
+
+Description:
+This file runs a parameter sweep over a simulation configuration, e.g. to tune the semaphores timings or the vehicle injection rate.
+The base configuration is parsed and validated once; every variant is a copy of the parsed configuration with some fields changed,
+built with Simulation.getSimulationFromDict (no file reading and no schema loading) and run in a process pool.
+A field is identified by its path in the JSON configuration, with the keys and list indexes separated by dots, e.g. "semaphores.0.greenLight" or "simulation.vehicleInjectionRate".
+The variants are a grid (every combination of the given values) or a random search (a given number of random samples).
+The parameters and the metrics of all the variants are saved in a single CSV table, one row per variant.
+Usage: python sweep.py sweep.json [workers]
+The sweep file contains the scenario, the mode ("grid" or "random"), the parameters and optionally the number of samples, the seed of the random search and the seed of the simulations:
+{"scenario": "simulation.json", "mode": "grid", "parameters": {"semaphores.0.greenLight": [30, 40, 50], "simulation.vehicleInjectionRate": [1, 2]}}
+In random mode a parameter is a list of values to choose from or a range {"min": 1, "max": 4}, integer if both bounds are integers.
+"""
+import copy
+import csv
+import contextlib
+import itertools
+import json
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from simulate import Simulation
+from montecarlo import flattenMetrics
+
+MODE_GRID = "grid"
+MODE_RANDOM = "random"
+SCENARIO_STRING = "scenario"
+MODE_STRING = "mode"
+PARAMETERS_STRING = "parameters"
+SAMPLES_STRING = "samples"
+SWEEP_SEED_STRING = "seed"
+SIMULATION_SEED_STRING = "simulationSeed"
+RANGE_MIN_STRING = "min"
+RANGE_MAX_STRING = "max"
+PATH_SEPARATOR = "."
+VARIANT_COLUMN = "variant"
+
+# Sets the value of the field with the given path, raises ValueError if the path doesn't exist in the configuration
+def setParameter(data, path, value):
+    keys = path.split(PATH_SEPARATOR)
+    node = data
+    for i, key in enumerate(keys):
+        if isinstance(node, list):
+            key = int(key) if key.isdigit() else None
+            exists = key is not None and key < len(node)
+        else:
+            exists = isinstance(node, dict) and key in node
+        if not exists and not (i == len(keys) - 1 and isinstance(node, dict)): #a missing optional field can be added
+            raise ValueError("Unknown parameter: %s" % path)
+        if i == len(keys) - 1:
+            node[key] = value
+        else:
+            node = node[key]
+
+def gridVariants(parameters): #every combination of the values of the parameters, as a list of dictionaries path -> value
+    paths = list(parameters.keys())
+    return [dict(zip(paths, values)) for values in itertools.product(*[parameters[path] for path in paths])]
+
+def randomVariants(parameters, samples, seed = None):
+    rng = random.Random(seed) #own generator, the one of the simulation is not touched
+    variants = []
+    for _ in range(samples):
+        variant = {}
+        for path, space in parameters.items():
+            if isinstance(space, dict):
+                low, high = space[RANGE_MIN_STRING], space[RANGE_MAX_STRING]
+                variant[path] = rng.randint(low, high) if isinstance(low, int) and isinstance(high, int) else rng.uniform(low, high)
+            else:
+                variant[path] = rng.choice(space)
+        variants.append(variant)
+    return variants
+
+# Returns a copy of the base configuration with the parameters of the variant, validated against the (cached) schema
+def getVariantData(baseData, variant):
+    data = copy.deepcopy(baseData)
+    for path, value in variant.items():
+        setParameter(data, path, value)
+    Simulation.validateJSON(data)
+    return data
+
+# Runs a variant in the worker process and returns its metrics as a flat dictionary. The simulation prints are discarded
+def runVariant(data, seed = None):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        simulation = Simulation.getSimulationFromDict(data)
+        if seed is not None:
+            simulation.seed = seed
+        simulation.saveOutput = False
+        simulation.log = False #the parallel runs would write the same log file
+        simulation.simulate()
+    return flattenMetrics(simulation.getMetrics())
+
+# Runs the variants in a process pool and returns the rows of the results table, in the order of the variants
+def runSweep(baseData, variants, workers = None, seed = None):
+    datas = [getVariantData(baseData, variant) for variant in variants] #invalid variants are reported before running anything
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(runVariant, data, seed) for data in datas]
+        rows = []
+        for i, future in enumerate(futures):
+            row = {VARIANT_COLUMN: i}
+            row.update(variants[i])
+            row.update(future.result())
+            rows.append(row)
+            print("Variant %d/%d" % (i + 1, len(variants)), end="\r")
+    print()
+    return rows
+
+def saveTable(rows, filename): #CSV with one column per parameter and metric, in order of appearance
+    columns = []
+    for row in rows:
+        for column in row:
+            if column not in columns:
+                columns.append(column)
+    with open(filename, "w+", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+# Reads the sweep file, runs the sweep and saves the table in the output folder
+def runSweepFromJSON(filename, workers = None):
+    with open(filename, "r") as f:
+        sweep = json.load(f)
+    with open(sweep[SCENARIO_STRING], "r") as f: #the base configuration is parsed and validated once
+        baseData = json.load(f)
+    Simulation.validateJSON(baseData)
+    mode = sweep[MODE_STRING] if MODE_STRING in sweep else MODE_GRID
+    if mode == MODE_GRID:
+        variants = gridVariants(sweep[PARAMETERS_STRING])
+    elif mode == MODE_RANDOM:
+        variants = randomVariants(sweep[PARAMETERS_STRING], sweep[SAMPLES_STRING], sweep[SWEEP_SEED_STRING] if SWEEP_SEED_STRING in sweep else None)
+    else:
+        raise ValueError("Unknown sweep mode: %s" % mode)
+    rows = runSweep(baseData, variants, workers, sweep[SIMULATION_SEED_STRING] if SIMULATION_SEED_STRING in sweep else None)
+    os.makedirs("../output", exist_ok=True)
+    simName = baseData[Simulation.SIMULATION_INFO_STRING][Simulation.SIMULATION_NAME_STRING]
+    tableFile = "../output/%s_sweep_%i.csv" % (simName, len(variants))
+    saveTable(rows, tableFile)
+    print("Data saved to %s" % os.path.abspath(tableFile))
+    return rows
+
+def main(argv):
+    if len(argv) < 1:
+        print("Usage: python sweep.py sweep.json [workers]")
+        return
+    workers = int(argv[1]) if len(argv) > 1 else None
+    try:
+        runSweepFromJSON(argv[0], workers)
+    except Exception as e:
+        print("Error:", e)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)
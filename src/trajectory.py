@@ -0,0 +1,159 @@
+"""
+@file    trajectory.py
+@authors  David Megli
+
+Description:
+This file contains the binary trajectory format, a compact alternative to the JSON vehicles history ("vehicleHistoryFormat": "bin").
+The file has a fixed size header, the records of the vehicles states, a time index and the table of the state names:
+- header: magic "VTRJ", version, record size, number of records, number of time buckets, offset of the time index, offset and length of the state names,
+  bounding box of the coordinates of all the records (min x, min y, max x, max y), so a player can set up its axes without reading the records
+- records: one fixed width record per saved state (time, vehicle id, road id, position, x, y, speed, acceleration, state code), grouped by time
+- time index: one entry per time bucket (time, first record, number of records), in order of time
+- state names: JSON list, the state code of a record is the index of its name
+All the numbers are little endian. The values are saved with full precision, they are not rounded as in the JSON files.
+TrajectoryWriter appends one time bucket at a time and writes the index at the end, so it's used while the simulation runs (see data.VehicleHistoryWriter).
+TrajectoryReader maps the records with numpy.memmap, so a time window is read without loading the whole file.
+The writer only uses the standard library, numpy is only needed by the reader.
+"""
+import json
+import struct
+
+MAGIC = b"VTRJ"
+VERSION = 2 #version 2 added the bounding box to the header
+HEADER_FORMAT = "<4sHHQQQQQdddd" #magic, version, record size, records, buckets, index offset, names offset, names length, min x, min y, max x, max y
+RECORD_FORMAT = "<dqidddddB" #time, vehicle id, road id, position, x, y, speed, acceleration, state code
+INDEX_FORMAT = "<dQQ" #time, first record, number of records
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_FORMAT)
+NO_ROAD = -1
+
+def getRecordDtype(): #numpy layout of a record, same fields and offsets of RECORD_FORMAT
+    import numpy as np # numpy is only imported by the reader
+    return np.dtype([("time", "<f8"), ("vehicle", "<i8"), ("road", "<i4"), ("position", "<f8"), ("x", "<f8"), ("y", "<f8"),
+                     ("speed", "<f8"), ("acceleration", "<f8"), ("state", "u1")])
+
+def getIndexDtype():
+    import numpy as np
+    return np.dtype([("time", "<f8"), ("first", "<u8"), ("count", "<u8")])
+
+class TrajectoryWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.recordCount = 0
+        self.index = [] #(time, first record, number of records) of the buckets written
+        self.stateNames = [] #state code -> state name, codes are given in order of appearance
+        self.stateCodes = {}
+        self.bounds = None #[min x, min y, max x, max y] of the records written
+
+    def open(self):
+        self.file = open(self.filename, "wb+")
+        self.file.write(b"\0" * HEADER_SIZE) #the header is written by close, when the counts are known
+        self.recordCount = 0
+        self.index = []
+        return self
+
+    def __getstate__(self): #the records written so far are flushed, the file is reopened by reopen (see checkpoint.py)
+        state = self.__dict__.copy()
+        if self.file is not None:
+            self.file.flush()
+            state["file"] = None
+        return state
+
+    def suspend(self): #closes the file without the header and the index, reopen continues it
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def reopen(self): #continues the file after the records counted in recordCount, dropping what was written after them
+        offset = HEADER_SIZE + self.recordCount * RECORD_SIZE
+        self.file = open(self.filename, "rb+")
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        return self
+
+    def getStateCode(self, state):
+        code = self.stateCodes.get(state)
+        if code is None:
+            code = len(self.stateNames)
+            self.stateNames.append(state)
+            self.stateCodes[state] = code
+        return code
+
+    def writeBucket(self, time, states, coordinates): #states is a list of (vehicle id, (time, position, speed, acceleration, state, road)), already in order, coordinates their (x, y)
+        records = bytearray()
+        for row, (vehicleId, (stateTime, position, speed, acceleration, state, road)) in enumerate(states):
+            x, y = coordinates[row]
+            if self.bounds is None:
+                self.bounds = [x, y, x, y]
+            elif x < self.bounds[0] or y < self.bounds[1] or x > self.bounds[2] or y > self.bounds[3]:
+                self.bounds = [min(self.bounds[0], x), min(self.bounds[1], y), max(self.bounds[2], x), max(self.bounds[3], y)]
+            records += struct.pack(RECORD_FORMAT, stateTime, vehicleId, road.id if road is not None else NO_ROAD, position, x, y,
+                                   speed, acceleration, self.getStateCode(state))
+        self.file.write(records)
+        self.index.append((time, self.recordCount, len(states)))
+        self.recordCount += len(states)
+
+    def close(self):
+        if self.file is None:
+            return
+        indexOffset = HEADER_SIZE + self.recordCount * RECORD_SIZE
+        self.file.write(b"".join(struct.pack(INDEX_FORMAT, *entry) for entry in self.index))
+        names = json.dumps(self.stateNames).encode("utf-8")
+        namesOffset = indexOffset + len(self.index) * INDEX_ENTRY_SIZE
+        self.file.write(names)
+        self.file.seek(0)
+        bounds = self.bounds if self.bounds is not None else [0, 0, 0, 0]
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, RECORD_SIZE, self.recordCount, len(self.index), indexOffset, namesOffset, len(names), *bounds))
+        self.file.close()
+        self.file = None
+
+# TrajectoryReader gives the records of a binary trajectory file as a numpy structured array mapped on the file:
+# the records of a time window are found with a binary search on the time index and only their pages are read from disk
+class TrajectoryReader:
+    def __init__(self, filename):
+        import numpy as np # numpy is only imported by the reader
+        self.filename = filename
+        with open(filename, "rb") as f:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                raise ValueError("Not a trajectory file: %s" % filename)
+            magic, version, recordSize, recordCount, bucketCount, indexOffset, namesOffset, namesLength, *bounds = struct.unpack(HEADER_FORMAT, header)
+            if magic != MAGIC:
+                raise ValueError("Not a trajectory file: %s" % filename)
+            if version != VERSION or recordSize != RECORD_SIZE:
+                raise ValueError("Unsupported trajectory file version %d (record size %d)" % (version, recordSize))
+            f.seek(namesOffset)
+            self.stateNames = json.loads(f.read(namesLength).decode("utf-8"))
+        self.recordCount = recordCount
+        self.bucketCount = bucketCount
+        self.bounds = tuple(bounds) #min x, min y, max x, max y
+        self.records = np.memmap(filename, dtype=getRecordDtype(), mode="r", offset=HEADER_SIZE, shape=(recordCount,)) if recordCount > 0 else np.zeros(0, dtype=getRecordDtype())
+        self.index = np.fromfile(filename, dtype=getIndexDtype(), count=bucketCount, offset=indexOffset)
+
+    def getTimes(self):
+        return self.index["time"]
+
+    def getBounds(self):
+        return self.bounds
+
+    def getRecords(self, startTime = None, endTime = None): #records with startTime <= time < endTime, a view on the mapped file
+        times = self.index["time"]
+        first = 0 if startTime is None else int(times.searchsorted(startTime, side="left"))
+        last = len(times) if endTime is None else int(times.searchsorted(endTime, side="left"))
+        if first >= last:
+            return self.records[0:0]
+        start = int(self.index["first"][first])
+        end = int(self.index["first"][last - 1] + self.index["count"][last - 1])
+        return self.records[start:end]
+
+    def getRecordsAt(self, time): #records of a single time bucket
+        i = int(self.index["time"].searchsorted(time, side="left"))
+        if i == len(self.index) or self.index["time"][i] != time:
+            return self.records[0:0]
+        start = int(self.index["first"][i])
+        return self.records[start:start + int(self.index["count"][i])]
+
+    def getStateName(self, code):
+        return self.stateNames[code]
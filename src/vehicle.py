@@ -14,6 +14,8 @@ import random
 from statistics import median
 import math
 import json
+from array import array
+from itertools import repeat
 
 # VehicleState represent the state of a vehicle at a given time, including the time, position, speed, acceleration and state of the vehicle
 class VehicleState:
@@ -34,13 +36,21 @@ class VehicleState:
         self.acceleration = acceleration
         self.state = state
         self.road = road
-        self.coordX = -1
-        self.coordY = -1
-        if road is not None:
-            coord = road.getCoordinatesByPosition(position)
-            if coord is not None:
-                self.coordX = coord.getX()
-                self.coordY = coord.getY()
+        self.coordinates = None #(x, y) projected from the road and the position only when they are read, see getCoordinates
+
+    def getCoordinates(self): #world coordinates of the state, (-1, -1) if the road has no shape
+        if self.coordinates is None:
+            coord = self.road.getCoordinatesByPosition(self.position) if self.road is not None else None
+            self.coordinates = (coord.getX(), coord.getY()) if coord is not None else (-1, -1)
+        return self.coordinates
+
+    @property
+    def coordX(self):
+        return self.getCoordinates()[0]
+
+    @property
+    def coordY(self):
+        return self.getCoordinates()[1]
 
     def setTime(self, time):
         self.time = time
@@ -90,6 +100,187 @@ class VehicleState:
     def getStateAsJSON(self):
         metrics = self.getVehicleState()
         return {VehicleState.TIME_STRING: metrics[0], VehicleState.POSITION_STRING: metrics[1], VehicleState.X_COORDINATE_STRING: metrics[2], VehicleState.Y_COORDINATE_STRING: metrics[3], VehicleState.SPEED_STRING: metrics[4], VehicleState.ACCELERATION_STRING: metrics[5], VehicleState.STATE_STRING: metrics[6], VehicleState.ROAD_STRING: metrics[7]}
+
+    # Returns the state as an entry of a time bucket of the history grouped by time, with the given (x, y) if they were already projected
+    def getStateAsTimeBucketJSON(self, vehicleId, coordinates = None):
+        x, y = coordinates if coordinates is not None else self.getCoordinates()
+        return {VehicleState.VEHICLE_ID_STRING: vehicleId, VehicleState.POSITION_STRING: self.getPosition(), VehicleState.X_COORDINATE_STRING: round(x, self.ROUND_DIGITS), VehicleState.Y_COORDINATE_STRING: round(y, self.ROUND_DIGITS), VehicleState.SPEED_STRING: self.getSpeed(), VehicleState.ACCELERATION_STRING: self.getAcceleration(), VehicleState.STATE_STRING: self.getState(), VehicleState.ROAD_STRING: self.road.id}
+
+# Returns a read-only property that reads the given column of the history at the index of the view
+def historyColumnProperty(column):
+    def get(self):
+        return getattr(self.history, column)[self.index]
+    return property(get)
+
+# VehicleStateView is a VehicleState that doesn't hold any value, it reads a row of a VehicleStateHistory.
+# Views are created on access (e.g. vehicle.stateHistory[-1]), so the history doesn't keep a Python object for each saved state.
+# The views are read-only: the saved states never change, and the history keeps values derived from them (the projected coordinates, the speed and acceleration sums)
+class VehicleStateView(VehicleState):
+    def __init__(self, history, index):
+        self.history = history
+        self.index = index
+
+    position = historyColumnProperty("position")
+    speed = historyColumnProperty("speed")
+    acceleration = historyColumnProperty("acceleration")
+
+    def getCoordinates(self):
+        return self.history.getCoordinates(self.index)
+
+    @property
+    def coordX(self):
+        return self.history.getCoordinates(self.index)[0]
+
+    @property
+    def coordY(self):
+        return self.history.getCoordinates(self.index)[1]
+
+    @property
+    def time(self):
+        return self.history.getTime(self.index)
+
+    @property
+    def state(self):
+        return VehicleStateHistory.STATE_NAMES[self.history.state[self.index]]
+
+    @property
+    def road(self):
+        return self.history.getRoadByCode(self.history.road[self.index])
+
+# VehicleStateHistory stores the states of a vehicle in typed columns (one array per field) instead of one VehicleState object per time step.
+# States and roads are stored as integer codes: state names are shared by all the histories, roads are indexed in a small per-vehicle table.
+# The history writer reads the row just saved with getRow (see Vehicle.saveState), so no object is built for each saved state.
+# Indexing and iterating the history return VehicleStateView objects, so it can be used as the old list of VehicleState.
+# The coordinates are not computed while the simulation runs: only road and position are saved, and the coordX and coordY columns
+# are filled by projectCoordinates when the coordinates are first read (e.g. when the history is exported), all the new states of a road at once
+class VehicleStateHistory:
+    STATE_NAMES = [] # state code -> state name
+    STATE_CODES = {} # state name -> state code
+    NO_ROAD = -1
+    def __init__(self):
+        self.time = array("d")
+        self.position = array("d")
+        self.speed = array("d")
+        self.acceleration = array("d")
+        self.coordX = array("d")
+        self.coordY = array("d")
+        self.state = array("B")
+        self.road = array("h")
+        self.roads = [] # road code -> road
+        self.roadCodes = {} # road -> road code
+        self.speedSum = 0.0 # running sums of the speed and acceleration columns, for Vehicle.getVehicleStateHistoryMetrics
+        self.accelerationSum = 0.0
+
+    @staticmethod
+    def getStateCode(state):
+        code = VehicleStateHistory.STATE_CODES.get(state)
+        if code is None:
+            code = len(VehicleStateHistory.STATE_NAMES)
+            VehicleStateHistory.STATE_NAMES.append(state)
+            VehicleStateHistory.STATE_CODES[state] = code
+        return code
+
+    def getRoadCode(self, road):
+        if road is None:
+            return self.NO_ROAD
+        code = self.roadCodes.get(road)
+        if code is None:
+            code = len(self.roads)
+            self.roads.append(road)
+            self.roadCodes[road] = code
+        return code
+
+    def getRoadByCode(self, code):
+        return self.roads[code] if code != self.NO_ROAD else None
+
+    def getTime(self, index): # times are stored as floats, integer times are returned as int as they were saved
+        time = self.time[index]
+        return int(time) if time.is_integer() else time
+
+    def append(self, time, position, speed, acceleration, state, road = None): #returns the index of the saved state
+        self.time.append(time)
+        self.position.append(position)
+        self.speed.append(speed)
+        self.acceleration.append(acceleration)
+        self.speedSum += speed
+        self.accelerationSum += acceleration
+        self.state.append(self.getStateCode(state))
+        self.road.append(self.getRoadCode(road))
+        return len(self.time) - 1
+
+    def getRow(self, index): #(time, position, speed, acceleration, state, road) of the state at the given index, as read by the views
+        return (self.getTime(index), self.position[index], self.speed[index], self.acceleration[index], self.STATE_NAMES[self.state[index]], self.getRoadByCode(self.road[index]))
+
+    def projectCoordinates(self): #computes the coordinates of the states saved after the last projection
+        first = len(self.coordX)
+        count = len(self.time) - first
+        if count == 0:
+            return
+        coordX = [-1] * count
+        coordY = [-1] * count
+        rowsByRoad = {} #road code -> rows of the new states on that road
+        for row, code in enumerate(self.road[first:]):
+            rowsByRoad.setdefault(code, []).append(row)
+        for code, rows in rowsByRoad.items():
+            road = self.getRoadByCode(code)
+            coords = road.getCoordinatesByPositions([self.position[first + row] for row in rows]) if road is not None else None
+            if coords is None:
+                continue
+            for row, x, y in zip(rows, coords[0], coords[1]):
+                coordX[row] = x
+                coordY[row] = y
+        self.coordX.extend(coordX)
+        self.coordY.extend(coordY)
+
+    def getCoordinates(self, index):
+        if index >= len(self.coordX):
+            self.projectCoordinates()
+        return self.coordX[index], self.coordY[index]
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.time)
+        if index < 0 or index >= len(self.time):
+            raise IndexError("vehicle state history index out of range")
+        return VehicleStateView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.time)):
+            yield VehicleStateView(self, index)
+
+    # When pickled (e.g. to move the vehicle to another process, see partition.py) the roads are saved by id and the states by name,
+    # since the codes of the states depend on the order they were first seen in each process. Call relinkRoads after unpickling
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["roads"] = [road if isinstance(road, int) else road.id for road in self.roads]
+        state["roadCodes"] = {}
+        state["stateNames"] = list(VehicleStateHistory.STATE_NAMES)
+        return state
+
+    def __setstate__(self, state):
+        stateNames = state.pop("stateNames")
+        self.__dict__.update(state)
+        codes = [self.getStateCode(name) for name in stateNames]
+        if codes != list(range(len(codes))):
+            self.state = array("B", [codes[code] for code in self.state])
+
+    def relinkRoads(self, roadsById): #replaces the road ids left by unpickling with the roads of this process
+        self.roads = [roadsById[road] if isinstance(road, int) else road for road in self.roads]
+        self.roadCodes = {road: code for code, road in enumerate(self.roads)}
+
+    def roundColumn(self, column): # rounds a whole column at once, used when the history is exported
+        return list(map(round, column, repeat(VehicleState.ROUND_DIGITS, len(column))))
+
+    def getStatesAsJSON(self): # same result as calling getStateAsJSON on every state, rounding column by column
+        self.projectCoordinates()
+        times = [int(time) if time.is_integer() else time for time in self.time]
+        states = [self.STATE_NAMES[code] for code in self.state]
+        roads = [self.getRoadByCode(code) for code in self.road]
+        columns = zip(times, self.roundColumn(self.position), self.roundColumn(self.coordX), self.roundColumn(self.coordY), self.roundColumn(self.speed), self.roundColumn(self.acceleration), states, roads)
+        return [{VehicleState.TIME_STRING: c[0], VehicleState.POSITION_STRING: c[1], VehicleState.X_COORDINATE_STRING: c[2], VehicleState.Y_COORDINATE_STRING: c[3], VehicleState.SPEED_STRING: c[4], VehicleState.ACCELERATION_STRING: c[5], VehicleState.STATE_STRING: c[6], VehicleState.ROAD_STRING: c[7]} for c in columns]
     
 # Vehicle is one of the main classes, it represents a vehicle in the simulation, with its states (time, position, speed, acceleration)
 class Vehicle:
@@ -139,7 +330,8 @@ class Vehicle:
         self.timeWaited = 0.0
         self.departDelay = 0.0
         self.lane = 0
-        self.stateHistory: list[VehicleState] = []
+        self.stateHistory = VehicleStateHistory()
+        self.historyWriter = None # if set, it's notified of every saved state (see data.VehicleHistoryWriter)
 
     # Static method that returns the metrics of a given list of vehicles
     @staticmethod
@@ -174,17 +366,23 @@ class Vehicle:
             avgAcc += m[1]
         avgSpeed /= len(vehicles)
         avgAcc /= len(vehicles)
-        arrivedVehicles = len([v for v in vehicles if v.isArrived()])
+        arrivedVehicles = len(timeWaited)
         return (minTravelTime, maxTravelTime, medianTravelTime, avgTravelTime, minStops, maxStops, medianStops, avgStops, minTimeWaited, maxTimeWaited, medianTimeWaited, avgTimeWaited, minDepartDelay, maxDepartDelay, medianDepartDelay, avgDepartDelay, avgSpeed, avgAcc, arrivedVehicles)
 
     @staticmethod
     def getVehiclesMetricsAsString(vehicles):
-        metrics = Vehicle.getVehiclesMetrics(vehicles)
+        return Vehicle.getMetricsTupleAsString(Vehicle.getVehiclesMetrics(vehicles))
+
+    @staticmethod
+    def getMetricsTupleAsString(metrics): #metrics as returned by getVehiclesMetrics (or by metrics.VehicleMetricsAccumulator)
         return "Duration: min: %f, max: %f, median: %f, average: %f\nStops: min: %f, max: %f, median: %f, average: %f\nTime Waited: min: %f, max: %f, median: %f, average: %f\nDeparture Delay: min: %f, max: %f, median: %f, average: %f\nAverage Speed: %f\nAverage Acceleration: %f\nArrived Vehicles: %d" % metrics
     
     @staticmethod
     def getVehiclesMetricsAsJSON(vehicles):
-        metrics = Vehicle.getVehiclesMetrics(vehicles)
+        return Vehicle.getMetricsTupleAsJSON(Vehicle.getVehiclesMetrics(vehicles))
+
+    @staticmethod
+    def getMetricsTupleAsJSON(metrics):
         return {"Duration": {"min": metrics[0], "max": metrics[1], "median": metrics[2], "average": metrics[3]}, "Stops": {"min": metrics[4], "max": metrics[5], "median": metrics[6], "average": metrics[7]}, "TimeWaited": {"min": metrics[8], "max": metrics[9], "median": metrics[10], "average": metrics[11]}, "DepartureDelay": {"min": metrics[12], "max": metrics[13], "median": metrics[14], "average": metrics[15]}, "AverageSpeed": metrics[16], "AverageAcceleration": metrics[17], "ArrivedVehicles": metrics[18]}
 
     @staticmethod
@@ -203,14 +401,18 @@ class Vehicle:
 
     @staticmethod
     def saveVehiclesStateHistoryGroupedByTime(vehicles, filename):
+        # single pass over the states: each state is put in the bucket of its time
+        # to write the history while the simulation is running use data.VehicleHistoryWriter
         vehiclesHistory = {Vehicle.VEHICLE_HISTORY_STRING: []}
         maxTime = max([v.stateHistory[-1].time for v in vehicles])
+        buckets = {}
         for t in range(maxTime):
-            vehiclesHistory[Vehicle.VEHICLE_HISTORY_STRING].append({VehicleState.TIME_STRING: t, Vehicle.VEHICLE_STATES_STRING: []})
-            for v in vehicles:
-                for state in v.stateHistory:
-                    if state.time == t:
-                        vehiclesHistory[Vehicle.VEHICLE_HISTORY_STRING][-1][Vehicle.VEHICLE_STATES_STRING].append({VehicleState.VEHICLE_ID_STRING: v.id, VehicleState.POSITION_STRING: state.getPosition(), VehicleState.X_COORDINATE_STRING: state.getCoordX(), VehicleState.Y_COORDINATE_STRING: state.getCoordY(), VehicleState.SPEED_STRING: state.getSpeed(), VehicleState.ACCELERATION_STRING: state.getAcceleration(), VehicleState.STATE_STRING: state.getState(), VehicleState.ROAD_STRING: state.road.id})
+            buckets[t] = {VehicleState.TIME_STRING: t, Vehicle.VEHICLE_STATES_STRING: []}
+            vehiclesHistory[Vehicle.VEHICLE_HISTORY_STRING].append(buckets[t])
+        for v in vehicles:
+            for state in v.stateHistory:
+                if state.time in buckets:
+                    buckets[state.time][Vehicle.VEHICLE_STATES_STRING].append(state.getStateAsTimeBucketJSON(v.id))
         with open(filename, "w+") as f:
             json.dump(vehiclesHistory, f, indent = 4)
 
@@ -218,18 +420,12 @@ class Vehicle:
         return self.stateHistory
     
     def getVehicleStateHistoryAsJSON(self):
-        history = {VehicleState.VEHICLE_ID_STRING: self.id, "History": []}
-        for state in self.stateHistory:
-            history["History"].append(state.getStateAsJSON())
-        return history
+        return {VehicleState.VEHICLE_ID_STRING: self.id, "History": self.stateHistory.getStatesAsJSON()}
     
-    def getVehicleStateHistoryMetrics(self):
-        avgSpeed = sum([state.speed for state in self.stateHistory])/len(self.stateHistory) if len(self.stateHistory) > 0 else 0
-        avgAcceleration = sum([state.acceleration for state in self.stateHistory])/len(self.stateHistory) if len(self.stateHistory) > 0 else 0
-        timeWaitingSemaphore = 0
-        for i in range(1,len(self.stateHistory)):
-            if self.stateHistory[i].state == self.STATE_WAITING_SEMAPHORE:
-                timeWaitingSemaphore += self.stateHistory[i].time - self.stateHistory[i-1].time
+    def getVehicleStateHistoryMetrics(self): #average speed and acceleration, from the running sums of the history
+        history = self.stateHistory
+        avgSpeed = history.speedSum/len(history) if len(history) > 0 else 0
+        avgAcceleration = history.accelerationSum/len(history) if len(history) > 0 else 0
         return (avgSpeed, avgAcceleration)
     
     def getVehicleStateHistoryMetricsAsJSON(self):
@@ -494,21 +690,74 @@ class Vehicle:
 
     def getLane(self):
         return self.lane
+
+    def setHistoryWriter(self, historyWriter):
+        self.historyWriter = historyWriter
+
+    def getStateCount(self): #number of states saved in the history
+        return len(self.stateHistory)
+
+    def retire(self): #returns the final metrics of an arrived vehicle, its state history is no longer needed (see RetiredVehicle)
+        return RetiredVehicle(self)
     
     # Function called in the update function to save the state of the vehicle at a given time in the vehicle state history
     def saveState(self, time, road = None):
-        pastTime = self.stateHistory[-1].time if len(self.stateHistory) > 0 else self.creationTime
-        pastSpeed = self.stateHistory[-1].speed if len(self.stateHistory) > 0 else self.initialSpeed
+        pastTime = self.stateHistory.getTime(-1) if len(self.stateHistory) > 0 else self.creationTime
+        pastSpeed = self.stateHistory.speed[-1] if len(self.stateHistory) > 0 else self.initialSpeed
         if time == 0: #debug
             print("Time: %d, pastTime: %d, pastSpeed: %d" % (time, pastTime, pastSpeed))
         if time < pastTime:
             return
         acceleration = (self.speed - pastSpeed) / (time - pastTime) if time > pastTime and time > self.creationTime else 0
-        self.stateHistory.append(VehicleState(time, self.position, self.speed, acceleration, self.state, road))
+        index = self.stateHistory.append(time, self.position, self.speed, acceleration, self.state, road)
+        if self.historyWriter is not None:
+            self.historyWriter.recordState(self, index)
         if time == 0: #debug
             print("Time: %d, position: %d, speed: %d, acceleration: %d, state: %s" % (time, self.position, self.speed, acceleration, self.state))
             print("Vehicle state saved: %s" % self.stateHistory[-1].getStateAsString())
 
+# RetiredVehicle keeps what the metrics need of a vehicle that left the network: the metrics are computed once, when the vehicle retires,
+# and the state history is dropped (it was already written to disk by the history writer, see data.VehicleHistoryWriter).
+# It answers the same metrics methods of Vehicle, so the lists of vehicles passed to getVehiclesMetrics can hold both
+class RetiredVehicle:
+    __slots__ = ("id", "creationTime", "arrivalTime", "departDelay", "timeWaited", "numberOfStops", "state", "metrics", "historyMetrics", "stateCount")
+    def __init__(self, vehicle: Vehicle):
+        self.id = vehicle.id
+        self.creationTime = vehicle.creationTime
+        self.arrivalTime = vehicle.arrivalTime
+        self.departDelay = vehicle.departDelay
+        self.timeWaited = vehicle.timeWaited
+        self.numberOfStops = vehicle.numberOfStops
+        self.state = vehicle.state
+        self.metrics = vehicle.getMetrics()
+        self.historyMetrics = vehicle.getVehicleStateHistoryMetrics()
+        self.stateCount = vehicle.getStateCount()
+
+    def isArrived(self):
+        return self.arrivalTime >= 0
+
+    def getArrivalTime(self):
+        return self.arrivalTime
+
+    def getTravelTime(self):
+        return self.metrics[6]
+
+    def getNumberOfStops(self):
+        return self.numberOfStops
+
+    def getMetrics(self):
+        return self.metrics
+
+    def getVehicleStateHistoryMetrics(self):
+        return self.historyMetrics
+
+    def getStateCount(self):
+        return self.stateCount
+
+    getMetricsAsString = Vehicle.getMetricsAsString
+    getMetricsAsJSON = Vehicle.getMetricsAsJSON
+    getVehicleStateHistoryMetricsAsJSON = Vehicle.getVehicleStateHistoryMetricsAsJSON
+
 class Car(Vehicle):
     LENGTH = 5
     MAX_SPEED = 41.67 #m/s = 150 km/h
@@ -0,0 +1,183 @@
+"""
+@file    warmstart.py
+@authors  David Megli
+
+Description:
+This file runs what-if experiments from a warmed up network: the simulation is run once for the warm-up cycles (e.g. until the roads fill up),
+then its state is forked in branches, each with its own changes (semaphore timings, vehicle injection rate, intersection fluxes), that run the remaining cycles in parallel processes.
+So the warm-up is simulated once instead of once per variant as in sweep.py.
+Where the "fork" start method is available (Linux) every branch is a fork of this process, that shares the warm state copy-on-write: nothing is copied or pickled.
+Elsewhere the warm state is pickled once as a checkpoint (see checkpoint.py) and every branch loads its own copy from the bytes.
+All the branches continue from the same state of the random generator, so the differences between them are due to the changes and not to the noise.
+The changes of a branch are a dictionary path -> value, where the path is the attribute of the simulation to change, with the attributes and list indexes
+separated by dots, e.g. "vehicleInjectionRate", "roads.0.semaphores.0.greenTime" or "intersections.0.outgoingRoadsFluxes".
+The warm-up and the branches don't write output files: the metrics of every branch (of the whole run, warm-up included) are returned and saved in a CSV table, one row per branch.
+Usage: python warmstart.py branches.json [workers]
+The branches file contains the scenario, the number of warm-up cycles and the changes of each branch, optionally the seed of the warm-up:
+{"scenario": "simulation.json", "warmup": 300, "branches": [{"vehicleInjectionRate": 2}, {"roads.0.semaphores.0.greenTime": 50, "roads.0.semaphores.0.redTime": 20}]}
+"""
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+from simulate import Simulation
+from montecarlo import flattenMetrics
+from sweep import PATH_SEPARATOR, saveTable
+
+SCENARIO_STRING = "scenario"
+WARMUP_STRING = "warmup"
+BRANCHES_STRING = "branches"
+SEED_STRING = "seed"
+BRANCH_COLUMN = "branch"
+POLL_INTERVAL = 1 #seconds between the checks of the branches processes that ended without a result
+
+# Returns the object and the attribute name or list index of the given path, raises ValueError if the path doesn't exist in the simulation
+def resolvePath(simulation, path):
+    keys = path.split(PATH_SEPARATOR)
+    node = simulation
+    for i, key in enumerate(keys):
+        if isinstance(node, list):
+            if not key.isdigit() or int(key) >= len(node):
+                raise ValueError("Unknown parameter: %s" % path)
+            key = int(key)
+        elif key.startswith("_") or not hasattr(node, key):
+            raise ValueError("Unknown parameter: %s" % path)
+        if i == len(keys) - 1:
+            return node, key
+        node = node[key] if isinstance(node, list) else getattr(node, key)
+
+# Applies the changes of a branch and clears what was computed from the old values: the phases of the semaphores and the semaphore index of the roads
+def applyChanges(simulation, changes):
+    for path, value in changes.items():
+        node, key = resolvePath(simulation, path)
+        if isinstance(node, list):
+            node[key] = value
+        else:
+            setattr(node, key, value)
+    for road in simulation.roads:
+        for semaphore in road.semaphores:
+            semaphore.compilePhases()
+        road.semaphoreIndex = None
+
+# Runs the warm-up cycles of the simulation, without output files, the branches continue from the cycle after them
+def warmUp(simulation, cycles):
+    if cycles <= 0 or cycles >= simulation.simulationCycles:
+        raise ValueError("The warm-up must be shorter than the simulation: %d cycles of %d" % (cycles, simulation.simulationCycles))
+    simulation.saveOutput = False
+    simulation.log = False #the branches would write the same log file
+    simulation.checkpointInterval = 0
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        simulation.simulate(0, cycles)
+    return simulation
+
+# Runs a branch in its own process and puts (index, metrics, error) in the results queue.
+# The simulation is the warm one of the parent with the fork start method, otherwise it's loaded from the checkpoint data
+def runBranch(index, changes, simulation, data, results):
+    try:
+        if simulation is None:
+            from checkpoint import loadCheckpointData
+            simulation = loadCheckpointData(data)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            applyChanges(simulation, changes)
+            simulation.resume()
+        results.put((index, flattenMetrics(simulation.getMetrics()), None))
+    except Exception as e:
+        results.put((index, None, str(e)))
+
+# Forks the warmed up simulation in one branch per dictionary of changes, runs at most workers branches at a time
+# and returns the rows of the results table, in the order of the branches. The warm simulation is not changed
+def runBranches(simulation, branches, workers = None):
+    if simulation.nextCycle == 0 or simulation.saveOutput or simulation.log:
+        raise ValueError("The simulation must be warmed up with warmUp")
+    for changes in branches: #invalid changes are reported before running anything
+        for path in changes:
+            resolvePath(simulation, path)
+    simulation.randomState = random.getstate() #every branch starts from the random state at the end of the warm-up
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        data = None
+        gc.freeze() #the warm objects are moved out of the collected generations, so the collections of the branches don't write (copy) their pages
+    else:
+        from checkpoint import getCheckpointData
+        context = multiprocessing.get_context()
+        data = getCheckpointData(simulation)
+    workers = workers if workers is not None else os.cpu_count()
+    results = context.Queue()
+    running = {} #index -> process of the branches running
+    pending = list(range(len(branches)))
+    metrics = [None] * len(branches)
+    errors = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                index = pending.pop(0)
+                process = context.Process(target=runBranch, args=(index, branches[index], simulation if data is None else None, data, results))
+                process.start()
+                running[index] = process
+            try:
+                index, branchMetrics, error = results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                for index, process in list(running.items()): #a branch killed before putting its result, the others exit with 0 after it
+                    if not process.is_alive() and process.exitcode != 0:
+                        process.join()
+                        del running[index]
+                        errors[index] = "exit code %s" % process.exitcode
+                continue
+            running.pop(index).join()
+            if error is not None:
+                errors[index] = error
+            metrics[index] = branchMetrics
+            print("Branch %d/%d" % (len(branches) - len(pending) - len(running), len(branches)), end="\r")
+    finally:
+        gc.unfreeze()
+        simulation.randomState = None
+        for process in running.values():
+            process.terminate()
+    print()
+    if errors:
+        index = min(errors)
+        raise RuntimeError("Branch %d failed: %s" % (index, errors[index]))
+    paths = list(dict.fromkeys(path for changes in branches for path in changes)) #a column for every changed attribute, empty in the branches that don't change it
+    rows = []
+    for index, changes in enumerate(branches):
+        row = {BRANCH_COLUMN: index}
+        row.update({path: changes.get(path, "") for path in paths})
+        row.update(metrics[index])
+        rows.append(row)
+    return rows
+
+# Reads the branches file, warms up the scenario, runs the branches and saves the table in the output folder
+def runBranchesFromJSON(filename, workers = None):
+    with open(filename, "r") as f:
+        experiment = json.load(f)
+    simulation = Simulation.getSimulationFromJSON(experiment[SCENARIO_STRING])
+    if simulation is None:
+        raise ValueError("Invalid simulation file: %s" % experiment[SCENARIO_STRING])
+    if SEED_STRING in experiment:
+        simulation.seed = experiment[SEED_STRING]
+    warmUp(simulation, experiment[WARMUP_STRING])
+    branches = experiment[BRANCHES_STRING]
+    rows = runBranches(simulation, branches, workers)
+    os.makedirs("../output", exist_ok=True)
+    tableFile = "../output/%s_branches_%i.csv" % (simulation.simulationName, len(branches))
+    saveTable(rows, tableFile)
+    print("Data saved to %s" % os.path.abspath(tableFile))
+    return rows
+
+def main(argv):
+    if len(argv) < 1:
+        print("Usage: python warmstart.py branches.json [workers]")
+        return
+    workers = int(argv[1]) if len(argv) > 1 else None
+    try:
+        runBranchesFromJSON(argv[0], workers)
+    except Exception as e:
+        print("Error:", e)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args)